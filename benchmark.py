@@ -0,0 +1,515 @@
+#!/usr/bin/python
+
+# Measure sync throughput end to end against a local object store stand-in.
+#
+# Synthetic trees are pushed to, resynced against, copied server side
+# between containers and pulled back from libcloud's LOCAL storage driver,
+# wrapped to add per-request latency and a per-connection bandwidth cap.
+# Finally the checksum manifests are deleted, and a resync has to fetch
+# every object to hash it again.
+# The wrapper also answers the raw Swift requests behind paged listings,
+# segmented uploads, ranged downloads and copies. No network access is
+# needed. Arguments after -- are passed through to push_to_cloudfiles, for
+# example:
+#
+#   ./benchmark.py --latency 20 --trees tiny,deep -- --jobs 8
+
+
+import argparse
+import datetime
+import hashlib
+import httplib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib
+
+from libcloud.storage.drivers.local import LocalStorageDriver
+from libcloud.storage.types import ContainerDoesNotExistError
+
+import local
+import push_to_cloudfiles
+import remote_libcloud
+import shalist
+import utility
+
+
+PROVIDER = 'bench'
+
+# Objects returned per simulated listing request
+LISTING_PAGE = 10000
+
+
+class StandInResponse(object):
+    """Just enough of a libcloud response for remote_libcloud."""
+
+    def __init__(self, status, body='', chunks=None):
+        self.status = status
+        self.body = body
+        self.headers = {}
+        self.chunks = chunks
+
+    def iter_content(self, chunk_size):
+        if self.chunks is not None:
+            return self.chunks
+        return iter([self.body])
+
+
+class StandInConnection(object):
+    """The raw Swift requests remote_libcloud makes, against local files.
+
+    Listings are paged, and split by delimiter, as Swift does. A Static
+    Large Object manifest is checked against its segments, which are then
+    joined into the object, so downloads needn't know about manifests.
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def request(self, action, params=None, data=None, headers=None,
+                method='GET', raw=False):
+        params = params or {}
+        headers = headers or {}
+        parts = [urllib.unquote(part)
+                 for part in action.lstrip('/').split('/', 1)]
+        try:
+            container = LocalStorageDriver.get_container(self.driver,
+                                                          parts[0])
+        except ContainerDoesNotExistError:
+            return StandInResponse(httplib.NOT_FOUND)
+
+        if len(parts) == 1 and method == 'GET':
+            return self.list(container, params)
+        if method == 'GET':
+            return self.get_range(container, parts[1], headers['Range'])
+        if method == 'PUT' and params.get('multipart-manifest') == 'put':
+            return self.put_manifest(container, parts[1], data, headers)
+        if method == 'PUT' and 'X-Copy-From' in headers:
+            return self.copy(container, parts[1], headers['X-Copy-From'])
+        return StandInResponse(httplib.NOT_IMPLEMENTED)
+
+    def list(self, container, params):
+        self.driver._call('list')
+        prefix = params.get('prefix', '')
+        marker = params.get('marker')
+        delimiter = params.get('delimiter')
+        limit = int(params.get('limit', LISTING_PAGE))
+
+        objects = sorted(LocalStorageDriver.iterate_container_objects(
+                             self.driver, container),
+                         key=lambda obj: obj.name)
+        entries = []
+        for obj in objects:
+            if not obj.name.startswith(prefix):
+                continue
+            if marker and obj.name <= marker:
+                continue
+
+            end = -1
+            if delimiter:
+                end = obj.name.find(delimiter, len(prefix))
+            if end >= 0:
+                # Like Swift, a page which starts at a subdirectory goes on
+                # from after it
+                subdir = obj.name[:end + 1]
+                if subdir == marker or (entries and
+                                        entries[-1].get('subdir') == subdir):
+                    continue
+                entries.append({'subdir': subdir})
+            else:
+                entries.append({'name': obj.name, 'bytes': obj.size,
+                                'hash': None, 'last_modified': None})
+            if len(entries) == limit:
+                break
+
+        if not entries:
+            return StandInResponse(httplib.NO_CONTENT)
+        return StandInResponse(httplib.OK, json.dumps(entries))
+
+    def path(self, container_name, object_name):
+        return os.path.join(self.driver.base_path, container_name,
+                            object_name)
+
+    def get_range(self, container, name, header):
+        start, end = [int(n) for n in header.split('=')[1].split('-')]
+        self.driver._call('download_range')
+        try:
+            with open(self.path(container.name, name), 'rb') as f:
+                f.seek(start)
+                data = f.read(end - start + 1)
+        except IOError:
+            return StandInResponse(httplib.NOT_FOUND)
+        return StandInResponse(httplib.PARTIAL_CONTENT,
+                               chunks=self.driver._throttle([data]))
+
+    def put_manifest(self, container, name, data, headers):
+        self.driver._call('upload_manifest')
+        chunks = []
+        for segment in json.loads(data):
+            segment_container, segment_name = \
+                segment['path'].lstrip('/').split('/', 1)
+            try:
+                with open(self.path(segment_container, segment_name),
+                          'rb') as f:
+                    chunk = f.read()
+            except IOError:
+                return StandInResponse(httplib.BAD_REQUEST)
+            if (len(chunk) != segment['size_bytes'] or
+                hashlib.md5(chunk).hexdigest() != segment['etag']):
+                return StandInResponse(httplib.BAD_REQUEST)
+            chunks.append(chunk)
+
+        prefix = 'x-object-meta-'
+        meta_data = dict((key.lower()[len(prefix):], value)
+                         for key, value in headers.items()
+                         if key.lower().startswith(prefix))
+        obj = LocalStorageDriver.upload_object_via_stream(
+            self.driver, iter(chunks), container, name)
+        self.driver._store_meta(obj, {'meta_data': meta_data})
+        return StandInResponse(httplib.CREATED)
+
+    def copy(self, container, name, source):
+        self.driver._call('copy')
+        source_container, source_name = [
+            urllib.unquote(part) for part in source.lstrip('/').split('/', 1)]
+        try:
+            source_obj = self.driver._make_object(
+                LocalStorageDriver.get_container(self.driver,
+                                                 source_container),
+                source_name)
+        except Exception:
+            return StandInResponse(httplib.NOT_FOUND)
+
+        obj = LocalStorageDriver.upload_object(
+            self.driver, self.path(source_container, source_name),
+            container, name)
+        self.driver._store_meta(obj, {'meta_data': source_obj.meta_data})
+        return StandInResponse(httplib.CREATED)
+
+
+class StandInDriver(LocalStorageDriver):
+    """libcloud's LOCAL driver, with costs and counts for each API call."""
+
+    latency = 0.0
+    bandwidth = 0
+    calls = {}
+    calls_lock = threading.Lock()
+
+    def __init__(self, key, secret=None, **kwargs):
+        # Ignore ex_force_service_region and friends
+        LocalStorageDriver.__init__(self, key, secret)
+        self.connection = StandInConnection(self)
+
+    # As the Cloud Files driver puts names in request paths
+    def _encode_container_name(self, name):
+        return urllib.quote(name)
+
+    def _encode_object_name(self, name):
+        return urllib.quote(name)
+
+    def _call(self, name, size=0):
+        with self.calls_lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+        delay = self.latency
+        if self.bandwidth and size:
+            delay += float(size) / self.bandwidth
+        if delay:
+            time.sleep(delay)
+
+    def _throttle(self, chunks):
+        for chunk in chunks:
+            if self.bandwidth:
+                time.sleep(float(len(chunk)) / self.bandwidth)
+            yield chunk
+
+    def _meta_path(self, container_name, object_name):
+        # The LOCAL driver doesn't keep object metadata, so the stand-in
+        # keeps it in a directory of its own
+        return os.path.join(self.base_path, '.meta', container_name,
+                            object_name)
+
+    def _store_meta(self, obj, extra):
+        path = self._meta_path(obj.container.name, obj.name)
+        meta_data = (extra or {}).get('meta_data')
+        if meta_data:
+            local.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(json.dumps(meta_data))
+            obj.meta_data = meta_data
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _make_object(self, container, object_name):
+        # The LOCAL driver's hashes are of the mtime, not an MD5 of the
+        # content, so don't let them pass for ETags
+        obj = LocalStorageDriver._make_object(self, container, object_name)
+        obj.hash = None
+        obj.meta_data = {}
+        path = self._meta_path(container.name, object_name)
+        if os.path.exists(path):
+            with open(path) as f:
+                obj.meta_data = json.loads(f.read())
+        return obj
+
+    def get_container(self, container_name):
+        self._call('get_container')
+        return LocalStorageDriver.get_container(self, container_name)
+
+    def create_container(self, container_name):
+        self._call('create_container')
+        return LocalStorageDriver.create_container(self, container_name)
+
+    def iterate_container_objects(self, container, ex_prefix=None):
+        self._call('list')
+        count = 0
+        for obj in LocalStorageDriver.iterate_container_objects(self,
+                                                                container):
+            if ex_prefix and not obj.name.startswith(ex_prefix):
+                continue
+            count += 1
+            if count % LISTING_PAGE == 0:
+                self._call('list')
+            yield obj
+
+    def get_object(self, container_name, object_name):
+        self._call('get_object')
+        return LocalStorageDriver.get_object(self, container_name,
+                                             object_name)
+
+    def download_object(self, obj, destination_path, *args, **kwargs):
+        self._call('download', obj.size)
+        return LocalStorageDriver.download_object(self, obj, destination_path,
+                                                  *args, **kwargs)
+
+    def download_object_as_stream(self, obj, chunk_size=None):
+        self._call('download')
+        return self._throttle(LocalStorageDriver.download_object_as_stream(
+            self, obj, chunk_size=chunk_size))
+
+    def upload_object(self, file_path, container, object_name, *args,
+                      **kwargs):
+        self._call('upload', os.path.getsize(file_path))
+        obj = LocalStorageDriver.upload_object(self, file_path, container,
+                                               object_name, *args, **kwargs)
+        self._store_meta(obj, kwargs.get('extra'))
+        return obj
+
+    def upload_object_via_stream(self, iterator, container, object_name,
+                                 *args, **kwargs):
+        self._call('upload')
+        obj = LocalStorageDriver.upload_object_via_stream(
+            self, self._throttle(iterator), container, object_name, *args,
+            **kwargs)
+        self._store_meta(obj, kwargs.get('extra'))
+        return obj
+
+    def delete_object(self, obj):
+        self._call('delete')
+        self._store_meta(obj, None)
+        return LocalStorageDriver.delete_object(self, obj)
+
+
+def register(config_path):
+    """Make PROVIDER the stand-in, with its config in config_path."""
+
+    remote_libcloud.CONFIG_PATH = config_path
+    remote_libcloud.DRIVERS[PROVIDER] = StandInDriver
+    remote_libcloud.PAGED_PROVIDERS.add(PROVIDER)
+
+
+# name -> (directories, depth, files per directory, file size)
+TREES = {
+    'tiny': (50, 1, 40, 1024),
+    'huge': (1, 1, 4, 32 * 1024 * 1024),
+    'deep': (4, 25, 5, 16 * 1024),
+}
+
+
+def make_tree(path, directories, depth, files, size, scale):
+    """Write a synthetic tree, unless it is already there."""
+
+    if os.path.exists(path):
+        return
+    print ('%s Generating %s' %(datetime.datetime.now(), path))
+
+    block = os.urandom(min(size, 1024 * 1024))
+    for d in range(max(1, int(directories * scale))):
+        directory = path
+        for level in range(depth):
+            directory = os.path.join(directory, 'd%03d' %(level or d))
+            os.makedirs(directory)
+            for f in range(files):
+                # Every file differs, but most of each is a shared block so
+                # generating large trees stays quick
+                name = os.path.join(directory, 'f%05d' % f)
+                with open(name, 'wb') as out:
+                    out.write(name)
+                    remaining = size - len(name)
+                    while remaining > 0:
+                        out.write(block[:remaining])
+                        remaining -= len(block)
+
+
+def remove_manifests(container_path):
+    # Object names are paths with / replaced by ~
+    for name in os.listdir(container_path):
+        if shalist.is_manifest(name.replace('~', '/')):
+            os.remove(os.path.join(container_path, name))
+
+
+def tree_size(path):
+    files = 0
+    total = 0
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            files += 1
+            total += os.path.getsize(os.path.join(root, name))
+    return files, total
+
+
+def run_phase(argv, results):
+    # Runs in its own process, so that RSS and counters are per phase
+    log = open(argv.pop(0), 'a')
+    sys.stdout = log
+    sys.stderr = log
+
+    start = time.time()
+    push_to_cloudfiles.sync(push_to_cloudfiles.parse_args(argv))
+    elapsed = time.time() - start
+
+    results.put({'elapsed': elapsed,
+                 'moved': push_to_cloudfiles.uploaded,
+                 'calls': StandInDriver.calls,
+                 'peak_rss': resource.getrusage(
+                     resource.RUSAGE_SELF).ru_maxrss * 1024})
+
+
+def benchmark(workdir, tree, phase, source, destination, sync_args):
+    files, total = tree_size(os.path.join(workdir, 'trees', tree))
+
+    argv = [os.path.join(workdir, 'sync.log'), '--checksum-index',
+            os.path.join(workdir, 'checksums.sqlite')]
+    argv.extend(sync_args)
+    argv.extend([source, destination])
+
+    results = multiprocessing.Queue()
+    p = multiprocessing.Process(target=run_phase, args=(argv, results))
+    p.start()
+    p.join()
+    if p.exitcode != 0:
+        print ('%s %s %s failed, see %s'
+               %(datetime.datetime.now(), tree, phase, argv[0]))
+        sys.exit(1)
+
+    result = results.get()
+    calls = sum(result['calls'].values())
+    result.update({'tree': tree,
+                   'phase': phase,
+                   'files': files,
+                   'bytes': total,
+                   'files_per_second': files / result['elapsed'],
+                   'mb_per_second': (total / result['elapsed'] /
+                                     1024 / 1024),
+                   'calls_per_file': float(calls) / max(files, 1)})
+
+    print ('%-5s %-9s %7d files %9.1f files/s %8.2f mb/s %6.2f calls/file '
+           '%7.1fs %s peak rss'
+           %(tree, phase, files, result['files_per_second'],
+             result['mb_per_second'], result['calls_per_file'],
+             result['elapsed'],
+             utility.DisplayFriendlySize(result['peak_rss'])))
+    return result
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    sync_args = []
+    if '--' in argv:
+        sync_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workdir', default=None,
+                        help='Where to put trees and the object store. '
+                             'Defaults to a temporary directory')
+    parser.add_argument('--keep', default=False, action='store_true',
+                        help='Keep the workdir afterwards')
+    parser.add_argument('--trees', default=','.join(sorted(TREES)),
+                        help='Comma separated trees to run, from %s'
+                             % ', '.join(sorted(TREES)))
+    parser.add_argument('--scale', default=1.0, type=float,
+                        help='Multiply the number of directories per tree')
+    parser.add_argument('--latency', default=0, type=float,
+                        help='Milliseconds added to every API call')
+    parser.add_argument('--bandwidth', default=0, type=float,
+                        help='Per connection bandwidth cap in mb/s, 0 for '
+                             'none')
+    parser.add_argument('--json', default=None,
+                        help='Also write the results to this file')
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='benchmark-')
+    store = os.path.join(workdir, 'store')
+    if not os.path.exists(store):
+        os.makedirs(store)
+    print '%s Working in %s' %(datetime.datetime.now(), workdir)
+
+    with open(os.path.join(workdir, 'cloudfiles.json'), 'w') as f:
+        f.write(json.dumps({PROVIDER: {'access_key': store,
+                                       'secret_key': ''}}))
+    register(os.path.join(workdir, 'cloudfiles.json'))
+    StandInDriver.latency = args.latency / 1000.0
+    StandInDriver.bandwidth = args.bandwidth * 1024 * 1024
+
+    # Low enough that the huge tree is uploaded in segments and downloaded
+    # in ranges. Later arguments win, so these can still be overridden.
+    sync_args = ['--segment-threshold', '16', '--segment-size', '8',
+                 '--fetch-threshold', '16', '--fetch-chunk-size', '8'] + \
+                sync_args
+
+    results = []
+    try:
+        for tree in args.trees.split(','):
+            if tree not in TREES:
+                print 'Unknown tree %s' % tree
+                sys.exit(1)
+
+            source = os.path.join(workdir, 'trees', tree)
+            make_tree(source, *(TREES[tree] + (args.scale,)))
+
+            download = os.path.join(workdir, 'download', tree)
+            for path in [os.path.join(store, name)
+                         for name in (tree, tree + '_segments',
+                                      tree + '-copy')] + [download]:
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+            os.makedirs(download)
+
+            # Copies between containers of the same store are made server
+            # side, and the download is from the copy, so that it reads
+            # the objects the copy made
+            remote = '%s@dfw://%s' %(PROVIDER, tree)
+            copy = '%s-copy' % remote
+            for phase, src, dst in [('upload', 'file://' + source, remote),
+                                    ('resync', 'file://' + source, remote),
+                                    ('copy', remote, copy),
+                                    ('download', copy,
+                                     'file://' + download),
+                                    ('rehash', 'file://' + source, remote)]:
+                if phase == 'rehash':
+                    remove_manifests(os.path.join(store, tree))
+                results.append(benchmark(workdir, tree, phase, src, dst,
+                                         sync_args))
+    finally:
+        if args.json:
+            with open(args.json, 'w') as f:
+                f.write(json.dumps(results, indent=4, sort_keys=True))
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir)
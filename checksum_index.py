@@ -0,0 +1,103 @@
+# A persistent cache of local file checksums
+
+
+import datetime
+import os
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_PATH = os.path.expanduser('~/.cache/cloudfiles-tools/checksums.sqlite')
+
+# Rows which haven't been looked at for this long are evicted on close
+MAX_AGE = 30 * 24 * 3600
+
+COMMIT_INTERVAL = 1000
+
+
+class ChecksumIndex(object):
+    """Remember the SHA-512 of local files between runs.
+
+    A cached checksum is only trusted if the size, mtime, ctime and inode of
+    the file are the same as when it was hashed. If reverify is set, every
+    file is hashed again and the cache is refreshed with the result.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, reverify=False, max_age=MAX_AGE):
+        self.path = path
+        self.reverify = reverify
+        self.max_age = max_age
+        self.now = time.time()
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+
+        d = os.path.dirname(self.path)
+        if d and not os.path.exists(d):
+            os.makedirs(d)
+
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS checksums ('
+                        'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                        'ctime REAL, inode INTEGER, checksum TEXT, '
+                        'seen REAL)')
+        self.db.commit()
+
+    def lookup(self, path, st):
+        """Return the cached checksum for path, or None."""
+
+        if self.reverify:
+            return None
+
+        with self.lock:
+            row = self.db.execute(
+                'SELECT size, mtime, ctime, inode, checksum FROM checksums '
+                'WHERE path = ?', (path,)).fetchone()
+            if (not row or
+                row[:4] != (st.st_size, st.st_mtime, st.st_ctime,
+                            st.st_ino)):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.db.execute('UPDATE checksums SET seen = ? WHERE path = ?',
+                            (self.now, path))
+            self._wrote()
+            return row[4]
+
+    def store(self, path, st, checksum):
+        # A file modified within the timestamp granularity of its hashing
+        # could change again without its mtime moving, so don't trust it
+        if st.st_mtime >= time.time() - 2:
+            return
+
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO checksums (path, size, mtime, ctime, '
+                'inode, checksum, seen) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (path, st.st_size, st.st_mtime, st.st_ctime, st.st_ino,
+                 checksum, self.now))
+            self._wrote()
+
+    def _wrote(self):
+        self.writes += 1
+        if self.writes % COMMIT_INTERVAL == 0:
+            self.db.commit()
+
+    def close(self):
+        """Evict stale rows and commit."""
+
+        with self.lock:
+            deleted = self.db.execute(
+                'DELETE FROM checksums WHERE seen < ?',
+                (self.now - self.max_age,)).rowcount
+            self.db.commit()
+            if deleted > 10000:
+                self.db.execute('VACUUM')
+            self.db.close()
+
+        print ('%s Checksum index: %d hits, %d misses, %d stale rows evicted'
+               %(datetime.datetime.now(), self.hits, self.misses, deleted))
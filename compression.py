@@ -0,0 +1,182 @@
+# Optional compression of objects as they are uploaded
+
+
+import os
+import tempfile
+import zlib
+
+has_zstd = False
+try:
+    import zstandard
+    has_zstd = True
+except ImportError:
+    pass
+
+
+CODECS = ['gzip', 'zstd']
+
+# The start of each file is compressed to decide if the whole file is worth
+# compressing. Files smaller than MIN_SIZE are always stored as they are.
+SAMPLE_SIZE = 256 * 1024
+MIN_SIZE = 4096
+
+# Compression has to save at least this fraction of the sample
+MIN_SAVING = 0.1
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def available(codec):
+    if codec == 'zstd':
+        return has_zstd
+    return codec in CODECS
+
+
+def compressor(codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor().compressobj()
+    return zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+
+def decompressor(codec):
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+
+def worth_compressing(sample, codec):
+    if not sample:
+        return False
+    c = compressor(codec)
+    size = len(c.compress(sample)) + len(c.flush())
+    return size <= len(sample) * (1 - MIN_SAVING)
+
+
+def metadata(codec, size):
+    """Object metadata describing a compressed object."""
+    return {'compression': codec, 'original-size': str(size)}
+
+
+def from_metadata(meta):
+    """(codec, original size) from object metadata, or None."""
+    codec = meta.get('compression')
+    if codec not in CODECS:
+        return None
+    try:
+        return codec, int(meta.get('original-size'))
+    except (TypeError, ValueError):
+        return None
+
+
+class PrefixedReader(object):
+    """Put back data which was already read from the front of a stream."""
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            d = self.prefix + self.stream.read()
+        else:
+            d = self.prefix[:size]
+        self.prefix = self.prefix[len(d):]
+        return d
+
+    def __iter__(self):
+        while True:
+            d = self.read(CHUNK_SIZE)
+            if not d:
+                return
+            yield d
+
+    def close(self):
+        if hasattr(self.stream, 'close'):
+            self.stream.close()
+
+
+class _CodecReader(object):
+    # Run everything read from a stream through a (de)compression object
+
+    def __init__(self, stream, codec):
+        self.stream = stream
+        self.codec = codec
+        self.buffer = ''
+        self.finished = False
+
+        # Bytes handed out, after (de)compression
+        self.count = 0
+
+    def read(self, size=-1):
+        while not self.finished and (size is None or size < 0 or
+                                     len(self.buffer) < size):
+            d = self.stream.read(CHUNK_SIZE)
+            if d:
+                self.buffer += self.process(d)
+            else:
+                # zstandard decompression objects may have no flush()
+                flush = getattr(self.obj, 'flush', None)
+                if flush:
+                    self.buffer += flush()
+                self.finished = True
+
+        if size is None or size < 0:
+            size = len(self.buffer)
+        d = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        self.count += len(d)
+        return d
+
+    def __iter__(self):
+        while True:
+            d = self.read(CHUNK_SIZE)
+            if not d:
+                return
+            yield d
+
+    def close(self):
+        if hasattr(self.stream, 'close'):
+            self.stream.close()
+
+
+class CompressingReader(_CodecReader):
+    """Compress a stream as it is read."""
+
+    def __init__(self, stream, codec):
+        _CodecReader.__init__(self, stream, codec)
+        self.obj = compressor(codec)
+
+    def process(self, d):
+        return self.obj.compress(d)
+
+
+class DecompressingReader(_CodecReader):
+    """Decompress a stream as it is read."""
+
+    def __init__(self, stream, codec):
+        _CodecReader.__init__(self, stream, codec)
+        self.obj = decompressor(codec)
+
+    def process(self, d):
+        return self.obj.decompress(d)
+
+
+def decompress_file(path, codec):
+    """Replace a compressed file with its content, returning the new path."""
+
+    (fd, decompressed) = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            with open(path, 'rb') as f:
+                reader = DecompressingReader(f, codec)
+                d = reader.read(CHUNK_SIZE)
+                while d:
+                    out.write(d)
+                    d = reader.read(CHUNK_SIZE)
+    except Exception:
+        os.remove(decompressed)
+        raise
+    os.remove(path)
+    return decompressed
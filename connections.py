@@ -0,0 +1,53 @@
+# Connections and the handles bound to them, shared between threads
+
+
+import threading
+
+
+class Slot(object):
+    """Whatever a thread caches against its connection, as attributes."""
+
+
+class _Lease(object):
+    # Held in the pool's thread local, so it is dropped, returning its slot
+    # to the pool, when the thread exits
+    def __init__(self, pool, slot):
+        self.pool = pool
+        self.slot = slot
+
+    def __del__(self):
+        self.pool._release(self.slot)
+
+
+class Pool(object):
+    """Per-thread connection slots, reused by the threads which follow.
+
+    Connections such as libcloud's can't be shared by threads running at
+    the same time, so each thread gets a slot of its own from get(). When
+    the thread exits its slot goes back to the pool, connection, container
+    handles and all, rather than the next thread having to authenticate
+    and look its containers up again. Segmented uploads, ranged fetches
+    and listings all run on threads which only last for one transfer.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = []
+        self.local = threading.local()
+        self.created = 0
+
+    def get(self):
+        lease = getattr(self.local, 'lease', None)
+        if lease is None:
+            with self.lock:
+                if self.idle:
+                    slot = self.idle.pop()
+                else:
+                    slot = Slot()
+                    self.created += 1
+            lease = self.local.lease = _Lease(self, slot)
+        return lease.slot
+
+    def _release(self, slot):
+        with self.lock:
+            self.idle.append(slot)
@@ -0,0 +1,77 @@
+# A map from content to the objects holding it, for deduplicating uploads
+
+
+import datetime
+import threading
+
+import workers
+
+
+class ContentIndex(object):
+    """Checksum -> path of an object in a container with that content.
+
+    Along with the path goes how the object is compressed, if it is, as
+    (codec, original size).
+
+    It is built from the checksum manifests already stored in the
+    container, so no objects need to be read. Entries whose object has
+    since gone from the container are left out. Files stored during the
+    sync are added as they finish, so later duplicates of them are found
+    too.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paths = {}
+
+    def build(self, container, jobs=4):
+        index = container.get_index()
+        directories = index.manifest_directories()
+
+        def load(path):
+            # Manifests are listed by their full path in the container,
+            # directories are fetched relative to its root
+            if path == container.basename:
+                relative = None
+            else:
+                relative = path[len(container.basename) + 1:]
+
+            manifest = container.get_directory(relative).shalist
+            for key in manifest.keys():
+                if index.exists(key):
+                    self.add(manifest[key], key, manifest.codec(key))
+
+        pool = workers.WorkerPool(jobs, name='dedup')
+        try:
+            for path in directories:
+                pool.submit(load, path)
+            pool.join()
+        finally:
+            pool.close()
+
+        print ('%s Indexed   %d distinct checksums from %d manifest '
+               'directories' %(datetime.datetime.now(), len(self.paths),
+                               len(directories)))
+
+    def add(self, checksum, path, codec=None):
+        if not checksum:
+            return
+        with self.lock:
+            self.paths.setdefault(checksum, (path, codec))
+
+    def lookup(self, checksum, path=None):
+        """(path, codec) of an object with this checksum, other than path."""
+
+        with self.lock:
+            found = self.paths.get(checksum)
+        if not found or found[0] == path:
+            return None
+        return found
+
+    def discard(self, checksum, path):
+        """Forget an object which turned out not to be usable."""
+
+        with self.lock:
+            found = self.paths.get(checksum)
+            if found and found[0] == path:
+                del self.paths[checksum]
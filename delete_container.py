@@ -1,44 +1,371 @@
 #!/usr/bin/python
 
+# Delete a container and everything in it.
+#
+# Objects are listed and deleted at the same time, in batches of up to
+# 1000 which are deleted in parallel. Cloud Files batches use Swift bulk
+# delete and s3 batches multi-object delete, so each batch is one request.
+#
+#   delete_container.py [-j JOBS] cloudfiles@ord://photos
+#   delete_container.py [-j JOBS] ord://photos          (pyrax)
+#   delete_container.py [-j JOBS] ord photos            (a raw container
+#                                                        name in Cloud Files)
+
+
+import argparse
+import base64
+import datetime
+import hashlib
+import httplib
 import json
-import os
+import re
 import sys
+import threading
+import time
+import urllib
+from xml.etree import ElementTree
 
 import libcloud
-from libcloud.storage.types import Provider
-from libcloud.storage.providers import get_driver
 
-import utility
+import remote_libcloud
+import workers
 
 
-def get_driver_helper(provider_name):
-    if provider_name == 'cloudfiles':
-        return get_driver(Provider.CLOUDFILES_US)
-    elif provider_name == 's3':
-        return get_driver(Provider.S3)
-    else:
-        print 'Unknown provider %s!' % provider_name
-        sys.exit(1)
+BATCH_SIZE = 1000
+JOBS = 8
+ATTEMPTS = 3
+PROGRESS_INTERVAL = 10
+
+LIBCLOUD_RE = re.compile('([a-z0-9]+)@([a-z_]+)://(.*)')
+PYRAX_RE = re.compile('([a-z]+)://(.*)')
+
+
+class LibcloudDeleter(object):
+    def __init__(self, provider_name, region, container_name):
+        self.provider_name = provider_name
+        self.region = region
+        self.container_name = container_name
+        self.provider = remote_libcloud.get_driver_helper(provider_name)
+        self.conf = remote_libcloud.load_config()[provider_name]
+
+        # libcloud connections are not thread safe
+        self.local = threading.local()
+
+    def get_connection(self):
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = self.provider(
+                self.conf['access_key'], self.conf['secret_key'],
+                ex_force_service_region=self.region)
+        return self.local.conn
+
+    def get_container(self):
+        if not hasattr(self.local, 'container'):
+            self.local.container = self.get_connection().get_container(
+                self.container_name)
+        return self.local.container
+
+    def exists(self):
+        try:
+            self.get_container()
+            return True
+        except libcloud.storage.types.ContainerDoesNotExistError:
+            return False
+
+    def list_names(self):
+        for obj in self.get_connection().iterate_container_objects(
+            self.get_container()):
+            yield obj.name
+
+    def delete_batch(self, names):
+        """Delete some objects, returning the names which failed."""
+
+        if self.provider_name == 'cloudfiles':
+            return self._bulk_delete(names)
+        elif self.provider_name == 's3':
+            return self._multi_delete(names)
+
+        failed = []
+        container = self.get_container()
+        for name in names:
+            try:
+                self.get_connection().delete_object(container.get_object(name))
+            except libcloud.storage.types.ObjectDoesNotExistError:
+                pass
+            except Exception:
+                failed.append(name)
+        return failed
+
+    def _bulk_delete(self, names):
+        conn = self.get_connection()
+        prefix = '/%s/' % self.container_name
+        body = '\n'.join([urllib.quote(utf8(prefix + name))
+                          for name in names])
+        response = conn.connection.request(
+            '/', method='POST', data=body, params={'bulk-delete': 1},
+            headers={'Content-Type': 'text/plain',
+                     'Accept': 'application/json'})
+        if response.status != httplib.OK:
+            raise Exception('bulk delete returned %d' % response.status)
+        return swift_failures(json.loads(response.body), self.container_name)
+
+    def _multi_delete(self, names):
+        conn = self.get_connection()
+        root = ElementTree.Element('Delete')
+        ElementTree.SubElement(root, 'Quiet').text = 'true'
+        for name in names:
+            ElementTree.SubElement(
+                ElementTree.SubElement(root, 'Object'), 'Key').text = name
+        body = ElementTree.tostring(root)
+
+        response = conn.connection.request(
+            conn._get_container_path(self.get_container()), method='POST',
+            data=body, params={'delete': ''},
+            headers={'Content-Type': 'application/xml',
+                     'Content-MD5': base64.b64encode(
+                         hashlib.md5(body).digest())})
+        if response.status != httplib.OK:
+            raise Exception('multi-object delete returned %d'
+                            % response.status)
+
+        # Quiet mode only reports the keys which could not be deleted
+        failed = []
+        for element in ElementTree.fromstring(response.body).iter():
+            if element.tag.endswith('Error'):
+                for child in element:
+                    if child.tag.endswith('Key'):
+                        failed.append(child.text)
+        return failed
+
+    def delete_container(self):
+        self.get_connection().delete_container(self.get_container())
+
+
+class PyraxDeleter(object):
+    def __init__(self, region, container_name):
+        # Only imported here, so the libcloud forms work without pyrax
+        import remote_pyrax
+
+        self.pyrax = remote_pyrax.pyrax
+        self.region = region
+        self.container_name = container_name
+        remote_pyrax.set_credentials(region)
+        self.local = threading.local()
+
+    def get_connection(self):
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = self.pyrax.connect_to_cloudfiles(
+                region=self.region.upper())
+        return self.local.conn
+
+    def exists(self):
+        try:
+            self.get_connection().get_container(self.container_name)
+            return True
+        except self.pyrax.exceptions.NoSuchContainer:
+            return False
+
+    def list_names(self):
+        container = self.get_connection().get_container(self.container_name)
+        marker = None
+        while True:
+            results = container.get_objects(marker=marker)
+            if not results:
+                return
+            for obj in results:
+                marker = obj.name
+                yield obj.name
+
+    def delete_batch(self, names):
+        conn = self.get_connection()
+        if hasattr(conn, 'bulk_delete'):
+            # pyrax empties the list it is given
+            results = conn.bulk_delete(self.container_name, list(names))
+            return swift_failures(results, self.container_name)
+
+        # Older pyrax can't bulk delete, so this is a request per object
+        failed = []
+        for name in names:
+            try:
+                conn.delete_object(self.container_name, name)
+            except (self.pyrax.exceptions.NoSuchObject,
+                    self.pyrax.exceptions.NotFound):
+                pass
+            except Exception:
+                failed.append(name)
+        return failed
+
+    def delete_container(self):
+        self.get_connection().delete_container(self.container_name)
+
+
+def utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def swift_failures(results, container_name):
+    # Swift answers a bulk delete with 200 whatever happened to it, and
+    # reports in the body: a status for the whole batch, and the objects
+    # which could not be deleted as (path, status) pairs. Objects which
+    # are already gone don't count.
+    status = results.get('Response Status') or results.get('status') or ''
+    prefix = '%s/' % container_name
+    failed = []
+    for path, error in (results.get('Errors') or results.get('errors') or
+                        []):
+        if error.startswith('404'):
+            continue
+        path = urllib.unquote(path).lstrip('/')
+        if path.startswith(prefix):
+            failed.append(path[len(prefix):])
+
+    # A batch which failed as a whole has no objects to blame
+    if status and not status.startswith('2') and not failed:
+        raise Exception('bulk delete returned %s' % status)
+    return failed
+
+
+class Progress(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.reported = self.start
+        self.deleted = 0
+        self.failed = 0
+
+    def update(self, deleted, failed):
+        with self.lock:
+            self.deleted += deleted
+            self.failed += failed
+            if time.time() - self.reported < PROGRESS_INTERVAL:
+                return
+            self.reported = time.time()
+        self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 0.001)
+        print ('%s Deleted   %d objects (%.1f per second), %d failed'
+               %(datetime.datetime.now(), self.deleted,
+                 self.deleted / elapsed, self.failed))
+
+
+def delete_objects(deleter, jobs=JOBS, batch_size=BATCH_SIZE):
+    """Delete every object, returning how many could not be deleted."""
+
+    progress = Progress()
+
+    def delete(names):
+        for attempt in range(ATTEMPTS):
+            try:
+                failed = deleter.delete_batch(names)
+            except Exception, e:
+                sys.stderr.write('%s Batch of %d failed (attempt %d): %s\n'
+                                 %(datetime.datetime.now(), len(names),
+                                   attempt, e))
+                continue
+
+            progress.update(len(names) - len(failed), 0)
+            if not failed:
+                return
+            names = failed
+        progress.update(0, len(names))
+
+    # The queue is bounded, so listing stays just ahead of the deletes
+    pool = workers.WorkerPool(jobs, queue_size=jobs, name='delete')
+    try:
+        batch = []
+        for name in deleter.list_names():
+            batch.append(name)
+            if len(batch) == batch_size:
+                pool.submit(delete, batch)
+                batch = []
+        if batch:
+            pool.submit(delete, batch)
+        pool.join()
+    finally:
+        pool.close()
+
+    progress.report()
+    return progress.failed
+
+
+def delete_container(deleter, jobs=JOBS, batch_size=BATCH_SIZE):
+    print ('%s Deleting  %s in %s'
+           %(datetime.datetime.now(), deleter.container_name,
+             deleter.region))
+
+    # Listings can lag behind deletes, so a container which still isn't
+    # empty gets another pass
+    for attempt in range(ATTEMPTS):
+        failed = delete_objects(deleter, jobs, batch_size)
+        if failed:
+            continue
+        try:
+            deleter.delete_container()
+            print ('%s Deleted   container %s'
+                   %(datetime.datetime.now(), deleter.container_name))
+            return True
+        except Exception, e:
+            print ('%s Could not delete container %s: %s'
+                   %(datetime.datetime.now(), deleter.container_name, e))
+    return False
+
+
+def get_deleter(target, container=None):
+    if container:
+        # The original form: a region and a raw Cloud Files container name
+        return LibcloudDeleter('cloudfiles', target, container)
+
+    m = LIBCLOUD_RE.match(target)
+    if m:
+        provider_name, region, name = m.groups()
+        return LibcloudDeleter(
+            provider_name, region,
+            remote_libcloud.container_name_for(provider_name, region, name))
+
+    m = PYRAX_RE.match(target)
+    if m:
+        import remote_pyrax
+
+        region, name = m.groups()
+        return PyraxDeleter(region,
+                            remote_pyrax.container_name_for(region, name))
+
+    print 'Unknown container URL format'
+    sys.exit(1)
 
 
 if __name__ == '__main__':
-    provider_name = 'cloudfiles'
-    region = sys.argv[1]
-    container_name = sys.argv[2]
-
-    provider = get_driver_helper(provider_name)
-
-    with open(os.path.expanduser('~/.cloudfiles'), 'r') as f:
-        conf = json.loads(f.read())
-        conn = provider(
-            conf[provider_name]['access_key'],
-            conf[provider_name]['secret_key'],
-            ex_force_service_region=region)
-        storage_class = conf[provider_name].get(
-            'storage_class', 'standard')
-
-    container = conn.get_container(container_name)
-    for f in container.list_objects():
-        print f.name
-        container.delete_object(f)
-    conn.delete_container(container)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', default=JOBS, type=int,
+                        help='Number of batches to delete in parallel')
+    parser.add_argument('--batch-size', default=BATCH_SIZE, type=int,
+                        help='Objects deleted per request, at most 1000')
+    parser.add_argument('--segments', default=False, action='store_true',
+                        help='Also delete the container holding large '
+                             'object segments')
+    parser.add_argument('target',
+                        help='A container URL as used by push_to_cloudfiles, '
+                             'or a Cloud Files region')
+    parser.add_argument('container', nargs='?',
+                        help='With a region, the name of the container')
+    args = parser.parse_args()
+
+    deleters = [get_deleter(args.target, args.container)]
+    if args.segments:
+        d = deleters[0]
+        if isinstance(d, LibcloudDeleter):
+            segments = LibcloudDeleter(d.provider_name, d.region,
+                                       '%s_segments' % d.container_name)
+        else:
+            segments = PyraxDeleter(d.region, '%s_segments' % d.container_name)
+        if segments.exists():
+            deleters.append(segments)
+
+    ok = True
+    for deleter in deleters:
+        ok = delete_container(deleter, args.jobs,
+                              min(args.batch_size, BATCH_SIZE)) and ok
+    if not ok:
+        sys.exit(1)
@@ -0,0 +1,88 @@
+# Checksums of files, shared by the local and remote backends
+
+
+import hashlib
+import mmap
+import multiprocessing
+import os
+import threading
+
+
+# hashlib releases the GIL while it hashes, so files checksummed from
+# several threads really are hashed in parallel
+try:
+    JOBS = multiprocessing.cpu_count()
+except NotImplementedError:
+    JOBS = 1
+
+# Bytes handed to hashlib at a time
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# With mapping turned on, files at least this big are memory mapped.
+# Otherwise files are read into a buffer each thread reuses.
+MMAP_THRESHOLD = 1024 * 1024
+
+# A mapped file which is truncated while it is hashed kills the process
+# with SIGBUS, so mapping is only for trees where files never shrink
+use_mmap = False
+
+_local = threading.local()
+
+
+def _buffer():
+    if not hasattr(_local, 'buffer'):
+        _local.buffer = bytearray(CHUNK_SIZE)
+    return _local.buffer
+
+
+def _mapped_chunks(m, size):
+    try:
+        offset = 0
+        while offset < size:
+            yield buffer(m, offset, CHUNK_SIZE)
+            offset += CHUNK_SIZE
+    finally:
+        m.close()
+
+
+def _read_chunks(f):
+    buf = _buffer()
+    view = memoryview(buf)
+    n = f.readinto(buf)
+    while n:
+        yield view[:n]
+        n = f.readinto(buf)
+
+
+def _chunks(f):
+    size = os.fstat(f.fileno()).st_size
+    if use_mmap and size >= MMAP_THRESHOLD:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            # Not something which can be mapped, a pipe for example
+            pass
+        else:
+            return _mapped_chunks(m, size)
+    return _read_chunks(f)
+
+
+def hash_file(path, md5=False):
+    """Return (sha512, md5) hex digests of a file.
+
+    The MD5 is computed alongside the SHA-512 when asked for, so the file
+    is only read once for both. Otherwise it is None.
+    """
+
+    hashes = [hashlib.sha512()]
+    if md5:
+        hashes.append(hashlib.md5())
+
+    with open(path, 'rb') as f:
+        for chunk in _chunks(f):
+            for h in hashes:
+                h.update(chunk)
+
+    if md5:
+        return hashes[0].hexdigest(), hashes[1].hexdigest()
+    return hashes[0].hexdigest(), None
@@ -0,0 +1,114 @@
+# An append-only record of sync progress, so interrupted syncs can resume
+
+
+import datetime
+import json
+import os
+import threading
+
+
+class Journal(object):
+    """Files a sync has finished with.
+
+    Each line is a JSON record. A file record means the file was uploaded
+    or found to be current, along with its checksum if one is known and
+    the codec each destination stored it with, which are also updates
+    for the destination manifests. The first line names the source and
+    destination, so a journal is only ever resumed by the same sync.
+    Journals from older versions also hold directory records, which are
+    ignored.
+    """
+
+    def __init__(self, path, source, destination, resume=False):
+        self.path = path
+        self.source = source
+        self.destination = destination
+        self.lock = threading.Lock()
+
+        # Replayed from an earlier run
+        self.files = {}
+        self.checksums = {}
+        self.codecs = {}
+
+        if resume and os.path.exists(path):
+            self._replay()
+            self.f = open(path, 'a')
+        else:
+            self.f = open(path, 'w')
+            self._append({'type': 'start', 'source': source,
+                          'destination': destination})
+
+    def _replay(self):
+        count = 0
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line of a journal which was killed mid write
+                    continue
+                count += 1
+
+                if record['type'] == 'start':
+                    if (record['source'] != self.source or
+                        record['destination'] != self.destination):
+                        raise ValueError('%s is a journal of %s to %s'
+                                         %(self.path, record['source'],
+                                           record['destination']))
+
+                elif record['type'] == 'file':
+                    key = (record['path'], record['name'])
+                    self.files[key] = record
+                    if record.get('checksum'):
+                        self.checksums.setdefault(record['path'], {})[
+                            record['name']] = record['checksum']
+                    if record.get('codecs') is not None:
+                        self.codecs.setdefault(record['path'], {})[
+                            record['name']] = record['codecs']
+
+        print ('%s Replayed %d journal records, %d files finished'
+               %(datetime.datetime.now(), count, len(self.files)))
+
+    def _append(self, record):
+        record['time'] = str(datetime.datetime.now())
+        with self.lock:
+            self.f.write(json.dumps(record, sort_keys=True))
+            self.f.write('\n')
+            self.f.flush()
+
+    def file_done(self, path, name, size, mtime, checksum=None,
+                  codecs=None):
+        # codecs holds (codec, original size) or None for each destination
+        self._append({'type': 'file', 'path': path, 'name': name,
+                      'size': size, 'mtime': mtime, 'checksum': checksum,
+                      'codecs': codecs})
+
+    def file_finished(self, path, name, size, mtime):
+        """Was this file finished by an earlier run, and not changed since?"""
+
+        record = self.files.get((path, name))
+        return (record is not None and record['size'] == size and
+                record['mtime'] == mtime)
+
+    def checksums_in(self, path):
+        """name -> checksum for files finished in directory path."""
+        return self.checksums.get(path, {})
+
+    def codecs_in(self, path, destination=0):
+        """name -> (codec, original size) or None for files finished in path.
+
+        The codecs are the ones the numbered destination stored the files
+        with. Files journaled without codecs are left out.
+        """
+        codecs = {}
+        for name, stored in self.codecs.get(path, {}).items():
+            if destination < len(stored):
+                codecs[name] = stored[destination] and tuple(
+                    stored[destination])
+        return codecs
+
+    def close(self):
+        with self.lock:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.f.close()
@@ -0,0 +1,161 @@
+# Listing huge containers in parallel, a slice of the key space at a time
+
+
+import datetime
+import threading
+import Queue
+
+import workers
+
+
+# Remote object names flatten paths with this
+DELIMITER = '~'
+
+JOBS = 8
+
+# Objects asked for per listing request
+PAGE_SIZE = 10000
+
+# The key space is split along directories until there are this many
+# slices per job, or the tree has been split this many levels deep
+SLICES_PER_JOB = 4
+MAX_DEPTH = 3
+
+
+def swift_page(entries):
+    """Split a Swift JSON listing into (objects, subdirectory prefixes)."""
+
+    objects = []
+    subdirs = []
+    for entry in entries:
+        if 'subdir' in entry:
+            subdirs.append(entry['subdir'])
+        else:
+            objects.append((entry['name'], int(entry['bytes']),
+                            entry['hash'], entry['last_modified']))
+    return objects, subdirs
+
+
+def _pages(list_page, prefix, delimiter=None):
+    # list_page(prefix, marker, delimiter) returns (objects, subdirs,
+    # marker), where the marker is None after the last page
+    marker = None
+    while True:
+        objects, subdirs, marker = list_page(prefix, marker, delimiter)
+        yield objects, subdirs
+        if marker is None:
+            return
+
+
+def _map(func, items, jobs):
+    # map() on up to jobs threads, raising the first error
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+    results = []
+    errors = []
+
+    def run():
+        while not errors:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results.append(func(item))
+            except Exception, e:
+                errors.append(e)
+
+    threads = []
+    for i in range(min(jobs, len(items))):
+        t = threading.Thread(target=run, name='listing-%d' % i)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        workers.join_thread(t)
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+def partition(list_page, prefix, emit, jobs=JOBS, max_depth=MAX_DEPTH):
+    """Split the names starting with prefix into slices of the key space.
+
+    The container is listed a directory level at a time, until there are
+    enough directories to keep jobs listers busy. Objects found on the way
+    are passed to emit(). Returns the prefixes of the directories below
+    that, which between them hold everything else.
+    """
+
+    def level(p):
+        subdirs = []
+        for objects, found in _pages(list_page, p, DELIMITER):
+            emit(objects)
+            subdirs.extend(found)
+        return subdirs
+
+    prefixes = [prefix]
+    depth = 0
+    while (prefixes and len(prefixes) < jobs * SLICES_PER_JOB and
+           depth < max_depth):
+        prefixes = [p for subdirs in _map(level, prefixes, jobs)
+                    for p in subdirs]
+        depth += 1
+    return prefixes
+
+
+def list_objects(list_page, prefix, jobs=JOBS):
+    """Yield (name, size, hash, last_modified) for names starting with prefix.
+
+    With more than one job the key space is partitioned, and the slices
+    listed concurrently. Objects are then not yielded in name order.
+    """
+
+    if jobs <= 1:
+        for objects, _ in _pages(list_page, prefix):
+            for obj in objects:
+                yield obj
+        return
+
+    # Listers hand pages over as they go, so nothing is held back until
+    # the whole listing is done
+    results = Queue.Queue(jobs * 4)
+    done = object()
+
+    def emit(objects):
+        if objects:
+            results.put(objects)
+
+    def flat(p):
+        for objects, _ in _pages(list_page, p):
+            emit(objects)
+
+    def run():
+        try:
+            prefixes = partition(list_page, prefix, emit, jobs)
+            print ('%s ... listing %d slices of the container with %d jobs'
+                   %(datetime.datetime.now(), len(prefixes), jobs))
+            _map(flat, prefixes, jobs)
+        except Exception, e:
+            results.put(e)
+        else:
+            results.put(done)
+
+    t = threading.Thread(target=run, name='listing')
+    t.daemon = True
+    t.start()
+
+    while True:
+        try:
+            objects = results.get(timeout=workers.WAIT)
+        except Queue.Empty:
+            continue
+        if objects is done:
+            break
+        if isinstance(objects, Exception):
+            raise objects
+        for obj in objects:
+            yield obj
+    workers.join_thread(t)
@@ -4,25 +4,44 @@
 
 
 import datetime
-import hashlib
+import errno
 import os
 import random
 import shutil
 
+import hashing
+import metrics
+
+
+def makedirs(path):
+    # Files are stored from several threads at once, so another one can
+    # create the directory between checking for it and making it
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
 
 class LocalContainer(object):
-    def __init__(self, name):
+    def __init__(self, name, checksum_index=None):
         self.name = name
         self.path = self.name.replace('file://', '')
         self.region = 'local'
+        self.checksum_index = checksum_index
+
+    def close(self):
+        pass
 
     def get_directory(self, path):
-        return LocalDirectory(self.region, self.path, path)
+        return LocalDirectory(self.region, self.path, path,
+                              checksum_index=self.checksum_index)
 
 
 class LocalDirectory(object):
-    def __init__(self, region, parent, path):
+    def __init__(self, region, parent, path, checksum_index=None):
         self.region = region
+        self.checksum_index = checksum_index
         if not path:
             self.path = parent
         else:
@@ -36,7 +55,8 @@ class LocalDirectory(object):
 
     def get_file(self, path):
         fullpath = os.path.join(self.path, path)
-        return LocalFile(self.region, fullpath)
+        return LocalFile(self.region, fullpath,
+                         checksum_index=self.checksum_index)
 
     def update_shalist(self, path, checksum):
         pass
@@ -46,24 +66,43 @@ class LocalDirectory(object):
 
 
 class LocalFile(object):
-    def __init__(self, region, path):
+    def __init__(self, region, path, checksum_index=None):
         self.region = region
         self.path = path
+        self.checksum_index = checksum_index
         self.cache = {}
 
     def checksum(self):
         if 'checksum' in self.cache:
             return self.cache['checksum']
 
-        h = hashlib.sha512()
-        with open(self.path, 'r') as f:
-            d = f.read(1024 * 1204)
-            while d:
-                h.update(d)
-                d = f.read(1024 * 1024)
-        self.cache['checksum'] = h.hexdigest()
+        if self.checksum_index:
+            st = os.stat(self.path)
+            key = os.path.abspath(self.path)
+            checksum = self.checksum_index.lookup(key, st)
+            if checksum:
+                self.cache['checksum'] = checksum
+                return checksum
+
+        self._hash()
         return self.cache['checksum']
 
+    def md5(self):
+        if 'md5' not in self.cache:
+            self._hash(md5=True)
+        return self.cache['md5']
+
+    def _hash(self, md5=False):
+        # The SHA-512 is always computed, and the MD5 alongside it if asked
+        # for, so that a file is only read once for both
+        st = os.stat(self.path)
+        with metrics.timer('local_hash', st.st_size):
+            checksum, md5_checksum = hashing.hash_file(self.path, md5=md5)
+
+        if md5_checksum:
+            self.cache['md5'] = md5_checksum
+        self.update_checksum(checksum, st)
+
     def size(self):
         if 'size' in self.cache:
             return self.cache['size']
@@ -72,9 +111,7 @@ class LocalFile(object):
         return self.cache['size']
 
     def store(self, local_file):
-        d = os.path.dirname(self.path)
-        if not os.path.exists(d):
-            os.makedirs(d)
+        makedirs(os.path.dirname(self.path))
         print '%s Renaming %s to %s' %(datetime.datetime.now(), local_file, self.path)
         shutil.copy(local_file, self.path)
 
@@ -91,7 +128,39 @@ class LocalFile(object):
         return self.path
 
     def store(self, path):
-        parentdir = '/'.join(self.path.split('/')[:-1])
-        if not os.path.exists(parentdir):
-            os.makedirs(parentdir)
+        makedirs('/'.join(self.path.split('/')[:-1]))
         shutil.copy(path, self.path)
+
+    def store_stream(self, stream, size):
+        # A sync's streams check their size and checksum once they are read
+        # to the end, so the stream is written beside the file, and only
+        # replaces it after that. The ~ makes syncs from this tree skip it
+        # like any other backup file.
+        makedirs(os.path.dirname(self.path))
+        partial = '%s.%08x~' %(self.path, random.getrandbits(32))
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                d = stream.read(1024 * 1024)
+                while d:
+                    f.write(d)
+                    d = stream.read(1024 * 1024)
+            os.rename(partial, self.path)
+        except:
+            os.remove(partial)
+            raise
+        self.cache.pop('size', None)
+
+    def open(self):
+        f = open(self.path, 'rb')
+        self.cache['stat'] = os.fstat(f.fileno())
+        return f
+
+    def update_checksum(self, checksum, st=None):
+        # Record a checksum computed while the file was read, possibly for
+        # some other reason such as an upload
+        self.cache['checksum'] = checksum
+        st = st or self.cache.get('stat')
+        if self.checksum_index and st:
+            self.checksum_index.store(os.path.abspath(self.path), st,
+                                      checksum)
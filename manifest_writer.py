@@ -0,0 +1,90 @@
+# Coalesce checksum manifest writes onto a background thread
+
+
+import datetime
+import sys
+import threading
+import time
+
+
+INTERVAL = 30
+BATCH_SIZE = 100
+
+
+class ManifestWriter(object):
+    """Write directory manifests in the background.
+
+    Directories are scheduled each time one of their checksums changes.
+    The writer thread waits until either interval seconds have passed or
+    batch_size updates are pending, and then writes each scheduled
+    directory once, however many updates it received in the meantime.
+    """
+
+    def __init__(self, interval=INTERVAL, batch_size=BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.updates = 0
+        self.stopped = False
+        self.writes = 0
+
+        self.thread = threading.Thread(target=self._run,
+                                       name='manifest-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def schedule(self, directory):
+        with self.cond:
+            self.pending[id(directory)] = directory
+            self.updates += 1
+            if self.updates >= self.batch_size:
+                self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                deadline = time.time() + self.interval
+                while (not self.stopped and self.updates < self.batch_size
+                       and time.time() < deadline):
+                    self.cond.wait(deadline - time.time())
+                if self.stopped:
+                    return
+                pending = self._take()
+
+            self._write(pending, retry=True)
+
+    def _take(self):
+        pending = self.pending
+        self.pending = {}
+        self.updates = 0
+        return pending
+
+    def _write(self, pending, retry=False):
+        for directory in pending.values():
+            try:
+                directory.flush_shalist()
+                self.writes += 1
+            except Exception, e:
+                sys.stderr.write('%s Manifest write for %s failed: %s\n'
+                                 %(datetime.datetime.now(), directory.path,
+                                   e))
+                if retry:
+                    self.schedule(directory)
+
+    def flush(self):
+        """Write everything which is pending now, on this thread."""
+        with self.cond:
+            pending = self._take()
+        self._write(pending)
+
+    def close(self):
+        with self.cond:
+            if self.stopped:
+                return
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join()
+        self.flush()
+        print ('%s Wrote %d directory manifests'
+               %(datetime.datetime.now(), self.writes))
@@ -0,0 +1,208 @@
+# Timings and API call counts for a sync, exportable as JSON or for the
+# Prometheus node exporter's textfile collector
+
+
+import contextlib
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+
+INTERVAL = 60
+PREFIX = 'push_to_cloudfiles'
+
+
+class Metrics(object):
+    """Everything measured during a run.
+
+    Phases are timed per operation, so time spent by threads working in
+    parallel adds up. A phase with 10 seconds in it might have taken 2
+    seconds of wall clock time across 5 upload threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+        # phase -> [operations, seconds, bytes]
+        self.phases = {}
+
+        # (backend, method) -> calls
+        self.calls = {}
+
+        # name -> value
+        self.counters = {}
+
+    def record(self, phase, seconds, size=0):
+        with self.lock:
+            totals = self.phases.setdefault(phase, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += size or 0
+
+    @contextlib.contextmanager
+    def timer(self, phase, size=0):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(phase, time.time() - start, size)
+
+    def count_call(self, backend, method):
+        with self.lock:
+            key = (backend, method)
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def add(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            calls = {}
+            for (backend, method), count in self.calls.items():
+                calls.setdefault(backend, {})[method] = count
+            return {'elapsed': time.time() - self.started,
+                    'phases': dict([(phase, {'operations': t[0],
+                                             'seconds': t[1],
+                                             'bytes': t[2]})
+                                    for phase, t in self.phases.items()]),
+                    'calls': calls,
+                    'counters': dict(self.counters)}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=4, sort_keys=True)
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP %s_%s %s' %(PREFIX, name, help))
+            lines.append('# TYPE %s_%s %s' %(PREFIX, name, kind))
+            for labels, value in sorted(samples):
+                label = ','.join(['%s="%s"' %(k, v) for k, v in labels])
+                if label:
+                    label = '{%s}' % label
+                lines.append('%s_%s%s %s' %(PREFIX, name, label, value))
+
+        phases = sorted(snapshot['phases'].items())
+        metric('phase_seconds_total', 'counter',
+               'Time spent in each phase, summed over threads',
+               [((('phase', p),), t['seconds']) for p, t in phases])
+        metric('phase_operations_total', 'counter',
+               'Operations completed in each phase',
+               [((('phase', p),), t['operations']) for p, t in phases])
+        metric('phase_bytes_total', 'counter',
+               'Bytes handled in each phase',
+               [((('phase', p),), t['bytes']) for p, t in phases])
+        metric('api_calls_total', 'counter',
+               'Calls made to each storage backend method',
+               [((('backend', backend), ('method', method)), count)
+                for backend, methods in snapshot['calls'].items()
+                for method, count in methods.items()])
+        metric('events_total', 'counter', 'Files and bytes moved',
+               [((('event', name),), value)
+                for name, value in snapshot['counters'].items()])
+        metric('elapsed_seconds', 'gauge', 'Time since the sync started',
+               [((), snapshot['elapsed'])])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, format='json'):
+        if format == 'prometheus':
+            data = self.to_prometheus()
+        else:
+            data = self.to_json()
+
+        # Readers such as the textfile collector must never see a partial
+        # file
+        tmp = '%s.%d.tmp' %(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def summary(self):
+        snapshot = self.snapshot()
+        for phase, t in sorted(snapshot['phases'].items()):
+            print ('%s Phase     %-16s %8d ops %10.1f seconds %s'
+                   %(datetime.datetime.now(), phase, t['operations'],
+                     t['seconds'], t['bytes'] and
+                     '%d bytes' % t['bytes'] or ''))
+        for backend, methods in sorted(snapshot['calls'].items()):
+            for method, count in sorted(methods.items()):
+                print ('%s API calls %s.%s %d'
+                       %(datetime.datetime.now(), backend, method, count))
+
+
+class Exporter(object):
+    """Write metrics to a file every interval seconds, and on close."""
+
+    def __init__(self, metrics, path, format='json', interval=INTERVAL):
+        self.metrics = metrics
+        self.path = path
+        self.format = format
+        self.interval = interval
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target=self._run,
+                                       name='metrics-exporter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._write()
+
+    def _write(self):
+        try:
+            self.metrics.write(self.path, self.format)
+        except Exception, e:
+            sys.stderr.write('%s Writing metrics to %s failed: %s\n'
+                             %(datetime.datetime.now(), self.path, e))
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self._write()
+
+
+def instrument(obj, backend, methods):
+    """Count calls to the named methods of one object.
+
+    Only this instance is changed. Objects which hold a reference to it,
+    such as libcloud containers holding their driver, are counted too.
+    """
+
+    def counted(method, name):
+        def wrapper(*args, **kwargs):
+            METRICS.count_call(backend, name)
+            return method(*args, **kwargs)
+        return wrapper
+
+    for name in methods:
+        method = getattr(obj, name, None)
+        if method is not None:
+            setattr(obj, name, counted(method, name))
+    return obj
+
+
+METRICS = Metrics()
+
+
+def timer(phase, size=0):
+    return METRICS.timer(phase, size)
+
+
+def record(phase, seconds, size=0):
+    METRICS.record(phase, seconds, size)
+
+
+def count_call(backend, method):
+    METRICS.count_call(backend, method)
+
+
+def add(counter, value=1):
+    METRICS.add(counter, value)
@@ -0,0 +1,56 @@
+# A chain of worker pools connected by bounded queues
+
+
+import datetime
+import sys
+
+import workers
+
+
+class Pipeline(object):
+    """Items flow through a list of stages.
+
+    Each stage is a function run on its own pool of threads. It returns the
+    item to hand to the next stage, or None to drop it. Every item which
+    enters the pipeline is passed to the done callback exactly once, when
+    it is dropped, fails or leaves the last stage. Queues between stages
+    are bounded, so a slow stage applies backpressure to the ones before it.
+    """
+
+    def __init__(self, done=None):
+        self.stages = []
+        self.done = done
+
+    def add_stage(self, func, workers_count=1, queue_size=None, name=None):
+        if not name:
+            name = func.__name__
+        pool = workers.WorkerPool(workers_count, queue_size=queue_size,
+                                  name=name)
+        self.stages.append((name, func, pool))
+
+    def put(self, item):
+        self.stages[0][2].submit(self._process, 0, item)
+
+    def _process(self, index, item):
+        name, func, pool = self.stages[index]
+        result = None
+        try:
+            result = func(item)
+        except Exception, e:
+            sys.stderr.write('%s Stage %s failed: %s\n'
+                             %(datetime.datetime.now(), name, e))
+
+        if result is not None and index + 1 < len(self.stages):
+            self.stages[index + 1][2].submit(self._process, index + 1,
+                                             result)
+            return
+
+        if self.done:
+            self.done(item)
+
+    def join(self):
+        """Wait for every item to leave the pipeline, then stop the threads."""
+        for name, func, pool in self.stages:
+            pool.join()
+        for name, func, pool in self.stages:
+            pool.close()
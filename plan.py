@@ -0,0 +1,144 @@
+# Sync plans: what a sync would do, worked out before doing any of it
+
+
+import datetime
+import json
+import threading
+import time
+
+import utility
+
+
+NEW = 'new'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+SKIPPED = 'skipped'
+
+ACTIONS = [NEW, CHANGED, UNCHANGED, SKIPPED]
+
+# Entries with these actions are the ones which need transferring
+TRANSFERS = [NEW, CHANGED]
+
+VERSION = 1
+
+
+class Plan(object):
+    """Every file a sync considered, and what it decided to do with it.
+
+    Plans are saved as JSON lines. The first line describes the sync, and
+    each following line is one file: the directory it is in (relative to
+    the root of the sync), its name within that directory, the action,
+    its size and, for skipped files, why.
+    """
+
+    def __init__(self, source, destination):
+        self.source = source
+        self.destination = destination
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def add(self, action, path, name, size=None, reason=None):
+        entry = {'action': action, 'path': path, 'name': name,
+                 'size': size}
+        if reason:
+            entry['reason'] = reason
+        with self.lock:
+            self.entries.append(entry)
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            f.write(json.dumps({'version': VERSION,
+                                'source': self.source,
+                                'destination': self.destination,
+                                'created': str(datetime.datetime.now())}))
+            f.write('\n')
+            for entry in self.sorted('path'):
+                f.write(json.dumps(entry, sort_keys=True))
+                f.write('\n')
+
+    @classmethod
+    def read(cls, filename):
+        with open(filename) as f:
+            header = json.loads(f.readline())
+            if header.get('version') != VERSION:
+                raise ValueError('%s is not a version %d plan'
+                                 %(filename, VERSION))
+
+            plan = cls(header['source'], header['destination'])
+            for line in f:
+                if line.strip():
+                    plan.entries.append(json.loads(line))
+        return plan
+
+    def sorted(self, order):
+        """Entries in path order, or largest first."""
+
+        with self.lock:
+            entries = list(self.entries)
+        entries.sort(key=lambda e: (e['path'] or '', e['name']))
+        if order == 'largest':
+            entries.sort(key=lambda e: e['size'] or 0, reverse=True)
+        return entries
+
+    def transfers(self, order='path'):
+        return [e for e in self.sorted(order) if e['action'] in TRANSFERS]
+
+    def totals(self):
+        """action -> (number of files, bytes)."""
+
+        totals = dict([(action, (0, 0)) for action in ACTIONS])
+        with self.lock:
+            for entry in self.entries:
+                files, size = totals[entry['action']]
+                totals[entry['action']] = (files + 1,
+                                           size + (entry['size'] or 0))
+        return totals
+
+    def dump(self):
+        for entry in self.sorted('path'):
+            reason = ''
+            if 'reason' in entry:
+                reason = ' (%s)' % entry['reason']
+            print ('%-9s %s %s%s'
+                   %(entry['action'],
+                     utility.path_join(entry['path'], entry['name']),
+                     utility.DisplayFriendlySize(entry['size'] or 0), reason))
+        self.summary()
+
+    def summary(self):
+        totals = self.totals()
+        for action in ACTIONS:
+            files, size = totals[action]
+            print ('%s Plan      %-9s %d files, %s'
+                   %(datetime.datetime.now(), action, files,
+                     utility.DisplayFriendlySize(size)))
+
+
+class Progress(object):
+    """Report how far through a known amount of work we are."""
+
+    def __init__(self, files, size):
+        self.files = files
+        self.size = size
+        self.done_files = 0
+        self.done_size = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def update(self, size):
+        with self.lock:
+            self.done_files += 1
+            self.done_size += size
+            done_files = self.done_files
+            done_size = self.done_size
+
+        elapsed = time.time() - self.start
+        eta = 'unknown'
+        if done_size and elapsed:
+            remaining = (self.size - done_size) * elapsed / done_size
+            eta = str(datetime.timedelta(seconds=int(remaining)))
+
+        print ('%s Progress  %d of %d files, %s of %s, ETA %s'
+               %(datetime.datetime.now(), done_files, self.files,
+                 utility.DisplayFriendlySize(done_size),
+                 utility.DisplayFriendlySize(self.size), eta))
@@ -11,12 +11,30 @@ import datetime
 import json
 import os
 import re
+import signal
 import sys
+import threading
 import time
 
 import utility
 
+import checksum_index
+import compression
+import dedup
+import hashing
+import journal
+import listing
 import local
+import manifest_writer
+import metrics
+import pipeline
+import plan
+import scheduler
+import shalist
+import streams
+import transfers
+import watch
+import workers
 
 
 has_pyrax = False
@@ -39,20 +57,218 @@ except ImportError, e:
 
 uploaded = 0
 destination_total = 0
+counter_lock = threading.Lock()
 
 ARGS = None
+SCHEDULER = scheduler.UNLIMITED
+JOURNAL = None
 
+# Destination container -> content index, for those being deduplicated
+DEDUP = {}
 
-def transfer_directory(source_container, destination_container, path, refilter):
-    global uploaded
-    global destination_total
+
+class DirectoryState(object):
+    """Tracks the files of one directory which are still in the pipeline.
+
+    Checksums are handed to the destination directory as each file
+    finishes. Remote stores coalesce the resulting manifest writes in the
+    background, so there is no batching here.
+    """
+
+    def __init__(self, destination_dir, path=None):
+        self.destination_dir = destination_dir
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.closed = False
+
+    def add_item(self):
+        with self.lock:
+            self.pending += 1
+
+    def finish_item(self, destination_file=None, checksum=None, size=0):
+        if checksum:
+            self.destination_dir.update_shalist(destination_file.path,
+                                                checksum)
+            self.destination_dir.write_shalist()
+
+        with self.lock:
+            self.pending -= 1
+            done = self.closed and self.pending == 0
+        if done:
+            self._done()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            done = self.pending == 0
+        if done:
+            self._done()
+
+    def _done(self):
+        print ('%s Finished  %s'
+               %(datetime.datetime.now(), self.destination_dir.path))
+
+
+class TransferItem(object):
+    """A single source file moving through the sync pipeline."""
+
+    def __init__(self, source_file, destination_file, state, path=None,
+                 name=None, content_index=None):
+        self.source_file = source_file
+        self.destination_file = destination_file
+        self.state = state
+
+        # Where deduplicated content can be found at the destination
+        self.content_index = content_index
+
+        # Where the file is relative to the root of the sync, for plans
+        self.path = path
+        self.name = name
+
+        # Only set once the file has been uploaded
+        self.checksum = None
+        self.size = 0
+
+        # Only set when planning
+        self.action = None
+
+        # Set once the destination is known to hold the file
+        self.complete = False
+
+
+class TransferGroup(object):
+    """One source file, and a TransferItem for each destination.
+
+    The file is hashed and read once for all of them. pending holds the
+    items which still need the file stored.
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self.pending = items
+
+    def complete(self):
+        for item in self.items:
+            if not item.complete:
+                return False
+        return True
+
+
+def delete_local(source_file):
+    # With several destinations, finish_group() deletes the file once all
+    # of them hold it
+    if ARGS.delete_local and len(ARGS.destination) == 1:
+        print '%s ... cleaning up file' % datetime.datetime.now()
+        os.remove(source_file.get_path())
+
+
+def source_mtime(source_file):
+    # Remote sources only have their size to go on
+    if source_file.region != 'local':
+        return None
+    return os.path.getmtime(source_file.get_path())
+
+
+def repair_manifest(destination_dir, path, destination=0):
+    """Restore checksums and codecs from the journal which the manifest lost.
+
+    An interrupted sync can finish files without their checksums reaching
+    the destination manifest, as manifests are written in the background.
+    destination is the number of the destination in the sync.
+    """
+
+    if destination_dir.region == 'local':
+        return
+
+    repaired = 0
+    codecs = JOURNAL.codecs_in(path, destination)
+    for name, checksum in JOURNAL.checksums_in(path).items():
+        destination_file = destination_dir.get_file(name)
+        codec = codecs.get(name, destination_file.codec())
+        if (destination_file.cache.get('checksum') != checksum or
+            destination_file.codec() != codec):
+            destination_dir.update_shalist(destination_file.path, checksum)
+            destination_file.set_codec(*(codec or (None, None)))
+            repaired += 1
+
+    if repaired:
+        print ('%s Repairing %d checksums in the manifest of %s'
+               %(datetime.datetime.now(), repaired, destination_dir.path))
+        destination_dir.write_shalist()
+
+
+def skip_checksum():
+    return int(os.environ.get('PUSH_NO_CHECKSUM', 0)) == 1
+
+
+def metadata_compare():
+    return ARGS is not None and ARGS.compare == 'metadata'
+
+
+def md5_comparable(source_file, destination_file):
+    # A matching MD5 is only as good as a SHA-512 when the destination has
+    # no checksum of its own in its manifest
+    return ('checksum' not in destination_file.cache and
+            destination_file.md5() is not None)
+
+
+def files_match(source_file, destination_file):
+    """Decide if the destination already holds the source file.
+
+    In metadata mode, sizes and listing MD5s are used first and only
+    ambiguous cases fall through to the SHA-512 comparison.
+    """
+
+    if metadata_compare():
+        if source_file.size() != destination_file.size():
+            print ('%s Size for %s does not match! (%d vs %d)'
+                   %(datetime.datetime.now(), source_file.get_path(),
+                     source_file.size(), destination_file.size()))
+            return False
+
+        if md5_comparable(source_file, destination_file):
+            source_md5 = source_file.md5()
+            if source_md5:
+                if source_md5 != destination_file.md5():
+                    print ('%s MD5 for %s does not match! (%s vs %s)'
+                           %(datetime.datetime.now(), source_file.get_path(),
+                             source_md5, destination_file.md5()))
+                    return False
+                return True
+
+    if destination_file.checksum() != source_file.checksum():
+        print ('%s Checksum for %s does not match! (%s vs %s)'
+               %(datetime.datetime.now(), source_file.get_path(),
+                 source_file.checksum(), destination_file.checksum()))
+        return False
+    return True
+
+
+def walk_directory(source_container, destination_containers, path,
+                   refilter, skipped=None, names=None):
+    """Yield a TransferGroup for every file under path, depth first.
+
+    Each group has an item for each of the destination containers. If
+    given, skipped(path, name, size, reason) is called for each file
+    which is left out. If names is given, only those entries of path are
+    considered, rather than everything in it.
+    """
 
     print '%s Syncing %s' %(datetime.datetime.now(), path)
     source_dir = source_container.get_directory(path)
-    destination_dir = destination_container.get_directory(path)
+    states = [DirectoryState(container.get_directory(path), path)
+              for container in destination_containers]
+
+    if JOURNAL:
+        for destination, state in enumerate(states):
+            repair_manifest(state.destination_dir, path, destination)
 
-    queued_shas = {}
-    for ent in source_dir.listdir():
+    ents = names
+    if ents is None:
+        ents = source_dir.listdir()
+
+    for ent in ents:
         # NOTE(mikal): this is a work around to handle the historial way
         # in which the directory name appears in both the container name and
         # path inside the container for remote stores. It was easier than
@@ -63,165 +279,993 @@ def transfer_directory(source_container, destination_container, path, refilter):
         fullpath = utility.path_join(path, ent)
         source_file = source_dir.get_file(ent)
 
+        # Named entries might have gone since we heard about them
+        if names is not None and not source_file.exists():
+            continue
+
         if source_file.isdir():
-            transfer_directory(source_container, destination_container,
-                               fullpath, refilter)
+            for transfer in walk_directory(source_container,
+                                           destination_containers, fullpath,
+                                           refilter, skipped=skipped):
+                yield transfer
 
         elif source_file.islink():
-            pass
+            if skipped:
+                skipped(path, ent, None, 'link')
 
-        elif source_file.get_path().endswith('.sha512'):
-            pass
-
-        elif source_file.get_path().endswith('.shalist'):
+        elif shalist.is_manifest(source_file.get_path()):
             pass
 
         elif source_file.get_path().endswith('~'):
-            pass
+            if skipped:
+                skipped(path, ent, source_file.size(), 'backup')
 
         else:
-            destination_file = destination_dir.get_file(ent)
             print '%s Consider  %s' %(datetime.datetime.now(),
                                       source_file.get_path())
             m = refilter.match(source_file.get_path())
             if not m:
                 print '%s ... skipping due to filter' % datetime.datetime.now()
+                if skipped:
+                    skipped(path, ent, source_file.size(), 'filter')
                 continue
 
-            if destination_file.exists():
-                if int(os.environ.get('PUSH_NO_CHECKSUM', 0)) == 1:
-                    print '%s ... skipping checksum' % datetime.datetime.now()
-                    if ARGS.delete_local:
-                        print ('%s ... cleaning up file'
-                               % datetime.datetime.now())
-                        os.remove(source_file.get_path())
-                    continue
-
-                if destination_file.checksum() != source_file.checksum():
-                    print ('%s Checksum for %s does not match! (%s vs %s)'
-                           %(datetime.datetime.now(), source_file.get_path(),
-                             source_file.checksum(),
-                             destination_file.checksum()))
-                else:
-                    if ARGS.delete_local:
-                        print ('%s ... cleaning up file'
-                               % datetime.datetime.now())
-                        os.remove(source_file.get_path())
-                    continue
-
-            done = False
-            attempts = 0
-            while not done and attempts < 3:
-                try:
-                    local_file = source_file.get_path()
-                    local_cleanup = False
-                    if not source_file.region == 'local':
-                        print ('%s Fetching the file from remote location'
-                               % datetime.datetime.now())
-                        local_cleanup = True
-                        local_file = source_file.fetch()
-
-                    source_size = source_file.size()
-                    print ('%s Transferring %s (%s)'
-                           %(datetime.datetime.now(), source_file.get_path(),
-                             utility.DisplayFriendlySize(source_size)))
-                    start_time = time.time()
-                    destination_file.store(local_file)
-
-                    queued_shas[source_file.checksum()] = destination_file
-                    print ('%s There are %d queued checksum writes'
-                           %(datetime.datetime.now(), len(queued_shas)))
-
-                    if ARGS.delete_local:
-                        print ('%s ... cleaning up file'
-                               % datetime.datetime.now())
-                        os.remove(source_file.get_path())
-
-                    if len(queued_shas) > 20 or source_size > 1024 * 1024:
-                        print ('%s Clearing queued checksum writes'
-                               % datetime.datetime.now())
-                        for sha in queued_shas:
-                            destination_dir.update_shalist(
-                                queued_shas[sha].path, sha)
-                        destination_dir.write_shalist()
-                        queued_shas = {}
-
-                    if local_cleanup:
-                        os.remove(local_file)
-
-                    print ('%s Uploaded  %s (%s)'
-                           %(datetime.datetime.now(), source_file.get_path(),
-                             utility.DisplayFriendlySize(source_file.size())))
-                    uploaded += source_size
-                    destination_total += source_size
-                    elapsed = time.time() - start_time
-                    print ('%s Total     %s'
-                           %(datetime.datetime.now(),
-                             utility.DisplayFriendlySize(uploaded)))
-                    print ('%s           %s per second'
-                           %(datetime.datetime.now(),
-                             utility.DisplayFriendlySize(int(source_size /
-                                                             elapsed))))
-                    print ('%s Stored    %s'
-                           %(datetime.datetime.now(),
-                             utility.DisplayFriendlySize(destination_total)))
-                    done = True
-
-                except Exception, e:
-                    sys.stderr.write('%s Sync failed for %s (attempt %d): %s'
-                                     %(datetime.datetime.now(),
-                                       source_file.get_path(),
-                                       attempts, e))
-                    attempts += 1
-
-    print '%s Clearing trailing checksum writes' % datetime.datetime.now()
-    for sha in queued_shas:
-        for sha in queued_shas:
-            destination_dir.update_shalist(queued_shas[sha].path, sha)
-        destination_dir.write_shalist()
-    queued_shas = {}
+            # Even in a directory an earlier run finished, files can have
+            # changed or been added since
+            if JOURNAL and JOURNAL.file_finished(
+                    path, ent, source_file.size(), source_mtime(source_file)):
+                print ('%s ... finished by an earlier run'
+                       % datetime.datetime.now())
+                continue
+
+            items = []
+            for container, state in zip(destination_containers, states):
+                state.add_item()
+                items.append(TransferItem(
+                    source_file, state.destination_dir.get_file(ent), state,
+                    path=path, name=ent, content_index=DEDUP.get(container)))
+            yield TransferGroup(items)
+
+    for state in states:
+        state.close()
+
+
+def hash_item(item):
+    """Pipeline stage: checksum the source file ahead of the upload."""
+
+    # New files are hashed while they stream to the destination instead,
+    # so that they are only read once
+    source_file = item.source_file
+    destination_file = item.destination_file
+    if not destination_file.exists():
+        # Looking for a duplicate needs the checksum up front, at the cost
+        # of reading new files which turn out to be unique twice
+        if item.content_index and source_file.region == 'local':
+            source_file.checksum()
+        return item
+    if skip_checksum():
+        return item
+
+    if metadata_compare():
+        if source_file.size() != destination_file.size():
+            return item
+        if md5_comparable(source_file, destination_file):
+            source_file.md5()
+            return item
+
+    source_file.checksum()
+    return item
+
+
+def compare_item(item):
+    """Pipeline stage: drop files which are already current remotely."""
+
+    source_file = item.source_file
+    destination_file = item.destination_file
+    if not destination_file.exists():
+        return item
+
+    if skip_checksum():
+        print ('%s ... skipping checksum for %s'
+               %(datetime.datetime.now(), source_file.get_path()))
+        delete_local(source_file)
+        item.complete = True
+        return None
+
+    if not files_match(source_file, destination_file):
+        return item
+    metrics.add('unchanged_files')
+
+    # If the match was made on metadata, the destination manifest might
+    # still be missing a checksum we happen to know
+    if ('checksum' not in destination_file.cache and
+        'checksum' in source_file.cache):
+        item.checksum = source_file.cache['checksum']
+
+    delete_local(source_file)
+    item.complete = True
+    return None
+
+
+def classify_item(item):
+    """Pipeline stage: decide what a sync would do with a file."""
+
+    source_file = item.source_file
+    destination_file = item.destination_file
+    if not destination_file.exists():
+        item.action = plan.NEW
+    elif skip_checksum() or files_match(source_file, destination_file):
+        item.action = plan.UNCHANGED
+    else:
+        item.action = plan.CHANGED
+    return item
+
+
+def compressing(destination_file, size):
+    return (ARGS is not None and ARGS.compress is not None and
+            destination_file.region != 'local' and
+            size >= compression.MIN_SIZE)
+
+
+def send_stream(stream, destination_file, size):
+    """Store a stream of size bytes, compressing it if that is worthwhile."""
+
+    if not compressing(destination_file, size):
+        destination_file.store_stream(stream, size)
+        return
+
+    # The sample is put back, so it is still sent and hashed once
+    sample = stream.read(compression.SAMPLE_SIZE)
+    stream = compression.PrefixedReader(sample, stream)
+    if not compression.worth_compressing(sample, ARGS.compress):
+        destination_file.store_stream(stream, size)
+        return
+
+    stream = compression.CompressingReader(stream, ARGS.compress)
+    destination_file.store_stream(stream, size, codec=ARGS.compress)
+    metrics.add('compressed_files')
+    metrics.add('compressed_saved_bytes', size - stream.count)
+
+
+def open_source(source_file, size):
+    """Open a source of size bytes, to be read through a HashingReader.
+
+    The reader's size is what the source turned out to be, once opened.
+    """
+
+    if source_file.region == 'local':
+        return streams.HashingReader(source_file.open(), size=size)
+
+    print ('%s Streaming the file from remote location'
+           % datetime.datetime.now())
+    stream = source_file.open()
+
+    # A remote object can turn out to be compressed only once it is opened,
+    # if its manifest lost the codec, and is then the size of its content.
+    # Its checksum comes from its manifest, so anything else is not what
+    # was stored.
+    return streams.HashingReader(stream, size=source_file.size(),
+                                 checksum=source_file.cache.get('checksum'))
+
+
+def sent_checksum(source_file, reader, size):
+    """Check a source was read in full, and return its checksum."""
+
+    if reader.count != size:
+        raise Exception('short read, %d of %d bytes' %(reader.count, size))
+
+    checksum = reader.hexdigest()
+    if 'checksum' in source_file.cache:
+        if source_file.cache['checksum'] != checksum:
+            # Only a local file can really have changed since
+            if source_file.region != 'local':
+                raise Exception('checksum mismatch, sent %s but the '
+                                'manifest has %s'
+                                %(checksum, source_file.cache['checksum']))
+            print ('%s Checksum for %s changed while it was sent!'
+                   %(datetime.datetime.now(), source_file.get_path()))
+
+    if source_file.region == 'local':
+        source_file.update_checksum(checksum)
+    else:
+        source_file.cache['checksum'] = checksum
+    return checksum
+
+
+def stream_file(source_file, destination_file, size):
+    """Copy a file to the destination, hashing it on the way through.
+
+    Remote sources are not staged on local disk, and local ones are only
+    read once. Returns the checksum of the data which was sent, before
+    any compression.
+    """
+
+    reader = open_source(source_file, size)
+    size = reader.size
+    try:
+        send_stream(reader, destination_file, size)
+    finally:
+        reader.close()
+    return sent_checksum(source_file, reader, size)
+
+
+def fan_out_file(source_file, destination_files, size):
+    """Copy a file to several destinations at once, reading it once.
+
+    Each destination is sent the file from its own thread, through a
+    bounded buffer. Returns the checksum of the file and the list of
+    destination files which failed.
+    """
+
+    reader = open_source(source_file, size)
+    size = reader.size
+    tee = streams.Tee(reader, len(destination_files),
+                      buffer=ARGS.fan_out_buffer)
+    failed = []
+
+    def send(index, destination_file):
+        stream = tee.reader(index)
+        try:
+            with SCHEDULER.unlimited():
+                send_stream(stream, destination_file, size)
+        except Exception, e:
+            sys.stderr.write('%s Sync failed for %s to %s in %s: %s\n'
+                             %(datetime.datetime.now(),
+                               source_file.get_path(),
+                               destination_file.get_path(),
+                               destination_file.region, e))
+            failed.append(destination_file)
+        finally:
+            stream.close()
+
+    threads = []
+    for index, destination_file in enumerate(destination_files):
+        t = threading.Thread(target=send, args=(index, destination_file),
+                             name='fan-out-%d' % index)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        workers.join_thread(t)
+    reader.close()
+
+    if len(failed) == len(destination_files):
+        return None, failed
+    return sent_checksum(source_file, reader, size), failed
+
+
+def copy_file(source_file, destination_file):
+    """Have the destination store copy a remote file server side.
+
+    This only happens when both files are in the same provider and the
+    source checksum is already known from its manifest, so nothing needs
+    to be downloaded. Returns False if the file should be streamed instead.
+    """
+
+    if source_file.region == 'local' or destination_file.region == 'local':
+        return False
+    if 'checksum' not in source_file.cache:
+        return False
+    if not destination_file.can_copy_from(source_file):
+        return False
+
+    print ('%s Copying %s server side'
+           %(datetime.datetime.now(), source_file.get_path()))
+    try:
+        destination_file.copy_from(source_file)
+    except Exception, e:
+        print ('%s Server side copy failed, streaming instead (%s)'
+               %(datetime.datetime.now(), e))
+        return False
+    return True
+
+
+def dedup_file(source_file, destination_file, content_index):
+    """Copy identical content already in the destination server side.
+
+    The content index says which object, if any, holds the same data as
+    the source. Returns False if the file should be transferred instead.
+    """
+
+    if not content_index or destination_file.region == 'local':
+        return False
+    if 'checksum' not in source_file.cache:
+        # Hashing a remote source would mean downloading it anyway
+        if source_file.region != 'local':
+            return False
+        source_file.checksum()
+
+    checksum = source_file.cache['checksum']
+    found = content_index.lookup(checksum, destination_file.path)
+    if not found:
+        return False
+
+    path, codec = found
+    existing = destination_file.sibling(path)
+    existing.cache['codec'] = codec
+    if not existing.exists() or existing.size() != source_file.size():
+        content_index.discard(checksum, path)
+        return False
+    if not destination_file.can_copy_from(existing):
+        return False
+
+    print ('%s Copying %s from duplicate %s'
+           %(datetime.datetime.now(), source_file.get_path(), path))
+    try:
+        destination_file.copy_from(existing)
+    except Exception, e:
+        print ('%s Duplicate copy failed, transferring instead (%s)'
+               %(datetime.datetime.now(), e))
+        content_index.discard(checksum, path)
+        return False
+    return True
+
+
+def copy_item(item, source_size):
+    """Store the file without sending it, if the destination can."""
+
+    global destination_total
+
+    source_file = item.source_file
+    destination_file = item.destination_file
+
+    start_time = time.time()
+    if copy_file(source_file, destination_file):
+        copied = 'copy'
+    elif dedup_file(source_file, destination_file, item.content_index):
+        copied = 'dedup'
+    else:
+        return False
+
+    metrics.record(copied, time.time() - start_time, source_size)
+    metrics.add('%s_files' % copied)
+    metrics.add('%s_bytes' % copied, source_size)
+    item.checksum = source_file.checksum()
+    item.size = source_size
+    item.complete = True
+    if source_file.region == 'local':
+        delete_local(source_file)
+    with counter_lock:
+        destination_total += source_size
+    print ('%s Copied    %s (%s)'
+           %(datetime.datetime.now(), source_file.get_path(),
+             utility.DisplayFriendlySize(source_size)))
+    return True
+
+
+def sent_item(item, checksum, source_size, elapsed):
+    """Account for a file which was sent to its destination."""
+
+    global uploaded
+    global destination_total
+
+    # Only the transfer itself counts towards the rate
+    phase = 'upload'
+    if item.destination_file.region == 'local':
+        phase = 'download'
+    elapsed = max(elapsed, 0.001)
+    metrics.record(phase, elapsed, source_size)
+    metrics.add('%s_files' % phase)
+    metrics.add('%s_bytes' % phase, source_size)
+    item.checksum = checksum
+    item.size = source_size
+    item.complete = True
+
+    print ('%s Uploaded  %s (%s)'
+           %(datetime.datetime.now(), item.source_file.get_path(),
+             utility.DisplayFriendlySize(source_size)))
+    with counter_lock:
+        uploaded += source_size
+        destination_total += source_size
+        total = uploaded
+        stored = destination_total
+    print ('%s Total     %s'
+           %(datetime.datetime.now(),
+             utility.DisplayFriendlySize(total)))
+    print ('%s           %s per second'
+           %(datetime.datetime.now(),
+             utility.DisplayFriendlySize(int(source_size / elapsed))))
+    print ('%s Stored    %s'
+           %(datetime.datetime.now(),
+             utility.DisplayFriendlySize(stored)))
+
+
+def upload_item(item, copy=True):
+    """Pipeline stage: store the source file at the destination.
+
+    The file is copied server side if the destination can, unless copy
+    is False because that was already tried.
+    """
+
+    source_file = item.source_file
+    destination_file = item.destination_file
+
+    attempts = 0
+    while attempts < 3:
+        try:
+            source_size = source_file.size()
+            print ('%s Transferring %s (%s)'
+                   %(datetime.datetime.now(), source_file.get_path(),
+                     utility.DisplayFriendlySize(source_size)))
+            if copy and copy_item(item, source_size):
+                return item
+
+            start_time = time.time()
+            checksum = stream_file(source_file, destination_file,
+                                   source_size)
+            sent_item(item, checksum, source_size, time.time() - start_time)
+            delete_local(source_file)
+            return item
+
+        except Exception, e:
+            sys.stderr.write('%s Sync failed for %s (attempt %d): %s\n'
+                             %(datetime.datetime.now(),
+                               source_file.get_path(), attempts, e))
+            attempts += 1
+
+            # The file might have changed underneath us
+            if source_file.region == 'local':
+                source_file.cache.pop('size', None)
+
+    return None
+
+
+def upload_group(group):
+    """Pipeline stage: store the source file at every destination.
+
+    Destinations which can copy the file server side do that. The rest
+    are sent the file together, and any which fail that get their own
+    attempts afterwards.
+    """
+
+    items = group.pending
+    copied = False
+    if len(items) > 1:
+        source_file = items[0].source_file
+        try:
+            source_size = source_file.size()
+            print ('%s Transferring %s (%s) to %d destinations'
+                   %(datetime.datetime.now(), source_file.get_path(),
+                     utility.DisplayFriendlySize(source_size), len(items)))
+            items = [item for item in items
+                     if not copy_item(item, source_size)]
+            copied = True
+
+            if len(items) > 1:
+                start_time = time.time()
+                checksum, failed = fan_out_file(
+                    source_file, [item.destination_file for item in items],
+                    source_size)
+                elapsed = time.time() - start_time
+                for item in items:
+                    if checksum and item.destination_file not in failed:
+                        sent_item(item, checksum, source_size, elapsed)
+                items = [item for item in items if not item.complete]
+        except Exception, e:
+            sys.stderr.write('%s Sync failed for %s: %s\n'
+                             %(datetime.datetime.now(),
+                               source_file.get_path(), e))
+            items = [item for item in items if not item.complete]
+
+    # Whatever is left is sent to on its own
+    for item in items:
+        upload_item(item, copy=not copied)
+    return group
+
+
+def settle_item(item):
+    if item.content_index and item.complete:
+        item.content_index.add(item.checksum, item.destination_file.path,
+                               item.destination_file.codec())
+    item.state.finish_item(item.destination_file, item.checksum, item.size)
+
+
+def journal_file(items, checksum):
+    # Every destination of a file gets the same checksum, but each remote
+    # one can have stored it compressed or not
+    codecs = [None if i.destination_file.region == 'local'
+              else i.destination_file.codec() for i in items]
+    item = items[0]
+    JOURNAL.file_done(item.path, item.name, item.size or
+                      item.source_file.size(),
+                      source_mtime(item.source_file), checksum, codecs)
+
+
+def finish_item(item):
+    if JOURNAL and item.complete:
+        journal_file([item], item.checksum)
+    settle_item(item)
+
+
+def finish_group(group):
+    # The journal only records files which every destination holds
+    if group.complete():
+        checksums = [item.checksum for item in group.items if item.checksum]
+        if JOURNAL:
+            journal_file(group.items, checksums and checksums[0] or None)
+        source_file = group.items[0].source_file
+        if (ARGS.delete_local and len(group.items) > 1 and
+            source_file.region == 'local'):
+            print '%s ... cleaning up file' % datetime.datetime.now()
+            os.remove(source_file.get_path())
+
+    for item in group.items:
+        settle_item(item)
+
+
+def hash_group(group):
+    """Pipeline stage: checksum the source file ahead of the uploads."""
+
+    # The source file is shared, so it is hashed at most once
+    for item in group.items:
+        hash_item(item)
+    return group
+
+
+def compare_group(group):
+    """Pipeline stage: drop destinations which already hold the file."""
+
+    group.pending = [item for item in group.items
+                     if compare_item(item) is not None]
+    if not group.pending:
+        return None
+    return group
+
+
+def classify_group(group):
+    for item in group.items:
+        classify_item(item)
+    return group
+
+
+def transfer_directory(source_container, destination_containers, path,
+                       refilter, jobs=1, hash_jobs=1, queue_size=100,
+                       names=None):
+    """Sync path from the source container to the destination containers.
+
+    Listing, hashing, comparing and uploading run as separate pipeline
+    stages, so hashing one file overlaps with uploading another. Each file
+    is hashed and read once however many destinations there are. If names
+    is given, only those entries of path are synced.
+    """
+
+    p = pipeline.Pipeline(done=finish_group)
+    p.add_stage(hash_group, hash_jobs, queue_size=queue_size)
+    p.add_stage(compare_group, max(jobs, 2), queue_size=queue_size)
+    p.add_stage(upload_group, jobs, queue_size=queue_size)
+
+    for transfer in walk_directory(source_container, destination_containers,
+                                   path, refilter, names=names):
+        p.put(transfer)
+    p.join()
+
+
+def watch_directory(source_container, destination_containers, refilter,
+                    jobs=1, hash_jobs=1, queue_size=100, delay=watch.DELAY,
+                    rescan=watch.RESCAN):
+    """Sync everything, and then keep syncing whatever changes."""
+
+    global JOURNAL
+
+    # Watching starts first, so that nothing changed during the first
+    # sync is missed
+    watcher = watch.Watcher(source_container.path, delay)
+    try:
+        transfer_directory(source_container, destination_containers, None,
+                           refilter, jobs=jobs, hash_jobs=hash_jobs,
+                           queue_size=queue_size)
+        scanned = time.time()
+
+        # The journal only covers the first sync. Afterwards it would
+        # have us skip directories which have changed since.
+        if JOURNAL:
+            JOURNAL.close()
+            JOURNAL = None
+
+        while True:
+            watcher.poll(min(delay, 1))
+            full, changes = watcher.ready()
+
+            if full or time.time() - scanned > rescan:
+                print ('%s Rescanning everything%s'
+                       %(datetime.datetime.now(),
+                         full and ', events were lost' or ''))
+                transfer_directory(source_container, destination_containers,
+                                   None, refilter, jobs=jobs,
+                                   hash_jobs=hash_jobs, queue_size=queue_size)
+                scanned = time.time()
+                continue
+
+            for path in sorted(changes, key=lambda p: p or ''):
+                transfer_directory(source_container, destination_containers,
+                                   path, refilter, jobs=jobs,
+                                   hash_jobs=hash_jobs, queue_size=queue_size,
+                                   names=sorted(changes[path]))
+    finally:
+        watcher.close()
+
+
+def plan_directory(source_container, destination_container, path, refilter,
+                   sync_plan, jobs=1, hash_jobs=1, queue_size=100):
+    """Work out what syncing path would do, without transferring anything."""
+
+    def skipped(path, name, size, reason):
+        sync_plan.add(plan.SKIPPED, path, name, size, reason=reason)
+
+    def done(group):
+        for item in group.items:
+            if item.action:
+                sync_plan.add(item.action, item.path, item.name,
+                              item.source_file.size())
+            item.state.finish_item()
+
+    p = pipeline.Pipeline(done=done)
+    p.add_stage(hash_group, hash_jobs, queue_size=queue_size)
+    p.add_stage(classify_group, max(jobs, 2), queue_size=queue_size)
+
+    for transfer in walk_directory(source_container, [destination_container],
+                                   path, refilter, skipped=skipped):
+        p.put(transfer)
+    p.join()
+
+
+def execute_plan(source_container, destination_container, sync_plan,
+                 jobs=1, queue_size=100, order='path'):
+    """Transfer the new and changed files of a plan.
+
+    The comparisons were made when the plan was, so files go straight to
+    the upload stage. Checksums are still taken from the data as it is
+    sent, so manifests stay correct if a file changed in the meantime.
+    """
+
+    entries = sync_plan.transfers(order)
+    progress = plan.Progress(len(entries),
+                             sum([e['size'] or 0 for e in entries]))
+
+    def done(item):
+        finish_item(item)
+        progress.update(item.size)
+
+    p = pipeline.Pipeline(done=done)
+    p.add_stage(upload_item, jobs, queue_size=queue_size)
+
+    # path -> (source directory, state of the destination directory)
+    directories = {}
+    for entry in entries:
+        path = entry['path']
+        if path not in directories:
+            directories[path] = (
+                source_container.get_directory(path),
+                DirectoryState(destination_container.get_directory(path)))
+        source_dir, state = directories[path]
+
+        state.add_item()
+        p.put(TransferItem(source_dir.get_file(entry['name']),
+                           state.destination_dir.get_file(entry['name']),
+                           state, path=path, name=entry['name'],
+                           content_index=DEDUP.get(destination_container)))
+
+    for source_dir, state in directories.values():
+        state.close()
+    p.join()
 
 
 REMOTE_RE = re.compile('[a-z]+://')
 LIBCLOUD_RE = re.compile('[a-z0-9]+@[a-z_]+://')
 
 
-def get_container(url):
+def remote_options():
+    if not ARGS:
+        return {}
+    return {'segment_threshold': ARGS.segment_threshold * 1024 * 1024,
+            'segment_size': ARGS.segment_size * 1024 * 1024,
+            'segment_jobs': ARGS.segment_jobs,
+            'fetch_threshold': ARGS.fetch_threshold * 1024 * 1024,
+            'fetch_chunk_size': ARGS.fetch_chunk_size * 1024 * 1024,
+            'fetch_jobs': ARGS.fetch_jobs,
+            'manifest_interval': ARGS.manifest_interval,
+            'manifest_batch': ARGS.manifest_batch,
+            'read_only': planning(),
+            'transfer_scheduler': SCHEDULER,
+            'listing_jobs': ARGS.listing_jobs,
+            'manifest_options': {
+                'sharded': ARGS.shalist_format == 'sharded',
+                'compress': ARGS.shalist_compress,
+                'shard_entries': ARGS.shalist_shard_entries}}
+
+
+def destination_url():
+    # Several destinations are named together in plans and journals
+    return ' '.join(ARGS.destination)
+
+
+def planning():
+    return ARGS is not None and (ARGS.dry_run or ARGS.plan_out is not None)
+
+
+def get_container(url, index=None):
     remote_match = REMOTE_RE.match(url)
     libcloud_match = LIBCLOUD_RE.match(url)
 
     if url.startswith('file://'):
-        return local.LocalContainer(url)
+        return local.LocalContainer(url, checksum_index=index)
     elif remote_match and has_pyrax:
-        return remote_pyrax.RemoteContainer(url)
+        return remote_pyrax.RemoteContainer(url, **remote_options())
     elif libcloud_match and has_libcloud:
-        return remote_libcloud.RemoteContainer(url)
+        return remote_libcloud.RemoteContainer(url, **remote_options())
     else:
         print 'Unknown container URL format'
         sys.exit(1)
 
 
-if __name__ == '__main__':
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--delete-local', default=False,
                         action='store_true',
                         help='Should we delete local files?')
     parser.add_argument('-f', '--filter', default='.*',
                         help='Optional regexp filter')
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help='Number of files to upload in parallel')
+    parser.add_argument('--hash-jobs', default=hashing.JOBS, type=int,
+                        help='Number of files to checksum in parallel, by '
+                             'default one per CPU')
+    parser.add_argument('--listing-jobs', default=listing.JOBS, type=int,
+                        help='Number of slices of a remote container to '
+                             'list in parallel')
+    parser.add_argument('--queue-size', default=100, type=int,
+                        help='Files buffered between sync stages')
+    parser.add_argument('--segment-threshold', type=int,
+                        default=transfers.SEGMENT_THRESHOLD / 1024 / 1024,
+                        help='Upload files larger than this many mb in '
+                             'segments')
+    parser.add_argument('--segment-size', type=int,
+                        default=transfers.SEGMENT_SIZE / 1024 / 1024,
+                        help='Size of upload segments in mb')
+    parser.add_argument('--segment-jobs', type=int,
+                        default=transfers.SEGMENT_JOBS,
+                        help='Number of segments of a file to upload in '
+                             'parallel')
+    parser.add_argument('--fetch-threshold', type=int,
+                        default=transfers.FETCH_THRESHOLD / 1024 / 1024,
+                        help='Download files larger than this many mb as '
+                             'parallel byte ranges')
+    parser.add_argument('--fetch-chunk-size', type=int,
+                        default=transfers.FETCH_CHUNK_SIZE / 1024 / 1024,
+                        help='Size of download byte ranges in mb')
+    parser.add_argument('--fetch-jobs', type=int,
+                        default=transfers.FETCH_JOBS,
+                        help='Number of byte ranges of a file to download in '
+                             'parallel')
+    parser.add_argument('--compare', default='checksum',
+                        choices=['checksum', 'metadata'],
+                        help='How to decide if an existing remote file is '
+                             'current. metadata compares sizes and MD5 '
+                             'ETags first, and only falls back to SHA-512 '
+                             'checksums when those are inconclusive')
+    parser.add_argument('--shalist-format', default='legacy',
+                        choices=['legacy', 'sharded'],
+                        help='Format for checksum manifests written to the '
+                             'destination. Both formats are always readable')
+    parser.add_argument('--shalist-compress', default=False,
+                        action='store_true',
+                        help='gzip sharded checksum manifests')
+    parser.add_argument('--shalist-shard-entries', type=int,
+                        default=shalist.SHARD_ENTRIES,
+                        help='Target number of entries per manifest shard')
+    parser.add_argument('--manifest-interval', type=int,
+                        default=manifest_writer.INTERVAL,
+                        help='Seconds between background checksum manifest '
+                             'writes')
+    parser.add_argument('--manifest-batch', type=int,
+                        default=manifest_writer.BATCH_SIZE,
+                        help='Write checksum manifests early once this many '
+                             'updates are pending')
+    parser.add_argument('--checksum-index',
+                        default=checksum_index.DEFAULT_PATH,
+                        help='Where to cache checksums of local files')
+    parser.add_argument('--no-checksum-index', default=False,
+                        action='store_true',
+                        help='Do not cache checksums of local files')
+    parser.add_argument('--mmap', default=False, action='store_true',
+                        help='Memory map large files to checksum them '
+                             'instead of reading them. A file which shrinks '
+                             'while it is hashed kills the sync.')
+    parser.add_argument('--reverify', default=False, action='store_true',
+                        help='Rehash every local file, ignoring the cache')
+    parser.add_argument('--bwlimit', default=None,
+                        help='Bandwidth limit in mb/s for each of uploads '
+                             'and downloads. Can vary by time of day, for '
+                             'example "08:00-18:00=2,20" allows 2 mb/s in '
+                             'business hours and 20 at other times')
+    parser.add_argument('--max-requests', default=0, type=int,
+                        help='Adapt the number of requests in flight to '
+                             'how the provider is coping, up to this many')
+    parser.add_argument('--metrics-file', default=None,
+                        help='Write timings and API call counts to this '
+                             'file during and after the sync')
+    parser.add_argument('--metrics-format', default='json',
+                        choices=['json', 'prometheus'],
+                        help='Format of the metrics file. prometheus suits '
+                             'the node exporter textfile collector')
+    parser.add_argument('--metrics-interval', type=int,
+                        default=metrics.INTERVAL,
+                        help='Seconds between metrics file updates')
+    parser.add_argument('--dry-run', default=False, action='store_true',
+                        help='Only print what would be transferred')
+    parser.add_argument('--plan-out', default=None,
+                        help='Save what would be transferred to this file '
+                             'instead of transferring it')
+    parser.add_argument('--plan', default=None,
+                        help='Transfer the files listed in a saved plan')
+    parser.add_argument('--plan-order', default='path',
+                        choices=['path', 'largest'],
+                        help='Order in which to transfer the files of a '
+                             'saved plan')
+    parser.add_argument('--journal', default=None,
+                        help='Record progress in this file, so that an '
+                             'interrupted sync can be resumed')
+    parser.add_argument('--resume', default=False, action='store_true',
+                        help='Skip work the journal says is finished, and '
+                             'repair manifests from it')
+    parser.add_argument('--compress', default=None,
+                        choices=compression.CODECS,
+                        help='Compress files on upload, if a sample of the '
+                             'start of the file compresses well')
+    parser.add_argument('--dedup', default=False, action='store_true',
+                        help='Copy files whose content is already stored '
+                             'elsewhere in the destination server side, '
+                             'instead of uploading them again')
+    parser.add_argument('--watch', default=False, action='store_true',
+                        help='Keep running after the sync, and sync local '
+                             'changes as inotify reports them')
+    parser.add_argument('--watch-delay', type=float, default=watch.DELAY,
+                        help='Seconds a changed file must be left alone '
+                             'before it is synced')
+    parser.add_argument('--watch-rescan', type=int, default=watch.RESCAN,
+                        help='Seconds between full scans while watching, in '
+                             'case a change was missed')
+    parser.add_argument('--fan-out-buffer', type=int,
+                        default=streams.TEE_BUFFER,
+                        help='With several destinations, how many mb a '
+                             'slow destination may fall behind the others')
     parser.add_argument('source')
-    parser.add_argument('destination')
-    ARGS = parser.parse_args()
+    parser.add_argument('destination', nargs='+',
+                        help='Containers to sync to, each file is read '
+                             'once for all of them')
+    args = parser.parse_args(argv)
+    if args.resume and not args.journal:
+        parser.error('--resume needs a --journal to resume from')
+    if len(args.destination) > 1 and (args.dry_run or args.plan_out or
+                                      args.plan):
+        parser.error('plans are for a single destination')
+    if args.watch:
+        if not args.source.startswith('file://'):
+            parser.error('--watch needs a local source')
+        if args.dry_run or args.plan_out or args.plan:
+            parser.error('--watch can not be used with plans')
+        if not watch.available():
+            parser.error('--watch needs Linux inotify')
+    if args.compress and not compression.available(args.compress):
+        parser.error('--compress %s needs the zstandard module'
+                     % args.compress)
+    return args
 
-    print '%s Running with "%s"' %(datetime.datetime.now(), ' '.join(sys.argv))
 
-    source_container = get_container(ARGS.source)
-    destination_container = get_container(ARGS.destination)
+def sync(args):
+    """Run one sync as configured by parse_args()."""
+
+    global ARGS
+    global SCHEDULER
+    global JOURNAL
+    global DEDUP
+    ARGS = args
+    SCHEDULER = scheduler.Scheduler(ARGS.bwlimit, ARGS.max_requests)
+    hashing.use_mmap = ARGS.mmap
+
+    exporter = None
+    if ARGS.metrics_file:
+        exporter = metrics.Exporter(metrics.METRICS, ARGS.metrics_file,
+                                    ARGS.metrics_format,
+                                    ARGS.metrics_interval)
+
+    index = None
+    if not ARGS.no_checksum_index:
+        index = checksum_index.ChecksumIndex(ARGS.checksum_index,
+                                             reverify=ARGS.reverify)
+
+    source_container = get_container(ARGS.source, index=index)
+    destination_containers = [get_container(url, index=index)
+                              for url in ARGS.destination]
+    if ARGS.watch:
+        destination_containers = [watch.CachedContainer(container)
+                                  for container in destination_containers]
+    destination_container = destination_containers[0]
     refilter = ARGS.filter
 
-    transfer_directory(source_container, destination_container, None,
-                       re.compile(refilter))
+    # Duplicates are only looked for among what each destination already
+    # held when we started, and what this sync stores there
+    DEDUP = {}
+    if ARGS.dedup and not planning():
+        for container in destination_containers:
+            if container.region != 'local':
+                DEDUP[container] = dedup.ContentIndex()
+                DEDUP[container].build(container, jobs=max(ARGS.jobs, 4))
+
+    if planning():
+        sync_plan = plan.Plan(ARGS.source, destination_url())
+        plan_directory(source_container, destination_container, None,
+                       re.compile(refilter), sync_plan, jobs=ARGS.jobs,
+                       hash_jobs=ARGS.hash_jobs, queue_size=ARGS.queue_size)
+        if ARGS.dry_run:
+            sync_plan.dump()
+        else:
+            sync_plan.summary()
+        if ARGS.plan_out:
+            sync_plan.write(ARGS.plan_out)
+
+    elif ARGS.plan:
+        sync_plan = plan.Plan.read(ARGS.plan)
+        if (sync_plan.source != ARGS.source or
+            sync_plan.destination != destination_url()):
+            print ('%s Plan %s is for %s to %s'
+                   %(datetime.datetime.now(), ARGS.plan, sync_plan.source,
+                     sync_plan.destination))
+            sys.exit(1)
+        sync_plan.summary()
+        execute_plan(source_container, destination_container, sync_plan,
+                     jobs=ARGS.jobs, queue_size=ARGS.queue_size,
+                     order=ARGS.plan_order)
+
+    else:
+        if ARGS.journal:
+            try:
+                JOURNAL = journal.Journal(ARGS.journal, ARGS.source,
+                                          destination_url(),
+                                          resume=ARGS.resume)
+            except ValueError, e:
+                print '%s %s' %(datetime.datetime.now(), e)
+                sys.exit(1)
+
+        if ARGS.watch:
+            watch_directory(source_container, destination_containers,
+                            re.compile(refilter), jobs=ARGS.jobs,
+                            hash_jobs=ARGS.hash_jobs,
+                            queue_size=ARGS.queue_size,
+                            delay=ARGS.watch_delay,
+                            rescan=ARGS.watch_rescan)
+        else:
+            transfer_directory(source_container, destination_containers,
+                               None, re.compile(refilter), jobs=ARGS.jobs,
+                               hash_jobs=ARGS.hash_jobs,
+                               queue_size=ARGS.queue_size)
+    source_container.close()
+    for container in destination_containers:
+        container.close()
+
+    if index:
+        index.close()
+
+    if JOURNAL:
+        JOURNAL.close()
+        JOURNAL = None
+    DEDUP = {}
+
+    metrics.METRICS.summary()
+    if exporter:
+        exporter.close()
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+
+    print '%s Running with "%s"' %(datetime.datetime.now(), ' '.join(sys.argv))
+
+    # Make sure pending manifest writes are flushed if we are killed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+    sync(ARGS)
 
     print '%s Finished' % datetime.datetime.now()
     print '%s Total     %s' %(datetime.datetime.now(),
                               utility.DisplayFriendlySize(uploaded))
-
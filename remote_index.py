@@ -0,0 +1,129 @@
+# An in-memory index of the objects in a remote container
+
+
+import datetime
+import os
+import threading
+
+import shalist
+
+
+class ObjectInfo(object):
+    __slots__ = ('size', 'hash', 'last_modified')
+
+    def __init__(self, size=None, hash=None, last_modified=None):
+        self.size = size
+        self.hash = hash
+        self.last_modified = last_modified
+
+
+class ContainerIndex(object):
+    """Every object in a container, arranged as a directory tree.
+
+    Remote object names flatten paths with '~', the index works with the
+    '/' separated paths the rest of the code uses. It is built from one
+    listing of the container and then kept up to date as objects are
+    stored, so directories and files can be queried without further API
+    calls.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = {}
+
+        # Directory path -> list of paths of the files directly inside it
+        self.directories = {}
+
+        # Directory path -> names of the directories inside it which hold a
+        # checksum manifest somewhere below them
+        self.children = {}
+
+        # Directory path -> names of the manifest objects inside it
+        self.manifests = {}
+
+    def add(self, name, size=None, hash=None, last_modified=None):
+        path = name.replace('~', '/')
+        with self.lock:
+            parent = os.path.dirname(path)
+            if shalist.is_manifest(path):
+                self.manifests.setdefault(parent, set()).add(
+                    os.path.basename(path))
+                self._add_directory(parent, manifest=True)
+                return
+
+            if path not in self.objects:
+                self._add_directory(parent)
+                self.directories[parent].append(path)
+            self.objects[path] = ObjectInfo(size, hash, last_modified)
+
+    def _add_directory(self, path, manifest=False):
+        while True:
+            known = path in self.directories
+            if not known:
+                self.directories[path] = []
+            if not path:
+                return
+
+            parent = os.path.dirname(path)
+            if manifest:
+                children = self.children.setdefault(parent, set())
+                name = os.path.basename(path)
+                if name in children:
+                    return
+                children.add(name)
+            elif known:
+                return
+            path = parent
+
+    def load(self, listing):
+        """Add (name, size, hash, last_modified) tuples from a listing."""
+
+        count = 0
+        for name, size, hash, last_modified in listing:
+            self.add(name, size, hash, last_modified)
+            count += 1
+            if count % 100000 == 0:
+                print ('%s ... indexed %d objects'
+                       %(datetime.datetime.now(), count))
+        return count
+
+    def exists(self, path):
+        return path in self.objects
+
+    def get(self, path):
+        return self.objects.get(path)
+
+    def isdir(self, path):
+        return path in self.directories
+
+    def remove(self, name):
+        path = name.replace('~', '/')
+        with self.lock:
+            parent = os.path.dirname(path)
+            if shalist.is_manifest(path):
+                self.manifests.get(parent, set()).discard(
+                    os.path.basename(path))
+            elif path in self.objects:
+                del self.objects[path]
+                self.directories[parent].remove(path)
+
+    def manifests_in(self, path):
+        """Names of the manifest objects in directory path."""
+        with self.lock:
+            return list(self.manifests.get(path, []))
+
+    def manifest_directories(self):
+        """Paths of every directory which holds a manifest."""
+        with self.lock:
+            return [path for path, names in self.manifests.items() if names]
+
+    def files(self, path):
+        """Paths of the files directly inside directory path."""
+        with self.lock:
+            return list(self.directories.get(path, []))
+
+    def subdirs(self, path):
+        """Names of the directories below path which hold manifests."""
+
+        with self.lock:
+            return list(self.children.get(path, []))
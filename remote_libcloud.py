@@ -1,27 +1,81 @@
 # Methods to handle remote files via libcloud
 
-import contextlib
+import atexit
+import base64
 import datetime
 import hashlib
+import httplib
 import json
 import os
 import sys
 import tempfile
+import threading
+import time
+import urllib
 import urllib2
 
 import libcloud
+from libcloud.storage.base import Object
 from libcloud.storage.types import Provider
 from libcloud.storage.providers import get_driver
-
+from libcloud.utils.xml import findtext, fixxpath
+
+import compression
+import connections
+import hashing
+import listing
+import manifest_writer
+import metrics
+import remote_index
+import scheduler
+import shalist
+import streams
+import transfers
 import utility
 
 
+CONFIG_PATH = '~/.cloudfiles'
+
+# Driver methods which make API calls, counted per connection
+API_METHODS = ['get_container', 'create_container',
+               'iterate_container_objects', 'get_object', 'upload_object',
+               'upload_object_via_stream', 'download_object',
+               'download_object_as_stream', 'delete_object',
+               '_initiate_multipart', '_commit_multipart',
+               '_abort_multipart']
+
+# Extra driver classes by provider name, such as the stand-in object store
+# which benchmark.py registers
+DRIVERS = {}
+
+# Providers listed a page at a time with raw requests, which lets listings
+# be split by delimiter and run in parallel. Other drivers can only be
+# iterated through.
+PAGED_PROVIDERS = set(['cloudfiles', 's3'])
+
+
 def remote_filename(filename):
     return filename.replace('/', '~')
 
 
+def container_name_for(provider_name, region, name):
+    if provider_name == 's3':
+        # s3 container names must be valid DNS names
+        return ('%s.%s' %(region, name)).replace('/', '.')
+    elif region == 'dfw':
+        return remote_filename(name)
+    return remote_filename('%s/%s' %(region, name))
+
+
+def load_config():
+    with open(os.path.expanduser(CONFIG_PATH), 'r') as f:
+        return json.loads(f.read())
+
+
 def get_driver_helper(provider_name):
-    if provider_name == 'cloudfiles':
+    if provider_name in DRIVERS:
+        return DRIVERS[provider_name]
+    elif provider_name == 'cloudfiles':
         return get_driver(Provider.CLOUDFILES_US)
     elif provider_name == 's3':
         return get_driver(Provider.S3)
@@ -30,60 +84,107 @@ def get_driver_helper(provider_name):
         sys.exit(1)
 
 
-@contextlib.contextmanager
-def data_in_file(d):
-    try:
-        (local_fd, local_file) = tempfile.mkstemp()
-        os.write(local_fd, d)
-        os.close(local_fd)
-        yield local_file
-    finally:
-        os.remove(local_file)
-
-
 class RemoteContainer(object):
-    def __init__(self, name):
+    def __init__(self, name, segment_threshold=transfers.SEGMENT_THRESHOLD,
+                 segment_size=transfers.SEGMENT_SIZE,
+                 segment_jobs=transfers.SEGMENT_JOBS,
+                 fetch_threshold=transfers.FETCH_THRESHOLD,
+                 fetch_chunk_size=transfers.FETCH_CHUNK_SIZE,
+                 fetch_jobs=transfers.FETCH_JOBS, manifest_options=None,
+                 manifest_interval=manifest_writer.INTERVAL,
+                 manifest_batch=manifest_writer.BATCH_SIZE,
+                 read_only=False, transfer_scheduler=scheduler.UNLIMITED,
+                 listing_jobs=listing.JOBS):
         self.provider_name, filename = name.split('@')
         self.region, name = filename.split('://')
         self.basename = os.path.basename(name)
         self.provider = get_driver_helper(self.provider_name)
+        self.segment_threshold = segment_threshold
+        self.segment_size = segment_size
+        self.segment_jobs = segment_jobs
+        self.fetch_threshold = fetch_threshold
+        self.fetch_chunk_size = fetch_chunk_size
+        self.fetch_jobs = fetch_jobs
+        self.manifest_options = manifest_options or {}
+        self.read_only = read_only
+        self.scheduler = transfer_scheduler
+        self.listing_jobs = listing_jobs
+
+        # Manifests are written in the background, and must be flushed
+        # however we exit
+        self.manifest_writer = manifest_writer.ManifestWriter(
+            manifest_interval, manifest_batch)
+        atexit.register(self.close)
+
+        self.conf = load_config()
+        self.storage_class = self.conf[self.provider_name].get(
+            'storage_class', 'standard')
+
+        # libcloud connections are not thread safe, so each thread which
+        # touches this container gets its own, from a pool which outlives
+        # the threads
+        self.connections = connections.Pool()
+
+        self.index = None
+        self.index_lock = threading.Lock()
+
+        self.container_name = container_name_for(self.provider_name,
+                                                 self.region, name)
+
+        # Force container creation. A sync which is only being planned
+        # creates nothing, and treats a missing container as empty.
+        self.missing = False
+        try:
+            self.get_container()
+        except libcloud.storage.types.ContainerDoesNotExistError:
+            self.missing = True
 
-        with open(os.path.expanduser('~/.cloudfiles'), 'r') as f:
-            self.conf = json.loads(f.read())
-            self.conn = self.provider(
-                self.conf[self.provider_name]['access_key'],
-                self.conf[self.provider_name]['secret_key'],
-                ex_force_service_region=self.region)
-            self.storage_class = self.conf[self.provider_name].get(
-                'storage_class', 'standard')
-
-        if self.provider_name == 's3':
-            # s3 container names must be valid DNS names
-            self.container_name = \
-                ('%s.%s' %(self.region, name)).replace('/', '.')
-        elif self.region == 'dfw':
-            self.container_name = remote_filename(name)
-        else:
-            self.container_name = remote_filename('%s/%s' %(self.region, name))
-
-        # Force container creation
-        self.get_container()
+    def close(self):
+        self.manifest_writer.close()
 
     def get_directory(self, path):
         return RemoteDirectory(self, utility.path_join(self.basename, path))
 
     # Helper methods for this driver (not part of the base interface)
     def get_connection(self):
-        return self.conn
+        slot = self.connections.get()
+        if not hasattr(slot, 'conn'):
+            slot.conn = metrics.instrument(
+                self.provider(self.conf[self.provider_name]['access_key'],
+                              self.conf[self.provider_name]['secret_key'],
+                              ex_force_service_region=self.region),
+                'libcloud', API_METHODS)
+        return slot.conn
 
     def get_name(self):
         return self.container_name
 
     def get_container(self):
-        try:
-            return self.conn.get_container(self.container_name)
-        except libcloud.storage.types.ContainerDoesNotExistError:
-            return self.conn.create_container(self.container_name)
+        # The container handle is bound to its connection, so it is cached
+        # alongside it
+        slot = self.connections.get()
+        if not hasattr(slot, 'container'):
+            conn = self.get_connection()
+            try:
+                slot.container = conn.get_container(self.container_name)
+            except libcloud.storage.types.ContainerDoesNotExistError:
+                if self.read_only:
+                    raise
+                slot.container = conn.create_container(self.container_name)
+        return slot.container
+
+    def get_segment_container(self):
+        # Cloud Files large object segments live in their own container, so
+        # they don't show up in listings of this one
+        slot = self.connections.get()
+        if not hasattr(slot, 'segment_container'):
+            conn = self.get_connection()
+            name = '%s_segments' % self.container_name
+            try:
+                slot.segment_container = conn.get_container(name)
+            except libcloud.storage.types.ContainerDoesNotExistError:
+                slot.segment_container = conn.create_container(name)
+        return slot.segment_container
 
     def get_class(self):
         return self.storage_class
@@ -91,6 +192,94 @@ class RemoteContainer(object):
     def get_provider(self):
         return self.provider_name
 
+    def get_index(self):
+        with self.index_lock:
+            if not self.index:
+                index = remote_index.ContainerIndex()
+                if self.missing:
+                    self.index = index
+                    return self.index
+
+                print ('%s Finding existing remote files'
+                       % datetime.datetime.now())
+                with metrics.timer('listing'):
+                    count = index.load(self.list_objects(
+                        remote_filename(self.basename)))
+                print ('%s Found %d existing objects in %s'
+                       %(datetime.datetime.now(), count, self.region))
+                self.index = index
+        return self.index
+
+    def list_objects(self, prefix):
+        if self.provider_name in PAGED_PROVIDERS:
+            return listing.list_objects(self.list_page, prefix,
+                                        self.listing_jobs)
+        return self.iterate_objects(prefix)
+
+    def iterate_objects(self, prefix):
+        # Other drivers can only be listed from start to finish
+        for obj in self.get_connection().iterate_container_objects(
+            self.get_container(), ex_prefix=prefix):
+            yield (obj.name, obj.size, obj.hash,
+                   obj.extra.get('last_modified'))
+
+    def list_page(self, prefix, marker=None, delimiter=None):
+        """One listing request, returning (objects, subdirs, marker).
+
+        libcloud can't list by delimiter, so the request is made here.
+        The marker to continue from is None after the last page.
+        """
+
+        conn = self.get_connection()
+        container = self.get_container()
+        params = {'prefix': prefix}
+        if marker:
+            params['marker'] = marker
+        if delimiter:
+            params['delimiter'] = delimiter
+
+        metrics.count_call('libcloud', 'list_page')
+        if self.provider_name == 's3':
+            params['max-keys'] = listing.PAGE_SIZE
+            response = conn.connection.request(
+                conn._get_container_path(container), params=params)
+            if response.status != httplib.OK:
+                raise Exception('listing returned %d' % response.status)
+
+            body = response.object
+            objects = [(obj.name, obj.size, obj.hash,
+                        obj.extra.get('last_modified'))
+                       for obj in conn._to_objs(obj=body, xpath='Contents',
+                                                container=container)]
+            subdirs = [e.text for e in body.findall(
+                fixxpath(xpath='CommonPrefixes/Prefix',
+                         namespace=conn.namespace))]
+            truncated = findtext(element=body, xpath='IsTruncated',
+                                 namespace=conn.namespace)
+            if truncated.lower() != 'true':
+                return objects, subdirs, None
+
+            # NextMarker is only sent for listings with a delimiter
+            marker = findtext(element=body, xpath='NextMarker',
+                              namespace=conn.namespace)
+            return objects, subdirs, marker or objects[-1][0]
+
+        params['limit'] = listing.PAGE_SIZE
+        response = conn.connection.request(
+            '/%s' % conn._encode_container_name(self.container_name),
+            params=params)
+        if response.status == httplib.NO_CONTENT:
+            return [], [], None
+        if response.status != httplib.OK:
+            raise Exception('listing returned %d' % response.status)
+
+        entries = json.loads(response.body)
+        objects, subdirs = listing.swift_page(entries)
+        if len(entries) < listing.PAGE_SIZE:
+            return objects, subdirs, None
+        last = entries[-1]
+        return objects, subdirs, last.get('subdir') or last['name']
+
 
 class RemoteDirectory(object):
     def __init__(self, parent_container, path):
@@ -99,56 +288,21 @@ class RemoteDirectory(object):
 
         self.parent_container = parent_container
         self.path = path
-        self.shalist = {}
-        self.remote_files = {}
-
-        self.conn = self.parent_container.get_connection()
+        self.index = parent_container.get_index()
 
-        if not self.path:
-            self.shalist_path = '.shalist'
-            prefix = None
-        else:
-            self.shalist_path = remote_filename(os.path.join(self.path,
-                                                             '.shalist'))
-            prefix = remote_filename(self.path)
-
-        try:
-            obj = self.parent_container.get_container().get_object(
-                remote_filename(self.shalist_path))
-            (local_fd, local_file) = tempfile.mkstemp()
-            os.close(local_fd)
-            obj.download(local_file, overwrite_existing=True,
-                         delete_on_failure=True)
-
-            with open(local_file) as f:
-                self.shalist = json.loads(f.read())
-
-            os.remove(local_file)
-        except libcloud.storage.types.ObjectDoesNotExistError:
-            pass
-
-        for obj in self.conn.iterate_container_objects(
-            self.parent_container.get_container(), ex_prefix=prefix):
-            if obj.name.endswith('.sha512'):
-                pass
-            elif obj.name.endswith('.shalist'):
-                pass
-            else:
-                self.remote_files[obj.name.replace('~', '/')] = True
+        self.shalist = shalist.Manifest(**parent_container.manifest_options)
+        with metrics.timer('manifest_read'):
+            self.shalist.load(self.index.manifests_in(self.path),
+                              self.read_manifest)
 
     def listdir(self):
         for ent in self.shalist.keys():
-            if ent in self.remote_files:
+            if self.index.exists(ent):
                 yield ent
 
         # Directories don't appear in shalists
-        prefix = remote_filename(self.path + '/')
-        for obj in self.conn.iterate_container_objects(
-            self.parent_container.get_container(), ex_prefix=prefix):
-            if obj.name.endswith('.shalist'):
-                subdir = obj.name[len(prefix):]
-                if subdir and subdir != '.shalist':
-                    yield subdir.split('~')[0]
+        for d in self.index.subdirs(self.path):
+            yield d
 
     def get_file(self, path):
         fullpath = utility.path_join(self.path, path)
@@ -161,20 +315,49 @@ class RemoteDirectory(object):
         return self.path
 
     def update_shalist(self, path, checksum):
-        self.shalist[path] = checksum
+        self.shalist.update(path, checksum)
 
     def write_shalist(self):
-        shafile = remote_filename(os.path.join(self.path, '.shalist'))
-        print '%s Updating  %s with %s' %(datetime.datetime.now(), shafile,
-                                          self.path)
+        # Checksums learned while only planning a sync are not saved
+        if self.parent_container.read_only:
+            return
+        self.parent_container.manifest_writer.schedule(self)
+
+    def flush_shalist(self):
+        print '%s Updating  manifest of %s' %(datetime.datetime.now(),
+                                              self.path)
+        with metrics.timer('manifest_write'):
+            self.shalist.write(self.write_manifest, self.delete_manifest)
+
+    def manifest_name(self, name):
+        return remote_filename(utility.path_join(self.path, name))
+
+    def read_manifest(self, name):
+        try:
+            obj = self.parent_container.get_container().get_object(
+                self.manifest_name(name))
+        except libcloud.storage.types.ObjectDoesNotExistError:
+            return None
+        return ''.join(self.parent_container.get_connection()
+                       .download_object_as_stream(obj))
 
-        with data_in_file(json.dumps(self.shalist,
-                                     sort_keys=True, indent=4)) as f:
-            self.conn.upload_object(f, self.parent_container.get_container(),
-                                    shafile)
+    def write_manifest(self, name, data):
+        self.parent_container.get_connection().upload_object_via_stream(
+            iter([data]), self.parent_container.get_container(),
+            self.manifest_name(name))
+        self.index.add(self.manifest_name(name))
+
+    def delete_manifest(self, name):
+        try:
+            obj = self.parent_container.get_container().get_object(
+                self.manifest_name(name))
+            self.parent_container.get_connection().delete_object(obj)
+        except libcloud.storage.types.ObjectDoesNotExistError:
+            pass
+        self.index.remove(self.manifest_name(name))
 
     def file_exists(self, path):
-        return path in self.remote_files
+        return self.index.exists(path)
 
 
 class RemoteFile(object):
@@ -185,7 +368,6 @@ class RemoteFile(object):
         self.parent_container = parent_container
         self.parent_directory = parent_directory
         self.path = path
-        self.conn = self.parent_container.get_connection()
         self.cache = {}
 
     def checksum(self):
@@ -194,23 +376,34 @@ class RemoteFile(object):
 
         print ('%s Computing checksum for %s'
                %(datetime.datetime.now(), self.path))
-        local_file = self.fetch()
-        h = hashlib.sha512()
-        with open(local_file) as f:
-            d = f.read(1024 * 1204)
-            while d:
-                h.update(d)
-                d = f.read(1024 * 1024)
-        os.remove(local_file)
-
-        self.cache['checksum'] = h.hexdigest()
+        with metrics.timer('remote_checksum', self.size()):
+            local_file = self.fetch()
+            try:
+                checksum, _ = hashing.hash_file(local_file)
+            finally:
+                os.remove(local_file)
+
+        self.cache['checksum'] = checksum
         self.write_checksum(self.cache['checksum'])
         return self.cache['checksum']
 
     def size(self):
+        # The size of the content, which for compressed objects is not the
+        # size of what is stored
+        codec = self.codec()
+        if codec:
+            return codec[1]
+        return self.stored_size()
+
+    def stored_size(self):
         if 'size' in self.cache:
             return self.cache['size']
 
+        info = self.parent_directory.index.get(self.path)
+        if info and info.size is not None:
+            self.cache['size'] = info.size
+            return self.cache['size']
+
         print ('%s Querying the size of %s'
                %(datetime.datetime.now(), self.path))
         obj = self.parent_container.get_container().get_object(
@@ -218,12 +411,25 @@ class RemoteFile(object):
         self.cache['size'] = obj.size
         return self.cache['size']
 
+    def md5(self):
+        # Listing ETags are only the MD5 of the content for objects which
+        # were uploaded in one piece, so anything which might be segmented
+        # or compressed is left to a full checksum
+        if self.codec():
+            return None
+        info = self.parent_directory.index.get(self.path)
+        if not info or not info.hash or info.size is None:
+            return None
+        if info.size > self.parent_container.segment_threshold:
+            return None
+
+        etag = info.hash.strip('"').lower()
+        if len(etag) != 32 or '-' in etag:
+            return None
+        return etag
+
     def isdir(self):
-        prefix = remote_filename(self.path) + '~'
-        for obj in self.conn.iterate_container_objects(
-            self.parent_container.get_container(), ex_prefix=prefix):
-            return True
-        return False
+        return self.parent_directory.index.isdir(self.path)
 
     def islink(self):
         return False
@@ -232,57 +438,338 @@ class RemoteFile(object):
         return self.parent_directory.file_exists(self.path)
 
     def write_checksum(self, checksum):
-        shafile = remote_filename(os.path.join(
-            self.parent_directory.get_path(), '.shalist'))
-
-        shalist = {}
-        try:
-            obj = self.parent_container.get_container().get_object(
-                    shafile)
-            (local_fd, local_file) = tempfile.mkstemp()
-            os.close(local_fd)
-            obj.download(local_file, overwrite_existing=True,
-                         delete_on_failure=True)
-
-            with open(local_file) as f:
-                shalist = json.loads(f.read())
-
-            os.remove(local_file)
-        except libcloud.storage.types.ObjectDoesNotExistError:
-            pass
-        
-        shalist[self.path] = checksum
         self.cache['checksum'] = checksum
-
-        print '%s Updating  %s with %s' %(datetime.datetime.now(), shafile,
-                                          self.path)
-
-        with data_in_file(json.dumps(shalist, sort_keys=True, indent=4)) as f:
-            self.conn.upload_object(f, self.parent_container.get_container(),
-                                    shafile)
+        self.parent_directory.update_shalist(self.path, checksum)
+        self.parent_directory.write_shalist()
 
     def get_path(self):
         return self.path
 
+    def codec(self):
+        """(codec, original size) if the object is stored compressed."""
+        if 'codec' not in self.cache:
+            self.cache['codec'] = self.parent_directory.shalist.codec(
+                self.path)
+        return self.cache['codec']
+
+    def stored_codec(self, meta):
+        # The object's own metadata says if it is compressed too, and
+        # outlives a manifest which lost its entry
+        codec = self.codec()
+        if not codec:
+            codec = compression.from_metadata(meta or {})
+            if codec:
+                self.cache['codec'] = codec
+        return codec
+
+    def set_codec(self, codec=None, size=None):
+        self.cache['codec'] = codec and (codec, size)
+        self.parent_directory.shalist.update_codec(self.path, codec, size)
+
     def store(self, local_path):
+        size = os.path.getsize(local_path)
+        if size > self.parent_container.segment_threshold:
+            with open(local_path, 'rb') as f:
+                self.store_stream(f, size)
+            return
+
         kwargs = {}
         if self.parent_container.get_provider() == 's3':
             kwargs['ex_storage_class'] = self.parent_container.get_class()
         
-        self.conn.upload_object(
-            local_path,
-            self.parent_container.get_container(),
-            remote_filename(self.path),
-            **kwargs)
+        with self.parent_container.scheduler.request('up', size):
+            obj = self.parent_container.get_connection().upload_object(
+                local_path,
+                self.parent_container.get_container(),
+                remote_filename(self.path),
+                **kwargs)
+        self.parent_directory.index.add(obj.name, obj.size, obj.hash)
+        self.cache.pop('size', None)
+        self.set_codec(None)
+
+    def store_stream(self, stream, size, codec=None):
+        # A compressed stream is of unknown length, size is only that of
+        # its content
+        if size > self.parent_container.segment_threshold:
+            if self.parent_container.get_provider() == 's3':
+                self.store_multipart(stream, size, codec)
+            else:
+                self.store_segmented(stream, size, codec)
+            self.cache.pop('size', None)
+            self.set_codec(codec, size)
+            return
+
+        kwargs = {}
+        if self.parent_container.get_provider() == 's3':
+            kwargs['ex_storage_class'] = self.parent_container.get_class()
+        if codec:
+            kwargs['extra'] = {'meta_data': compression.metadata(codec, size)}
+
+        conn = self.parent_container.get_connection()
+        transfer_scheduler = self.parent_container.scheduler
+        with transfer_scheduler.request('up', size, streamed=True):
+            obj = conn.upload_object_via_stream(
+                iter(transfer_scheduler.reader(stream, 'up')),
+                self.parent_container.get_container(),
+                remote_filename(self.path),
+                **kwargs)
+
+        stored_size = size
+        if codec:
+            stored_size = stream.count
+        self.parent_directory.index.add(obj.name, stored_size, obj.hash)
+        self.cache.pop('size', None)
+        self.set_codec(codec, size)
+
+    def store_multipart(self, stream, size, codec=None):
+        # S3 multipart upload, with the parts sent in parallel
+        conn = self.parent_container.get_connection()
+        container = self.parent_container.get_container()
+        name = remote_filename(self.path)
+        headers = {'x-amz-storage-class':
+                       self.parent_container.get_class().upper()}
+        if codec:
+            for key, value in compression.metadata(codec, size).items():
+                headers['x-amz-meta-%s' % key] = value
+        upload_id = conn._initiate_multipart(container, name, headers=headers)
+        request_path = conn._get_object_path(container, name)
+
+        # Parts other than the last must be at least 5mb, and there can be
+        # at most 10,000 of them
+        segment_size = transfers.segment_size_for(
+            size, max(self.parent_container.segment_size, 5 * 1024 * 1024),
+            10000)
+
+        def upload_segment(number, data):
+            c = self.parent_container.get_connection()
+            metrics.count_call('libcloud', 'upload_part')
+            headers = {'Content-Length': len(data),
+                       'Content-MD5': base64.b64encode(
+                           hashlib.md5(data).digest())}
+            response = c.connection.request(
+                request_path, method='PUT', data=data, headers=headers,
+                params={'uploadId': upload_id, 'partNumber': number})
+            if response.status != httplib.OK:
+                raise Exception('part upload returned %d' % response.status)
+            return response.headers['etag'].replace('"', '')
+
+        try:
+            segments = transfers.segmented_upload(
+                stream, segment_size, self.parent_container.segment_jobs,
+                upload_segment, name=self.path,
+                transfer_scheduler=self.parent_container.scheduler)
+            conn._commit_multipart(container, name, upload_id,
+                                   [(s[0], s[3]) for s in segments])
+        except Exception:
+            conn._abort_multipart(container, name, upload_id)
+            raise
+
+        self.parent_directory.index.add(name, sum([s[1] for s in segments]))
+
+    def store_segmented(self, stream, size, codec=None):
+        # Segments are uploaded in parallel and then tied together with a
+        # Static Large Object manifest
+        name = remote_filename(self.path)
+        segment_container_name = \
+            self.parent_container.get_segment_container().name
+        prefix = '%s/slo/%f/%d' %(name, time.time(), size)
+        segment_size = transfers.segment_size_for(
+            size, self.parent_container.segment_size, 1000)
+        uploaded = []
+
+        def upload_segment(number, data):
+            segment_name = '%s/%08d' %(prefix, number)
+            self.parent_container.get_connection().upload_object_via_stream(
+                iter([data]), self.parent_container.get_segment_container(),
+                segment_name)
+            uploaded.append(segment_name)
+            return segment_name
+
+        try:
+            segments = transfers.segmented_upload(
+                stream, segment_size, self.parent_container.segment_jobs,
+                upload_segment, name=self.path,
+                transfer_scheduler=self.parent_container.scheduler)
+            self.put_segment_manifest(segments, segment_container_name,
+                                      codec, size)
+        except Exception:
+            self.delete_segments(uploaded)
+            raise
+
+        self.delete_earlier_segments(prefix)
+        self.parent_directory.index.add(name, sum([s[1] for s in segments]))
+
+    def put_segment_manifest(self, segments, segment_container_name, codec,
+                             size):
+        manifest = []
+        for number, length, md5, segment_name in segments:
+            manifest.append({'path': '/%s/%s' %(segment_container_name,
+                                                segment_name),
+                             'etag': md5,
+                             'size_bytes': length})
+
+        headers = {'Content-Type': 'application/json'}
+        if codec:
+            for key, value in compression.metadata(codec, size).items():
+                headers['X-Object-Meta-%s' % key] = value
+
+        conn = self.parent_container.get_connection()
+        metrics.count_call('libcloud', 'put_large_object_manifest')
+        response = conn.connection.request(
+            self.request_path(conn), method='PUT', data=json.dumps(manifest),
+            params={'multipart-manifest': 'put'}, headers=headers)
+        if response.status != httplib.CREATED:
+            raise Exception('manifest upload returned %d' % response.status)
+
+    def delete_earlier_segments(self, prefix):
+        # Nothing refers to the segments of earlier uploads once the
+        # manifest under prefix is written. Object names have no /, so no
+        # other object's segments share the listing prefix.
+        conn = self.parent_container.get_connection()
+        try:
+            names = [obj.name for obj in conn.iterate_container_objects(
+                         self.parent_container.get_segment_container(),
+                         ex_prefix='%s/slo/' % remote_filename(self.path))]
+        except Exception, e:
+            print ('%s Listing   FAILED TO LIST SEGMENTS OF %s (%s)'
+                   %(datetime.datetime.now(), self.path, e))
+            return
+        self.delete_segments([segment_name for segment_name in names
+                              if not segment_name.startswith(prefix + '/')])
+
+    def delete_segments(self, names):
+        # A segment left behind only costs its storage, so failures here
+        # don't fail the file
+        conn = self.parent_container.get_connection()
+        container = self.parent_container.get_segment_container()
+        for segment_name in names:
+            try:
+                conn.delete_object(Object(segment_name, 0, None, {}, {},
+                                          container, conn))
+            except Exception, e:
+                print ('%s Delete    FAILED TO DELETE SEGMENT %s (%s)'
+                       %(datetime.datetime.now(), segment_name, e))
+
+    def can_copy_from(self, source_file):
+        # The copy is authorized with our credentials, so they have to work
+        # for the source too. Swift can only copy within a cluster, which
+        # for Cloud Files means within a region.
+        if not isinstance(source_file, RemoteFile):
+            return False
+
+        source = source_file.parent_container
+        destination = self.parent_container
+        if source.get_provider() != destination.get_provider():
+            return False
+        if (source.conf[source.get_provider()] !=
+            destination.conf[destination.get_provider()]):
+            return False
+        if destination.get_provider() != 's3' and \
+            source.region != destination.region:
+            return False
+        return source_file.size() <= transfers.COPY_LIMIT
+
+    def copy_from(self, source_file):
+        conn = self.parent_container.get_connection()
+        source = '/%s/%s' %(
+            urllib.quote(source_file.parent_container.get_name()),
+            urllib.quote(remote_filename(source_file.path)))
+
+        if self.parent_container.get_provider() == 's3':
+            headers = {'x-amz-copy-source': source,
+                       'x-amz-storage-class':
+                           self.parent_container.get_class().upper()}
+            expected = httplib.OK
+        else:
+            headers = {'X-Copy-From': source}
+            expected = httplib.CREATED
+        headers['Content-Length'] = 0
+
+        metrics.count_call('libcloud', 'copy_object')
+        response = conn.connection.request(self.request_path(conn),
+                                           method='PUT', headers=headers)
+        if response.status != expected:
+            raise Exception('copy returned %d' % response.status)
+
+        info = source_file.parent_directory.index.get(source_file.path)
+        self.parent_directory.index.add(remote_filename(self.path),
+                                        source_file.stored_size(),
+                                        info and info.hash)
+        self.cache.pop('size', None)
+
+        # Copies are of the stored data, compressed or not
+        self.set_codec(*(source_file.codec() or (None, None)))
+
+    def sibling(self, path):
+        """Another object in this container, such as a copy source."""
+        return RemoteFile(self.parent_container, self.parent_directory, path)
+
+    def open(self):
+        obj = self.parent_container.get_container().get_object(
+            remote_filename(self.path))
+        conn = self.parent_container.get_connection()
+        stream = self.parent_container.scheduler.reader(
+            streams.IteratorReader(conn.download_object_as_stream(
+                obj, chunk_size=streams.CHUNK_SIZE)), 'down')
+
+        codec = self.stored_codec(obj.meta_data)
+        if codec:
+            stream = compression.DecompressingReader(stream, codec[0])
+        return stream
 
     def fetch(self):
+        local_file = self.fetch_stored()
+        codec = self.codec()
+        if codec:
+            local_file = compression.decompress_file(local_file, codec[0])
+        return local_file
+
+    def fetch_stored(self):
         obj = self.parent_container.get_container().get_object(
             remote_filename(self.path))
+        self.stored_codec(obj.meta_data)
 
         (local_fd, local_file) = tempfile.mkstemp()
         os.close(local_fd)
-
-        self.conn.download_object(obj, local_file, overwrite_existing=True,
-                                  delete_on_failure=True)
+        transfer_scheduler = self.parent_container.scheduler
+
+        if obj.size > self.parent_container.fetch_threshold:
+            def fetch_range(start, end):
+                conn = self.parent_container.get_connection()
+                metrics.count_call('libcloud', 'get_object_range')
+                response = conn.connection.request(
+                    self.request_path(conn), method='GET', raw=True,
+                    headers={'Range': 'bytes=%d-%d' %(start, end)})
+                if response.status != httplib.PARTIAL_CONTENT:
+                    raise Exception('range request returned %d'
+                                    % response.status)
+                return streams.IteratorReader(
+                    response.iter_content(streams.CHUNK_SIZE))
+
+            try:
+                transfers.ranged_fetch(local_file, obj.size,
+                                       self.parent_container.fetch_chunk_size,
+                                       self.parent_container.fetch_jobs,
+                                       fetch_range, name=self.path,
+                                       transfer_scheduler=transfer_scheduler)
+            except Exception:
+                os.remove(local_file)
+                raise
+            return local_file
+
+        with transfer_scheduler.request('down', obj.size):
+            self.parent_container.get_connection().download_object(
+                obj, local_file, overwrite_existing=True,
+                delete_on_failure=True)
 
         return local_file
+
+    def request_path(self, conn):
+        # The path of this object for raw requests on conn.connection
+        name = remote_filename(self.path)
+        if self.parent_container.get_provider() == 's3':
+            return conn._get_object_path(self.parent_container.get_container(),
+                                         name)
+        return '/%s/%s' %(
+            conn._encode_container_name(self.parent_container.get_name()),
+            conn._encode_object_name(name))
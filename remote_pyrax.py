@@ -1,16 +1,30 @@
 # Methods to handle remote files
 
 
+import atexit
 import datetime
-import hashlib
 import json
 import os
 import sys
 import tempfile
+import threading
+import time
+import urllib
 import urllib2
 
 import pyrax
 
+import compression
+import connections
+import hashing
+import listing
+import manifest_writer
+import metrics
+import remote_index
+import scheduler
+import shalist
+import streams
+import transfers
 import utility
 
 
@@ -22,36 +36,191 @@ except ImportError:
     pass
 
 
+# Methods which make API calls, counted per connection. Before pyrax 1.9
+# every request went through a swiftclient connection, since then they go
+# through the pyrax client's own request methods.
+SWIFT_API_METHODS = ['get_account', 'head_account', 'get_container',
+                     'head_container', 'put_container', 'post_container',
+                     'delete_container', 'get_object', 'head_object',
+                     'put_object', 'post_object', 'delete_object']
+CLIENT_API_METHODS = ['method_head', 'method_get', 'method_post',
+                      'method_put', 'method_delete']
+
+
+def swift_connection(conn):
+    # The swiftclient connection underneath pyrax, which went away in 1.9
+    return getattr(conn, 'connection', None)
+
+
+def client_request(conn, method, path, params=None, headers=None,
+                   **kwargs):
+    """Make a request below the pyrax 1.9 client's request methods.
+
+    Those quote the path, but leave a ? or & in it alone, and add query
+    strings unquoted, so an object name in either is cut short. Here path
+    is quoted and params encoded. Returns (response, body), with the body
+    decoded if it is JSON.
+    """
+
+    url = conn.management_url + urllib.quote(path)
+    if params:
+        url += '?' + urllib.urlencode(params)
+    headers = dict(headers or {})
+
+    metrics.count_call('pyrax', 'method_%s' % method.lower())
+    try:
+        headers['X-Auth-Token'] = conn.identity.token
+        return conn.request(url, method, headers=headers, **kwargs)
+    except pyrax.exceptions.Unauthorized:
+        # As the client does, authenticate again when the token expires
+        conn.identity.authenticate()
+        headers['X-Auth-Token'] = conn.identity.token
+        return conn.request(url, method, headers=headers, **kwargs)
+
+
+def put_manifest(conn, container_name, name, manifest, headers):
+    # Neither pyrax API can send the query string a Static Large Object
+    # manifest needs, so this goes underneath them: to swiftclient before
+    # pyrax 1.9, and below the client's own request methods since
+    swift = swift_connection(conn)
+    if swift:
+        swift.put_object(container_name, name, contents=json.dumps(manifest),
+                         query_string='multipart-manifest=put',
+                         headers=headers)
+        return
+
+    # The client would otherwise label the manifest as JSON, which is what
+    # Swift would then serve the assembled object as
+    headers = dict(headers)
+    headers['Content-Type'] = None
+    client_request(conn, 'PUT', '/%s/%s' %(container_name, name),
+                   params={'multipart-manifest': 'put'},
+                   data=json.dumps(manifest), headers=headers)
+
+
+def list_names(conn, container_name, prefix):
+    """Every object name in a container starting with prefix."""
+
+    swift = swift_connection(conn)
+    if swift:
+        _, entries = swift.get_container(container_name, prefix=prefix,
+                                         full_listing=True)
+        return [entry['name'] for entry in entries]
+
+    # The client's own listings send the prefix and marker unquoted
+    names = []
+    params = {'prefix': prefix, 'format': 'json',
+              'limit': listing.PAGE_SIZE}
+    while True:
+        _, entries = client_request(conn, 'GET', '/%s' % container_name,
+                                    params=params)
+        # An empty listing has no JSON body
+        entries = entries or []
+        names.extend([entry['name'] for entry in entries])
+        if len(entries) < listing.PAGE_SIZE:
+            return names
+        params['marker'] = entries[-1]['name']
+
+
+def response_metadata(response):
+    # The object metadata in the headers of a download
+    prefix = 'x-object-meta-'
+    return dict((key.lower()[len(prefix):], value)
+                for key, value in response.info().items()
+                if key.lower().startswith(prefix))
+
+
 def remote_filename(filename):
     return filename.replace('/', '~')
 
 
-class RemoteContainer(object):
-    def __init__(self, name):
-        self.region, name = name.split('://')
-        self.basename = os.path.basename(name)
+def container_name_for(region, name):
+    if region == 'dfw':
+        return remote_filename(name)
+    return remote_filename('%s/%s' %(region, name))
 
-        pyrax.set_setting('identity_type', 'rackspace')
-        with open(os.path.expanduser('~/.cloudfiles'), 'r') as f:
-            self.conf = json.loads(f.read())
-            pyrax.set_credentials(self.conf['access_key'],
-                                  self.conf['secret_key'],
-                                  region=self.region)
 
-        conn = pyrax.connect_to_cloudfiles(region=self.region.upper())
+def set_credentials(region):
+    pyrax.set_setting('identity_type', 'rackspace')
+    with open(os.path.expanduser('~/.cloudfiles'), 'r') as f:
+        conf = json.loads(f.read())
+        pyrax.set_credentials(conf['access_key'], conf['secret_key'],
+                              region=region)
+    return conf
 
-        if self.region == 'dfw':
-            self.container_name = remote_filename(name)
-        else:
-            self.container_name = remote_filename('%s/%s' %(self.region, name))
-        container = conn.create_container(self.container_name)
 
-        for i in range(3):
+def object_headers(codec, size):
+    # Compressed objects say so in their metadata, as well as in the
+    # manifest
+    headers = {}
+    if codec:
+        for key, value in compression.metadata(codec, size).items():
+            headers['X-Object-Meta-%s' % key] = value
+    return headers
+
+
+class RemoteContainer(object):
+    def __init__(self, name, segment_threshold=transfers.SEGMENT_THRESHOLD,
+                 segment_size=transfers.SEGMENT_SIZE,
+                 segment_jobs=transfers.SEGMENT_JOBS,
+                 fetch_threshold=transfers.FETCH_THRESHOLD,
+                 fetch_chunk_size=transfers.FETCH_CHUNK_SIZE,
+                 fetch_jobs=transfers.FETCH_JOBS, manifest_options=None,
+                 manifest_interval=manifest_writer.INTERVAL,
+                 manifest_batch=manifest_writer.BATCH_SIZE,
+                 read_only=False, transfer_scheduler=scheduler.UNLIMITED,
+                 listing_jobs=listing.JOBS):
+        self.region, name = name.split('://')
+        self.basename = os.path.basename(name)
+        self.segment_threshold = segment_threshold
+        self.segment_size = segment_size
+        self.segment_jobs = segment_jobs
+        self.fetch_threshold = fetch_threshold
+        self.fetch_chunk_size = fetch_chunk_size
+        self.fetch_jobs = fetch_jobs
+        self.manifest_options = manifest_options or {}
+        self.read_only = read_only
+        self.scheduler = transfer_scheduler
+        self.listing_jobs = listing_jobs
+
+        # Manifests are written in the background, and must be flushed
+        # however we exit
+        self.manifest_writer = manifest_writer.ManifestWriter(
+            manifest_interval, manifest_batch)
+        atexit.register(self.close)
+        self.segment_container_name = None
+        self.segment_lock = threading.Lock()
+
+        self.conf = set_credentials(self.region)
+
+        # Connections and container handles are reused for the life of the
+        # container. pyrax clients are not thread safe, so each thread which
+        # touches this container gets its own, from a pool which outlives
+        # the threads.
+        self.connections = connections.Pool()
+
+        self.container_name = container_name_for(self.region, name)
+        conn = self.get_connection()
+
+        # A sync which is only being planned creates nothing, and treats a
+        # missing container as empty
+        self.missing = False
+        if read_only:
             try:
-                container.log_retention(True)
-                break
-            except:
-                pass
+                self.connections.get().container = conn.get_container(
+                    self.container_name)
+            except pyrax.exceptions.NoSuchContainer:
+                self.missing = True
+        else:
+            container = conn.create_container(self.container_name)
+            self.connections.get().container = container
+
+            for i in range(3):
+                try:
+                    container.log_retention(True)
+                    break
+                except:
+                    pass
 
         for info in conn.list_containers_info():
             if info['name'] == self.container_name:
@@ -61,131 +230,202 @@ class RemoteContainer(object):
                          utility.DisplayFriendlySize(remote_total),
                          info['count']))
 
-    def get_directory(self, path):
-        return RemoteDirectory(self.region, self.container_name,
-                               utility.path_join(self.basename, path))
-
-
-class RemoteDirectory(object):
-    def __init__(self, region, container_name, path):
-        self.region = region
-        self.container_name = container_name
-        self.path = path
-        self.shalist = {}
-        self.remote_files = {}
+        self.index = None
+        self.index_lock = threading.Lock()
 
-        conn = pyrax.connect_to_cloudfiles(region=self.region.upper())
-        container = conn.create_container(self.container_name)
+    def close(self):
+        self.manifest_writer.close()
 
-        if not self.path:
-            self.shalist_path = '.shalist'
-            prefix = None
+    def get_directory(self, path):
+        return RemoteDirectory(self, utility.path_join(self.basename, path))
+
+    # Helper methods for this driver (not part of the base interface)
+    def get_connection(self):
+        slot = self.connections.get()
+        if not hasattr(slot, 'conn'):
+            slot.conn = pyrax.connect_to_cloudfiles(
+                region=self.region.upper())
+            swift = swift_connection(slot.conn)
+            if swift:
+                metrics.instrument(swift, 'pyrax', SWIFT_API_METHODS)
+            else:
+                metrics.instrument(slot.conn, 'pyrax', CLIENT_API_METHODS)
+        return slot.conn
+
+    def get_container(self):
+        # The container was created, or found when planning, in the
+        # constructor, so a lookup is enough here, once per connection
+        slot = self.connections.get()
+        if not hasattr(slot, 'container'):
+            slot.container = self.get_connection().get_container(
+                self.container_name)
+        return slot.container
+
+    def get_segment_container_name(self):
+        # Large object segments live in their own container, so they don't
+        # show up in listings of this one
+        with self.segment_lock:
+            if not self.segment_container_name:
+                name = '%s_segments' % self.container_name
+                self.get_connection().create_container(name)
+                self.segment_container_name = name
+        return self.segment_container_name
+
+    def get_index(self):
+        with self.index_lock:
+            if not self.index:
+                index = remote_index.ContainerIndex()
+                if self.missing:
+                    self.index = index
+                    return self.index
+
+                print ('%s Finding existing remote files'
+                       % datetime.datetime.now())
+                with metrics.timer('listing'):
+                    count = index.load(self.list_objects(
+                        remote_filename(self.basename)))
+                print ('%s Found %d existing objects in %s'
+                       %(datetime.datetime.now(), count, self.region))
+                self.index = index
+        return self.index
+
+    def list_objects(self, prefix):
+        return listing.list_objects(self.list_page, prefix, self.listing_jobs)
+
+    def list_page(self, prefix, marker=None, delimiter=None):
+        """One listing request, returning (objects, subdirs, marker).
+
+        pyrax drops the subdirectories from the objects it lists, so the
+        raw listing is used: from client_request() since pyrax 1.9, whose
+        own listings send the marker unquoted, and from the swiftclient
+        underneath it before that. The marker to continue from is None
+        after the last page.
+        """
+
+        conn = self.get_connection()
+        swift = swift_connection(conn)
+        if swift:
+            _, entries = swift.get_container(
+                self.container_name, prefix=prefix, marker=marker,
+                delimiter=delimiter, limit=listing.PAGE_SIZE)
         else:
-            self.shalist_path = remote_filename(os.path.join(self.path,
-                                                             '.shalist'))
-            prefix = remote_filename(self.path)
+            params = {'prefix': prefix, 'format': 'json',
+                      'limit': listing.PAGE_SIZE}
+            if marker:
+                params['marker'] = marker
+            if delimiter:
+                params['delimiter'] = delimiter
+            _, entries = client_request(conn, 'GET',
+                                        '/%s' % self.container_name,
+                                        params=params)
+            # An empty listing has no JSON body
+            entries = entries or []
+        print ('%s ... %d results, marker %s'
+               %(datetime.datetime.now(), len(entries), marker))
+
+        objects, subdirs = listing.swift_page(entries)
+        if len(entries) < listing.PAGE_SIZE:
+            return objects, subdirs, None
+        last = entries[-1]
+        return objects, subdirs, last.get('subdir') or last['name']
 
-        for i in range(3):
-            try:
-                self.shalist = json.loads(container.get_object(
-                        remote_filename(self.shalist_path)).fetch())
-                break
-            except:
-                pass
 
-        print '%s Finding existing remote files' % datetime.datetime.now()
-        try:
-            marker = None
-            while True:
-                results = container.get_objects(prefix=prefix, marker=marker)
-                print ('%s ... %d results, marker %s'
-                       %(datetime.datetime.now(), len(results), marker))
-                if not results:
-                    break
-
-                for f in results:
-                    marker = f.name
-                    if f.name.endswith('.sha512'):
-                        pass
-                    elif f.name.endswith('.shalist'):
-                        pass
-                    else:
-                        self.remote_files[f.name.replace('~', '/')] = True
+class RemoteDirectory(object):
+    def __init__(self, parent_container, path):
+        self.region = parent_container.region
+        self.parent_container = parent_container
+        self.container_name = parent_container.container_name
+        self.path = path
+        self.index = parent_container.get_index()
 
-        except pyrax.exceptions.NoSuchObject:
-            pass
+        self.shalist = shalist.Manifest(**parent_container.manifest_options)
+        with metrics.timer('manifest_read'):
+            self.shalist.load(self.index.manifests_in(self.path),
+                              self.read_manifest)
 
         print ('%s Found %d existing files in %s'
-               %(datetime.datetime.now(), len(self.remote_files), self.region))
+               %(datetime.datetime.now(), len(self.index.files(self.path)),
+                 self.region))
 
     def listdir(self):
         for ent in self.shalist.keys():
-            if ent in self.remote_files:
+            if self.index.exists(ent):
                 yield ent
 
         # Directories don't appear in shalists
-        conn = pyrax.connect_to_cloudfiles(region=self.region.upper())
-        container = conn.create_container(self.container_name)
-
-        dirs = {}
-        marker = None
-        prefix = remote_filename(self.path) + '~'
-        while True:
-            results = container.get_objects(prefix=prefix, marker=marker)
-            if not results:
-                break
-            for f in results:
-                marker = f.name
-                if f.name.endswith('.shalist'):
-                    subdir = f.name[len(prefix):]
-                    if subdir and subdir != '.shalist':
-                        dirs[subdir.split('~')[0]] = True
-
-        for d in dirs:
+        for d in self.index.subdirs(self.path):
             yield d
 
     def get_file(self, path):
         fullpath = utility.path_join(self.path, path)
-        r = RemoteFile(self.region, self.container_name, self.shalist,
-                       self.remote_files, self.path, fullpath)
+        r = RemoteFile(self.parent_container, self, fullpath)
         if fullpath in self.shalist:
              r.cache['checksum'] = self.shalist[fullpath]
         return r
 
     def update_shalist(self, path, checksum):
-        self.shalist[path] = checksum
+        self.shalist.update(path, checksum)
 
     def write_shalist(self):
-        shafile = remote_filename(os.path.join(self.path, '.shalist'))
-        print '%s Updating  %s with %s' %(datetime.datetime.now(), shafile,
-                                          self.path)
-
-        conn = pyrax.connect_to_cloudfiles(region=self.region.upper())
-        container = conn.create_container(self.container_name)
+        # Checksums learned while only planning a sync are not saved
+        if self.parent_container.read_only:
+            return
+        self.parent_container.manifest_writer.schedule(self)
+
+    def flush_shalist(self):
+        print '%s Updating  manifest of %s' %(datetime.datetime.now(),
+                                              self.path)
+        with metrics.timer('manifest_write'):
+            self.shalist.write(self.write_manifest, self.delete_manifest)
+
+    # Helper methods for this driver (not part of the base interface)
+    def manifest_name(self, name):
+        return remote_filename(utility.path_join(self.path, name))
+
+    def read_manifest(self, name):
+        container = self.parent_container.get_container()
+        for i in range(3):
+            try:
+                return container.get_object(self.manifest_name(name)).fetch()
+            except pyrax.exceptions.NoSuchObject:
+                return None
+            except Exception as e:
+                print ('%s Fetch     FAILED TO FETCH CHECKSUMS (%s)'
+                       %(datetime.datetime.now(), e))
+        return None
 
+    def write_manifest(self, name, data):
+        container = self.parent_container.get_container()
         for i in range(3):
             try:
-                try:
-                    obj = container.delete_object(shafile)
-                except:
-                    pass
-                obj = container.store_object(
-                    shafile, json.dumps(self.shalist, sort_keys=True, indent=4))
-                break
+                container.store_object(self.manifest_name(name), data)
+                self.index.add(self.manifest_name(name))
+                return
             except Exception as e:
                 print ('%s Upload    FAILED TO UPLOAD CHECKSUM (%s)'
                        %(datetime.datetime.now(), e))
 
+        # The manifest writer tries again later
+        raise e
+
+    def delete_manifest(self, name):
+        container = self.parent_container.get_container()
+        try:
+            container.delete_object(self.manifest_name(name))
+        except pyrax.exceptions.NoSuchObject:
+            pass
+        self.index.remove(self.manifest_name(name))
+
 
 class RemoteFile(object):
-    def __init__(self, region, container_name, shalist, remote_files,
-                 container_path, path):
-        self.region = region
-        self.container_name = container_name
-        self.shalist = shalist
-        self.remote_files = remote_files
+    def __init__(self, parent_container, parent_directory, path):
+        self.region = parent_container.region
+        self.parent_container = parent_container
+        self.parent_directory = parent_directory
+        self.container_name = parent_container.container_name
+        self.index = parent_directory.index
         self.path = path
-        self.container_path = container_path
+        self.container_path = parent_directory.path
         self.cache = {}
 
     def checksum(self):
@@ -194,31 +434,32 @@ class RemoteFile(object):
 
         write_remote_checksum = False
 
-        conn = pyrax.connect_to_cloudfiles(region=self.region.upper())
-        container = conn.create_container(self.container_name)
+        container = self.parent_container.get_container()
 
         try:
             self.cache['checksum'] = container.get_object(
                 remote_filename(self.path + '.sha512')).fetch()
-            container.delete_object(
-                remote_filename(self.path + '.sha512'))
-            write_remote_checksum = True
             print ('%s Found old style checksum for %s'
                    %(datetime.datetime.now(), self.path))
+
+            # The checksum moves into the manifest, but a sync which is
+            # only being planned writes no manifests, so it stays put
+            if not self.parent_container.read_only:
+                container.delete_object(
+                    remote_filename(self.path + '.sha512'))
+                write_remote_checksum = True
         except:
             print ('%s Missing checksum for %s'
                    %(datetime.datetime.now(), self.path))
-            local_file = self.fetch()
-            h = hashlib.sha512()
-            with open(local_file) as f:
-                d = f.read(1024 * 1204)
-                while d:
-                    h.update(d)
-                    d = f.read(1024 * 1024)
-            os.remove(local_file)
+            with metrics.timer('remote_checksum', self.size()):
+                local_file = self.fetch()
+                try:
+                    checksum, _ = hashing.hash_file(local_file)
+                finally:
+                    os.remove(local_file)
 
-            self.cache['checksum'] = h.hexdigest()
-            write_remote_checksum = True
+            self.cache['checksum'] = checksum
+            write_remote_checksum = not self.parent_container.read_only
 
         if write_remote_checksum:
             self.write_checksum(self.cache['checksum'])
@@ -226,92 +467,295 @@ class RemoteFile(object):
         return self.cache['checksum']
 
     def size(self):
+        # The size of the content, which for compressed objects is not the
+        # size of what is stored
+        codec = self.codec()
+        if codec:
+            return codec[1]
+        return self.stored_size()
+
+    def stored_size(self):
         if 'size' in self.cache:
             return self.cache['size']
 
+        info = self.index.get(self.path)
+        if info and info.size is not None:
+            self.cache['size'] = info.size
+            return self.cache['size']
+
         print ('%s Querying the size of %s in %s'
                %(datetime.datetime.now(), self.path, self.region))
-        conn = pyrax.connect_to_cloudfiles(region=self.region.upper())
-        container = conn.create_container(self.container_name)
+        container = self.parent_container.get_container()
         obj = container.get_object(remote_filename(self.path))
         self.cache['size'] = obj.total_bytes
         return self.cache['size']
 
-    def isdir(self):
-        conn = pyrax.connect_to_cloudfiles(region=self.region.upper())
-        container = conn.create_container(self.container_name)
+    def md5(self):
+        # Listing ETags are only the MD5 of the content for objects which
+        # were uploaded in one piece, so anything which might be segmented
+        # or compressed is left to a full checksum
+        if self.codec():
+            return None
+        info = self.index.get(self.path)
+        if not info or not info.hash or info.size is None:
+            return None
+        if info.size > self.parent_container.segment_threshold:
+            return None
+
+        etag = info.hash.strip('"').lower()
+        if len(etag) != 32 or '-' in etag:
+            return None
+        return etag
 
-        prefix = remote_filename(self.path) + '~'
-        results = container.get_objects(prefix=prefix)
-        if not results:
-            return False
-        return True
+    def isdir(self):
+        return self.index.isdir(self.path)
 
     def islink(self):
         return False
 
     def exists(self):
-        return self.path in self.remote_files
+        return self.index.exists(self.path)
 
     def write_checksum(self, checksum):
-        self.shalist[self.path] = checksum
         self.cache['checksum'] = checksum
-
-        shafile = remote_filename(os.path.join(self.container_path, '.shalist'))
-        print '%s Updating  %s with %s' %(datetime.datetime.now(), shafile,
-                                          self.path)
-
-        conn = pyrax.connect_to_cloudfiles(region=self.region.upper())
-        container = conn.create_container(self.container_name)
-
-        for i in range(3):
-            try:
-                try:
-                    obj = container.delete_object(shafile)
-                except:
-                    pass
-                obj = container.store_object(
-                    shafile, json.dumps(self.shalist, sort_keys=True, indent=4))
-                break
-            except Exception as e:
-                print ('%s Upload    FAILED TO UPLOAD CHECKSUM (%s)'
-                       %(datetime.datetime.now(), e))
+        self.parent_directory.update_shalist(self.path, checksum)
+        self.parent_directory.write_shalist()
 
     def get_path(self):
         return self.path
 
+    def codec(self):
+        """(codec, original size) if the object is stored compressed."""
+        if 'codec' not in self.cache:
+            self.cache['codec'] = self.parent_directory.shalist.codec(
+                self.path)
+        return self.cache['codec']
+
+    def stored_codec(self, meta):
+        # The object's own metadata says if it is compressed too, and
+        # outlives a manifest which lost its entry
+        codec = self.codec()
+        if not codec:
+            codec = compression.from_metadata(meta or {})
+            if codec:
+                self.cache['codec'] = codec
+        return codec
+
+    def set_codec(self, codec=None, size=None):
+        self.cache['codec'] = codec and (codec, size)
+        self.parent_directory.shalist.update_codec(self.path, codec, size)
+
     def store(self, local_path):
+        size = os.path.getsize(local_path)
+        if size > self.parent_container.segment_threshold:
+            with open(local_path, 'rb') as f:
+                self.store_stream(f, size)
+            return
+
         # Uploads sometimes timeout. Retry three times.
-        conn = pyrax.connect_to_cloudfiles(region=self.region.upper())
-        container = conn.create_container(self.container_name)
+        container = self.parent_container.get_container()
 
         for i in range(3):
             try:
-                obj = container.upload_file(
-                    local_path, obj_name=remote_filename(self.path))
+                with self.parent_container.scheduler.request('up', size):
+                    obj = container.upload_file(
+                        local_path, obj_name=remote_filename(self.path))
+                self.index.add(remote_filename(self.path),
+                               os.path.getsize(local_path))
+                self.cache.pop('size', None)
+                self.set_codec(None)
                 break
             except Exception as e:
                 print '%s Upload    FAILED (%s)' %(datetime.datetime.now(), e)
 
+    def store_stream(self, stream, size, codec=None):
+        # A compressed stream is of unknown length, size is only that of
+        # its content
+        if size > self.parent_container.segment_threshold:
+            self.store_segmented(stream, size, codec)
+            self.set_codec(codec, size)
+            return
+
+        # Streams can't be rewound, so retries are left to the caller. With
+        # a chunk size pyrax sends the stream chunked, so it is never read
+        # into memory or a temp file.
+        conn = self.parent_container.get_connection()
+        transfer_scheduler = self.parent_container.scheduler
+        with transfer_scheduler.request('up', size, streamed=True):
+            conn.store_object(
+                self.container_name, remote_filename(self.path),
+                transfer_scheduler.reader(stream, 'up'),
+                chunk_size=streams.CHUNK_SIZE,
+                headers=object_headers(codec, size), return_none=True)
+
+        stored_size = size
+        if codec:
+            stored_size = stream.count
+        self.index.add(remote_filename(self.path), stored_size)
+        self.cache.pop('size', None)
+        self.set_codec(codec, size)
+
+    def store_segmented(self, stream, size, codec=None):
+        # Segments are uploaded in parallel and then tied together with a
+        # Static Large Object manifest
+        name = remote_filename(self.path)
+        segment_container = self.parent_container.get_segment_container_name()
+        prefix = '%s/slo/%f/%d' %(name, time.time(), size)
+        segment_size = transfers.segment_size_for(
+            size, self.parent_container.segment_size, 1000)
+        uploaded = []
+
+        def upload_segment(number, data):
+            segment_name = '%s/%08d' %(prefix, number)
+            conn = self.parent_container.get_connection()
+            conn.store_object(segment_container, segment_name, data,
+                              return_none=True)
+            uploaded.append(segment_name)
+            return segment_name
+
+        try:
+            segments = transfers.segmented_upload(
+                stream, segment_size, self.parent_container.segment_jobs,
+                upload_segment, name=self.path,
+                transfer_scheduler=self.parent_container.scheduler)
+
+            manifest = []
+            for number, length, md5, segment_name in segments:
+                manifest.append({'path': '/%s/%s' %(segment_container,
+                                                    segment_name),
+                                 'etag': md5,
+                                 'size_bytes': length})
+
+            put_manifest(self.parent_container.get_connection(),
+                         self.container_name, name, manifest,
+                         object_headers(codec, size))
+        except Exception:
+            self.delete_segments(uploaded)
+            raise
+
+        self.delete_earlier_segments(prefix)
+        self.index.add(name, sum([s[1] for s in segments]))
+        self.cache.pop('size', None)
+
+    def delete_earlier_segments(self, prefix):
+        # Nothing refers to the segments of earlier uploads once the
+        # manifest under prefix is written. Object names have no /, so no
+        # other object's segments share the listing prefix.
+        try:
+            names = list_names(
+                self.parent_container.get_connection(),
+                self.parent_container.get_segment_container_name(),
+                '%s/slo/' % remote_filename(self.path))
+        except Exception as e:
+            print ('%s Listing   FAILED TO LIST SEGMENTS OF %s (%s)'
+                   %(datetime.datetime.now(), self.path, e))
+            return
+        self.delete_segments([segment_name for segment_name in names
+                              if not segment_name.startswith(prefix + '/')])
+
+    def delete_segments(self, names):
+        # A segment left behind only costs its storage, so failures here
+        # don't fail the file
+        conn = self.parent_container.get_connection()
+        segment_container = self.parent_container.get_segment_container_name()
+        for segment_name in names:
+            try:
+                conn.delete_object(segment_container, segment_name)
+            except Exception as e:
+                print ('%s Delete    FAILED TO DELETE SEGMENT %s (%s)'
+                       %(datetime.datetime.now(), segment_name, e))
+
+    def can_copy_from(self, source_file):
+        # Swift can only copy objects within a cluster, which for Cloud
+        # Files means within a region
+        return (isinstance(source_file, RemoteFile) and
+                source_file.region == self.region and
+                source_file.size() <= transfers.COPY_LIMIT)
+
+    def copy_from(self, source_file):
+        conn = self.parent_container.get_connection()
+        conn.copy_object(source_file.container_name,
+                         remote_filename(source_file.path),
+                         self.container_name,
+                         new_obj_name=remote_filename(self.path))
+
+        info = source_file.index.get(source_file.path)
+        self.index.add(remote_filename(self.path), source_file.stored_size(),
+                       info and info.hash)
+        self.cache.pop('size', None)
+
+        # Copies are of the stored data, compressed or not
+        self.set_codec(*(source_file.codec() or (None, None)))
+
+    def sibling(self, path):
+        """Another object in this container, such as a copy source."""
+        return RemoteFile(self.parent_container, self.parent_directory, path)
+
+    def open(self):
+        container = self.parent_container.get_container()
+        url = container.get_object(remote_filename(self.path)).get_temp_url(
+            3600)
+        url = url.replace(' ', '%20')
+        metrics.count_call('pyrax', 'temp_url_get')
+        response = urllib2.urlopen(url)
+        stream = self.parent_container.scheduler.reader(response, 'down')
+
+        codec = self.stored_codec(response_metadata(response))
+        if codec:
+            stream = compression.DecompressingReader(stream, codec[0])
+        return stream
+
     def fetch(self):
-        conn = pyrax.connect_to_cloudfiles(region=self.region.upper())
-        container = conn.create_container(self.container_name)
+        local_file = self.fetch_stored()
+        codec = self.codec()
+        if codec:
+            local_file = compression.decompress_file(local_file, codec[0])
+        return local_file
 
-        (local_fd, local_file) = tempfile.mkstemp()
-        os.close(local_fd)
+    def fetch_stored(self):
+        container = self.parent_container.get_container()
+        transfer_scheduler = self.parent_container.scheduler
 
         url = container.get_object(remote_filename(self.path)).get_temp_url(
             3600)
         url = url.replace(' ', '%20')
         print '%s Fetch URL is %s' %(datetime.datetime.now(), url)
 
-        maxval = self.size()
+        (local_fd, local_file) = tempfile.mkstemp()
+        os.close(local_fd)
+
+        maxval = self.stored_size()
         if maxval == 0:
             # Special case for zero length remote files
             with open(local_file, 'w') as f:
                 pass
             return local_file
-       
+
+        if maxval > self.parent_container.fetch_threshold:
+            def fetch_range(start, end):
+                metrics.count_call('pyrax', 'temp_url_get')
+                response = urllib2.urlopen(urllib2.Request(
+                    url, headers={'Range': 'bytes=%d-%d' %(start, end)}))
+                # Without the range, this would be the whole object
+                if response.getcode() != 206:
+                    response.close()
+                    raise Exception('range request returned %d'
+                                    % response.getcode())
+                self.stored_codec(response_metadata(response))
+                return response
+
+            try:
+                transfers.ranged_fetch(local_file, maxval,
+                                       self.parent_container.fetch_chunk_size,
+                                       self.parent_container.fetch_jobs,
+                                       fetch_range, name=self.path,
+                                       transfer_scheduler=transfer_scheduler)
+            except Exception:
+                os.remove(local_file)
+                raise
+            print '%s Fetch finished' % datetime.datetime.now()
+            return local_file
+
         if has_progressbar: 
             widgets = ['Fetching: ', ' ', progressbar.Percentage(), ' ',
                        progressbar.Bar(marker=progressbar.RotatingMarker()),
@@ -320,23 +764,31 @@ class RemoteFile(object):
             pbar = progressbar.ProgressBar(widgets=widgets,
                                            maxval=maxval).start()
 
-        r = urllib2.urlopen(url)
-        count = 0
         try:
-            with open(local_file, 'w') as f:
-                d = r.read(409600)
-                count += len(d)
-                while d:
-                    f.write(d)
-                    d = r.read(14096)
-                    count += len(d)
+            with transfer_scheduler.request('down', maxval, streamed=True):
+                metrics.count_call('pyrax', 'temp_url_get')
+                response = urllib2.urlopen(url)
+                self.stored_codec(response_metadata(response))
+                r = transfer_scheduler.reader(response, 'down')
+                count = 0
+                try:
+                    with open(local_file, 'w') as f:
+                        d = r.read(409600)
+                        count += len(d)
+                        while d:
+                            f.write(d)
+                            d = r.read(14096)
+                            count += len(d)
+                            if has_progressbar:
+                                pbar.update(count)
+
+                finally:
                     if has_progressbar:
-                        pbar.update(count)
-
-        finally:
-            if has_progressbar:
-                pbar.finish()
-            print '%s Fetch finished' % datetime.datetime.now()
-            r.close()
+                        pbar.finish()
+                    print '%s Fetch finished' % datetime.datetime.now()
+                    r.close()
+        except Exception:
+            os.remove(local_file)
+            raise
 
         return local_file
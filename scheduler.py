@@ -0,0 +1,288 @@
+# Bandwidth limits and adaptive concurrency for requests to object stores
+
+
+import contextlib
+import datetime
+import re
+import threading
+import time
+
+import streams
+
+
+MB = 1024 * 1024
+
+# A request is only healthy if it takes at most this many times longer,
+# per mb, than requests usually do
+LATENCY_FACTOR = 2.0
+
+# Don't back off again within this many seconds of the last time, so that
+# a burst of failures from one overload only halves concurrency once
+BACKOFF_INTERVAL = 5
+
+# Errors which mean the provider wants us to slow down
+CONGESTION_RE = re.compile('(\\b(408|429|500|502|503|504)\\b|timed out|'
+                           'RateLimit)')
+
+
+class TokenBucket(object):
+    """Allow rate bytes a second on average, in bursts of up to a second.
+
+    Callers which take more than is available go into debt and sleep it
+    off, so requests larger than the bucket still work and later callers
+    queue behind them.
+    """
+
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.time()
+
+    def set_rate(self, rate):
+        with self.lock:
+            if rate != self.rate:
+                self.rate = rate
+                self.tokens = min(self.tokens, rate)
+
+    def consume(self, size):
+        """Take size bytes, returning how long we slept for them."""
+
+        with self.lock:
+            if not self.rate:
+                return 0
+
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            wait = max(0.0, -self.tokens / self.rate)
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class Schedule(object):
+    """A bandwidth limit which depends on the time of day.
+
+    Specs are comma separated. Entries like 08:00-18:00=2 limit the
+    window to 2 mb/s, and a bare number is the limit at all other times.
+    Windows may wrap past midnight, and 0 means unlimited.
+    """
+
+    def __init__(self, default=0, windows=None):
+        self.default = default
+        self.windows = windows or []
+
+    @classmethod
+    def parse(cls, spec):
+        schedule = cls()
+        for entry in spec.split(','):
+            entry = entry.strip()
+            if not entry:
+                continue
+
+            if '=' not in entry:
+                schedule.default = float(entry) * MB
+                continue
+
+            window, rate = entry.split('=')
+            start, end = window.split('-')
+            schedule.windows.append((cls._minutes(start), cls._minutes(end),
+                                     float(rate) * MB))
+        return schedule
+
+    @staticmethod
+    def _minutes(value):
+        hours, minutes = value.split(':')
+        return int(hours) * 60 + int(minutes)
+
+    def rate_at(self, now=None):
+        t = time.localtime(now)
+        minute = t.tm_hour * 60 + t.tm_min
+        for start, end, rate in self.windows:
+            if start <= end:
+                if start <= minute < end:
+                    return rate
+            elif minute >= start or minute < end:
+                return rate
+        return self.default
+
+
+class ConcurrencyLimiter(object):
+    """Limit requests in flight, adjusting the limit AIMD style.
+
+    The limit grows by one each time as many healthy requests as the
+    limit have completed, and halves when the provider reports overload
+    or times out. Requests which are slow compared to the usual latency
+    stop growth without backing off.
+    """
+
+    def __init__(self, maximum, initial=None):
+        self.maximum = maximum
+        self.limit = initial or max(1, maximum / 2)
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.successes = 0
+        self.baseline = None
+        self.backed_off = 0
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, elapsed=None, size=0, error=None):
+        with self.cond:
+            self.in_flight -= 1
+            if error is not None:
+                if congested(error):
+                    self._decrease()
+            elif elapsed is not None:
+                self._sample(elapsed / max(size, MB) * MB)
+            self.cond.notify_all()
+
+    def _sample(self, cost):
+        if self.baseline is None:
+            self.baseline = cost
+
+        if cost > self.baseline * LATENCY_FACTOR:
+            self.successes = 0
+            return
+
+        self.baseline = self.baseline * 0.95 + cost * 0.05
+        self.successes += 1
+        if self.successes >= self.limit and self.limit < self.maximum:
+            self.limit += 1
+            self.successes = 0
+            print ('%s Concurrency raised to %d'
+                   %(datetime.datetime.now(), self.limit))
+
+    def _decrease(self):
+        self.successes = 0
+        if time.time() - self.backed_off < BACKOFF_INTERVAL:
+            return
+        self.backed_off = time.time()
+        self.limit = max(1, self.limit / 2)
+        print ('%s Concurrency lowered to %d'
+               %(datetime.datetime.now(), self.limit))
+
+
+def congested(error):
+    for attr in ('http_status', 'code', 'status'):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value in (408, 429, 500, 502, 503, 504)
+    return (CONGESTION_RE.search(str(error)) is not None or
+            CONGESTION_RE.search(error.__class__.__name__) is not None)
+
+
+class ThrottledReader(object):
+    """Wrap a file-like object so reads from it respect the bandwidth cap."""
+
+    def __init__(self, scheduler, stream, direction,
+                 chunk_size=streams.CHUNK_SIZE):
+        self.scheduler = scheduler
+        self.stream = stream
+        self.direction = direction
+        self.chunk_size = chunk_size
+
+    def read(self, size=-1):
+        d = self.stream.read(size)
+        if d:
+            self.scheduler.throttle(self.direction, len(d))
+        return d
+
+    def __iter__(self):
+        while True:
+            d = self.read(self.chunk_size)
+            if not d:
+                return
+            yield d
+
+    def close(self):
+        if hasattr(self.stream, 'close'):
+            self.stream.close()
+
+
+class Scheduler(object):
+    """Shared by every container in a sync, so limits apply to the whole.
+
+    Uploads and downloads have separate bandwidth caps of the same size.
+    With no bandwidth spec and no max_requests, nothing is limited.
+    """
+
+    def __init__(self, bandwidth=None, max_requests=0):
+        self.schedule = None
+        if bandwidth:
+            self.schedule = Schedule.parse(bandwidth)
+        self.buckets = {'up': TokenBucket(), 'down': TokenBucket()}
+
+        self.limiter = None
+        if max_requests:
+            self.limiter = ConcurrencyLimiter(max_requests)
+
+        # Time each thread has spent asleep for bandwidth, which is left
+        # out of request latencies
+        self.local = threading.local()
+
+    def throttle(self, direction, size):
+        if not self.schedule or not size:
+            return
+        bucket = self.buckets[direction]
+        bucket.set_rate(self.schedule.rate_at())
+        self.local.throttled = (getattr(self.local, 'throttled', 0) +
+                                bucket.consume(size))
+
+    def reader(self, stream, direction):
+        if not self.schedule:
+            return stream
+        return ThrottledReader(self, stream, direction)
+
+    @contextlib.contextmanager
+    def unlimited(self):
+        """Don't count requests made by this thread against max_requests.
+
+        For streams fed from a streams.Tee: a reader waiting for a slot
+        can stall the tee, and with it the other readers holding slots.
+        Bandwidth limits still apply.
+        """
+
+        self.local.unlimited = True
+        try:
+            yield
+        finally:
+            self.local.unlimited = False
+
+    @contextlib.contextmanager
+    def request(self, direction, size=0, streamed=False):
+        """Run one request of size bytes under the limits.
+
+        Unless the data is streamed through reader(), the whole size is
+        paid for before the request starts.
+        """
+
+        if not streamed:
+            self.throttle(direction, size)
+        if not self.limiter or getattr(self.local, 'unlimited', False):
+            yield
+            return
+
+        self.limiter.acquire()
+        throttled = getattr(self.local, 'throttled', 0)
+        start = time.time()
+        try:
+            yield
+        except Exception, e:
+            self.limiter.release(error=e)
+            raise
+        self.limiter.release(
+            elapsed=(time.time() - start -
+                     (getattr(self.local, 'throttled', 0) - throttled)),
+            size=size)
+
+
+UNLIMITED = Scheduler()
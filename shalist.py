@@ -0,0 +1,210 @@
+# Reading and writing the per-directory checksum manifests
+
+
+import datetime
+import hashlib
+import json
+import os
+import re
+import threading
+import zlib
+
+
+# A legacy manifest is a single .shalist object holding a JSON dictionary
+# of path to checksum. A sharded manifest splits the same dictionary across
+# .shalist-<shard>-<count> objects by a hash of the path, optionally
+# gzipped, so that only the shards with changed entries are rewritten.
+LEGACY = '.shalist'
+SHARD_RE = re.compile('^\.shalist-([0-9]+)-([0-9]+)(\.gz)?$')
+
+SHARD_ENTRIES = 1000
+
+# Objects stored compressed have a second entry, under this prefix and the
+# path, holding the codec and size of the original content. The original
+# checksum stays in the ordinary entry.
+CODEC_PREFIX = 'codec:'
+
+
+def is_manifest(path):
+    name = os.path.basename(path)
+    return (name.endswith('.sha512') or name.endswith('.shalist') or
+            SHARD_RE.match(name) is not None)
+
+
+def shard_for(key, count):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:8], 16) % count
+
+
+def shard_name(shard, count, compress):
+    name = '.shalist-%03d-%03d' %(shard, count)
+    if compress:
+        name += '.gz'
+    return name
+
+
+def decode(name, data):
+    if name.endswith('.gz'):
+        data = zlib.decompress(data, zlib.MAX_WBITS | 32)
+    return json.loads(data)
+
+
+def encode(name, entries):
+    if name == LEGACY:
+        return json.dumps(entries, sort_keys=True, indent=4)
+
+    data = json.dumps(entries, sort_keys=True, separators=(',', ':'))
+    if name.endswith('.gz'):
+        c = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        data = c.compress(data) + c.flush()
+    return data
+
+
+class Manifest(object):
+    """The checksums of the files in one remote directory.
+
+    The manifest doesn't talk to the object store itself. load() and
+    write() take callbacks which read, write and delete manifest objects
+    by their name within the directory.
+    """
+
+    def __init__(self, sharded=False, compress=False,
+                 shard_entries=SHARD_ENTRIES):
+        self.sharded = sharded
+        self.compress = compress
+        self.shard_entries = shard_entries
+        self.lock = threading.Lock()
+
+        self.entries = {}
+        self.existing = set()
+        self.count = None
+        self.dirty = set()
+
+    def load(self, names, read):
+        """Read the named manifest objects, legacy or sharded."""
+
+        # Legacy first, so that shards written after a migration win
+        for name in sorted(names, key=lambda n: n != LEGACY):
+            if name != LEGACY and not SHARD_RE.match(name):
+                continue
+
+            data = read(name)
+            if data is None:
+                continue
+            try:
+                self.entries.update(decode(name, data))
+                self.existing.add(name)
+            except ValueError, e:
+                print ('%s Ignoring corrupt manifest %s: %s'
+                       %(datetime.datetime.now(), name, e))
+
+            m = SHARD_RE.match(name)
+            if m:
+                self.count = max(self.count, int(m.group(2)))
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def keys(self):
+        with self.lock:
+            return [key for key in self.entries
+                    if not key.startswith(CODEC_PREFIX)]
+
+    def update(self, key, checksum):
+        with self.lock:
+            self._set(key, checksum)
+
+    def _set(self, key, value):
+        if self.entries.get(key) == value:
+            return
+        if value is None:
+            del self.entries[key]
+        else:
+            self.entries[key] = value
+        if self.count:
+            self.dirty.add(shard_for(key, self.count))
+
+    def codec(self, key):
+        """(codec, original size) if key is stored compressed, else None."""
+
+        value = self.entries.get(CODEC_PREFIX + key)
+        if not value:
+            return None
+        codec, size = value.split(':')
+        return codec, int(size)
+
+    def update_codec(self, key, codec=None, size=None):
+        value = None
+        if codec:
+            value = '%s:%d' %(codec, size)
+        with self.lock:
+            self._set(CODEC_PREFIX + key, value)
+
+    def _layout(self):
+        # Power of two shard counts, grown once shards get too full
+        count = self.count or 1
+        while len(self.entries) > count * self.shard_entries * 2:
+            count *= 2
+        if not self.count:
+            while count * self.shard_entries < len(self.entries):
+                count *= 2
+        return count
+
+    def write(self, write, delete):
+        """Write the manifest, rewriting as little as possible.
+
+        Objects are encoded under the lock, but written outside it, so
+        updates needn't wait for the store. If a write raises, the shards
+        it was writing are dirty again for the next attempt.
+        """
+
+        with self.lock:
+            if not self.sharded:
+                names = set([LEGACY])
+                rewrite = []
+                payloads = [(LEGACY, encode(LEGACY, self.entries))]
+                self.count = None
+            else:
+                count = self._layout()
+                shards = {}
+                for key in self.entries:
+                    shards.setdefault(shard_for(key, count), {})[key] = \
+                        self.entries[key]
+
+                names = set([shard_name(shard, count, self.compress)
+                             for shard in shards])
+                if count != self.count or not names <= self.existing:
+                    rewrite = shards.keys()
+                else:
+                    rewrite = [shard for shard in self.dirty
+                               if shard in shards]
+
+                payloads = []
+                for shard in rewrite:
+                    name = shard_name(shard, count, self.compress)
+                    payloads.append((name, encode(name, shards[shard])))
+                self.count = count
+
+            self.dirty = set()
+
+        try:
+            for name, data in payloads:
+                write(name, data)
+        except Exception:
+            # A new layout isn't recorded as existing until it is complete,
+            # so the next write starts it again
+            with self.lock:
+                self.dirty.update(rewrite)
+            raise
+
+        with self.lock:
+            stale = self.existing - names
+            self.existing = names
+
+        # Old layouts are only removed once the new one is complete
+        for name in stale:
+            delete(name)
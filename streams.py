@@ -0,0 +1,196 @@
+# File-like helpers for moving data between stores without temp files
+
+
+import collections
+import hashlib
+import threading
+
+
+CHUNK_SIZE = 1024 * 1024
+
+# Chunks a Tee holds for each reader
+TEE_BUFFER = 16
+
+
+class HashingReader(object):
+    """Wrap a file-like object, hashing everything read through it.
+
+    Can also be iterated over in chunks, which is what the libcloud upload
+    calls expect. Given the size or checksum the stream should have,
+    reading its end raises if it doesn't, so whatever is storing the data
+    fails rather than keeping it.
+    """
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE, size=None,
+                 checksum=None):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.sha512 = hashlib.sha512()
+        self.count = 0
+        self.size = size
+        self.checksum = checksum
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.chunk_size
+        d = self.stream.read(size)
+        if d:
+            self.sha512.update(d)
+            self.count += len(d)
+        else:
+            self.verify()
+        return d
+
+    def verify(self):
+        if self.size is not None and self.count != self.size:
+            raise Exception('short read, %d of %d bytes'
+                            %(self.count, self.size))
+        if self.checksum and self.hexdigest() != self.checksum:
+            raise Exception('checksum mismatch, read %s but expected %s'
+                            %(self.hexdigest(), self.checksum))
+
+    def __iter__(self):
+        while True:
+            d = self.read(self.chunk_size)
+            if not d:
+                return
+            yield d
+
+    def hexdigest(self):
+        return self.sha512.hexdigest()
+
+    def close(self):
+        if hasattr(self.stream, 'close'):
+            self.stream.close()
+
+
+class IteratorReader(object):
+    """Present an iterator of byte strings as a file-like object."""
+
+    def __init__(self, iterator):
+        self.iterator = iter(iterator)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self.buffer]
+            chunks.extend(self.iterator)
+            self.buffer = ''
+            return ''.join(chunks)
+
+        while len(self.buffer) < size:
+            try:
+                self.buffer += next(self.iterator)
+            except StopIteration:
+                break
+
+        d = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return d
+
+    def close(self):
+        if hasattr(self.iterator, 'close'):
+            self.iterator.close()
+
+
+class Tee(object):
+    """Share one stream between several readers, reading it only once.
+
+    Each reader has its own queue of up to buffer chunks. The stream is
+    read whenever a reader runs dry, so readers go at their own pace
+    until the slowest one is a full buffer behind, when the others wait
+    for it. A reader which is closed early no longer holds anyone back.
+    """
+
+    def __init__(self, stream, count, buffer=TEE_BUFFER,
+                 chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.buffer = buffer
+        self.chunk_size = chunk_size
+        self.cond = threading.Condition()
+        self.queues = [collections.deque() for i in range(count)]
+        self.live = [True] * count
+        self.reading = False
+        self.eof = False
+        self.error = None
+
+    def reader(self, index):
+        return TeeReader(self, index)
+
+    def next_chunk(self, index):
+        with self.cond:
+            while True:
+                if self.queues[index]:
+                    d = self.queues[index].popleft()
+                    self.cond.notify_all()
+                    return d
+                if self.error is not None:
+                    raise self.error
+                if self.eof:
+                    return ''
+                if not self.reading and not self._full():
+                    self.reading = True
+                    break
+                self.cond.wait()
+
+        # Only one reader at a time gets here, so the stream is read in
+        # order
+        try:
+            d = self.stream.read(self.chunk_size)
+        except Exception, e:
+            with self.cond:
+                self.error = e
+                self.reading = False
+                self.cond.notify_all()
+            raise
+
+        with self.cond:
+            self.reading = False
+            if d:
+                for i, queue in enumerate(self.queues):
+                    if self.live[i]:
+                        queue.append(d)
+            else:
+                self.eof = True
+            self.cond.notify_all()
+        return self.next_chunk(index)
+
+    def _full(self):
+        for i, queue in enumerate(self.queues):
+            if self.live[i] and len(queue) >= self.buffer:
+                return True
+        return False
+
+    def detach(self, index):
+        with self.cond:
+            self.live[index] = False
+            self.queues[index].clear()
+            self.cond.notify_all()
+
+
+class TeeReader(object):
+    """One reader's view of a Tee, as a file-like object."""
+
+    def __init__(self, tee, index):
+        self.tee = tee
+        self.index = index
+        self.buffer = ''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.tee.chunk_size
+        if not self.buffer:
+            self.buffer = self.tee.next_chunk(self.index)
+        d = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return d
+
+    def __iter__(self):
+        while True:
+            d = self.read(self.tee.chunk_size)
+            if not d:
+                return
+            yield d
+
+    def close(self):
+        self.tee.detach(self.index)
@@ -0,0 +1,92 @@
+# Run push_to_cloudfiles against benchmark.py's stand-in object store.
+#
+# Run as a script, this is push_to_cloudfiles with the stand-in
+# registered, and takes the path of a cloudfiles config first:
+#
+#   support.py CONFIG [push_to_cloudfiles arguments]
+
+
+import json
+import os
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PROVIDER = 'bench'
+
+# Seconds a sync may take before it is treated as hung
+TIMEOUT = 60
+
+STAND_IN_ARGS = ['--no-checksum-index']
+
+
+class SyncTestCase(unittest.TestCase):
+    """A temporary directory holding source trees and the object store."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='cloudfiles-test-')
+        self.store = os.path.join(self.workdir, 'store')
+        os.makedirs(self.store)
+        self.config = os.path.join(self.workdir, 'cloudfiles.json')
+        with open(self.config, 'w') as f:
+            f.write(json.dumps({PROVIDER: {'access_key': self.store,
+                                           'secret_key': ''}}))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def path(self, *parts):
+        return os.path.join(self.workdir, *parts)
+
+    def write_file(self, path, size):
+        d = os.path.dirname(path)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+
+    def remote(self, name):
+        return '%s@dfw://%s' %(PROVIDER, name)
+
+    def stored(self, container, path):
+        """Path in the store of the object for path in container."""
+        name = '%s/%s' %(container, path)
+        return os.path.join(self.store, container, name.replace('/', '~'))
+
+    def start_sync(self, args):
+        log = open(self.path('sync.log'), 'a')
+        return subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), self.config] +
+            STAND_IN_ARGS + args, stdout=log, stderr=subprocess.STDOUT)
+
+    def wait(self, p, timeout=TIMEOUT):
+        deadline = time.time() + timeout
+        while p.poll() is None:
+            if time.time() > deadline:
+                p.kill()
+                p.wait()
+                self.fail('sync did not finish within %d seconds, see %s'
+                          %(timeout, self.path('sync.log')))
+            time.sleep(0.1)
+        return p.returncode
+
+    def sync(self, args, timeout=TIMEOUT):
+        returncode = self.wait(self.start_sync(args), timeout)
+        self.assertEqual(returncode, 0,
+                         'sync failed, see %s' % self.path('sync.log'))
+
+
+if __name__ == '__main__':
+    import benchmark
+
+    benchmark.register(sys.argv.pop(1))
+    sys.argv[0] = os.path.join(ROOT, 'push_to_cloudfiles.py')
+    runpy.run_path(sys.argv[0], run_name='__main__')
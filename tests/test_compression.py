@@ -0,0 +1,177 @@
+import StringIO
+import glob
+import json
+import os
+import tempfile
+
+import support
+
+import compression
+
+
+class CompressedRestoreTest(support.SyncTestCase):
+    def setUp(self):
+        support.SyncTestCase.setUp(self)
+        self.original = self.path('src', 'a', 'log.txt')
+        os.makedirs(os.path.dirname(self.original))
+        with open(self.original, 'w') as f:
+            for i in range(10000):
+                f.write('line %d of a very compressible log\n' % i)
+
+    def manifests(self):
+        return glob.glob(os.path.join(self.store, 'dest', '*.shalist*'))
+
+    def restored(self):
+        self.sync([self.remote('dest'), 'file://' + self.path('restore')])
+        with open(self.path('restore', 'a', 'log.txt')) as f:
+            return f.read()
+
+    def test_manifest_lost_before_resume(self):
+        # A crash can lose the background manifest write. The journal
+        # put the checksums back, but not that the object was compressed.
+        args = ['--compress', 'gzip', '--journal', self.path('journal'),
+                'file://' + self.path('src'), self.remote('dest')]
+        self.sync(args)
+        for name in self.manifests():
+            os.remove(name)
+        self.sync(['--resume'] + args)
+
+        with open(self.original) as f:
+            self.assertEqual(self.restored(), f.read())
+
+    def test_manifest_without_codec(self):
+        # The object's own metadata still says it is compressed
+        self.sync(['--compress', 'gzip', 'file://' + self.path('src'),
+                   self.remote('dest')])
+        for name in self.manifests():
+            with open(name) as f:
+                entries = json.loads(f.read())
+            with open(name, 'w') as f:
+                f.write(json.dumps(dict(
+                    (key, value) for key, value in entries.items()
+                    if not key.startswith('codec:'))))
+
+        with open(self.original) as f:
+            self.assertEqual(self.restored(), f.read())
+
+
+class ChunkedStream(object):
+    """A stream which returns at most size bytes per read."""
+
+    def __init__(self, data, size):
+        self.stream = StringIO.StringIO(data)
+        self.size = size
+        self.closed = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size
+        return self.stream.read(min(size, self.size))
+
+    def close(self):
+        self.closed = True
+
+
+class RoundTripTest(support.unittest.TestCase):
+    def setUp(self):
+        # Compressible, and several chunks long
+        self.data = ''.join(['line %d\n' % i for i in range(300000)])
+        self.assertTrue(len(self.data) > 2 * compression.CHUNK_SIZE)
+
+    def round_trip(self, codec, data, read_size):
+        compressed = compression.CompressingReader(
+            StringIO.StringIO(data), codec)
+        stored = ''.join(compressed)
+        self.assertEqual(compressed.count, len(stored))
+
+        reader = compression.DecompressingReader(
+            ChunkedStream(stored, 1000), codec)
+        out = []
+        d = reader.read(read_size)
+        while d:
+            out.append(d)
+            d = reader.read(read_size)
+        self.assertEqual(reader.count, len(data))
+        return stored, ''.join(out)
+
+    def test_gzip(self):
+        stored, out = self.round_trip('gzip', self.data, 65536)
+        self.assertEqual(out, self.data)
+        self.assertTrue(len(stored) < len(self.data) / 2)
+
+    def test_read_all(self):
+        stored, out = self.round_trip('gzip', self.data, -1)
+        self.assertEqual(out, self.data)
+
+    def test_empty(self):
+        stored, out = self.round_trip('gzip', '', 100)
+        self.assertEqual(out, '')
+
+    def test_zstd(self):
+        if not compression.has_zstd:
+            self.skipTest('zstandard is not installed')
+        stored, out = self.round_trip('zstd', self.data, 65536)
+        self.assertEqual(out, self.data)
+
+    def test_decompress_file(self):
+        stored = ''.join(compression.CompressingReader(
+            StringIO.StringIO(self.data), 'gzip'))
+        (fd, path) = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(stored)
+        out = compression.decompress_file(path, 'gzip')
+        try:
+            self.assertFalse(os.path.exists(path))
+            with open(out, 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+        finally:
+            os.remove(out)
+
+    def test_worth_compressing(self):
+        self.assertTrue(compression.worth_compressing(self.data[:4096],
+                                                      'gzip'))
+        self.assertFalse(compression.worth_compressing(os.urandom(4096),
+                                                       'gzip'))
+        self.assertFalse(compression.worth_compressing('', 'gzip'))
+
+
+class PrefixedReaderTest(support.unittest.TestCase):
+    def test_sample_put_back(self):
+        # The sample read to decide on compression comes first again
+        stream = ChunkedStream('abcdefghij', 3)
+        sample = stream.read(3)
+        reader = compression.PrefixedReader(sample, stream)
+        self.assertEqual(reader.read(2), 'ab')
+        self.assertEqual(reader.read(10), 'c')
+        self.assertEqual(reader.read(10), 'def')
+        self.assertEqual(reader.read(10), 'ghi')
+        self.assertEqual(reader.read(10), 'j')
+        self.assertEqual(reader.read(10), '')
+
+    def test_read_all(self):
+        reader = compression.PrefixedReader(
+            'abc', StringIO.StringIO('defg'))
+        self.assertEqual(reader.read(1), 'a')
+        self.assertEqual(reader.read(), 'bcdefg')
+
+    def test_iterate_and_close(self):
+        stream = ChunkedStream('defg', 2)
+        reader = compression.PrefixedReader('abc', stream)
+        self.assertEqual(''.join(reader), 'abcdefg')
+        reader.close()
+        self.assertTrue(stream.closed)
+
+    def test_compressed_with_prefix(self):
+        data = 'x' * 100000
+        stream = StringIO.StringIO(data)
+        sample = stream.read(compression.MIN_SIZE)
+        reader = compression.CompressingReader(
+            compression.PrefixedReader(sample, stream), 'gzip')
+        stored = ''.join(reader)
+        restored = compression.DecompressingReader(
+            StringIO.StringIO(stored), 'gzip').read()
+        self.assertEqual(restored, data)
+
+
+if __name__ == '__main__':
+    support.unittest.main()
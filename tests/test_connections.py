@@ -0,0 +1,55 @@
+import threading
+
+import support
+
+import connections
+
+
+class PoolTest(support.unittest.TestCase):
+    def run_thread(self, func):
+        t = threading.Thread(target=func)
+        t.start()
+        t.join()
+
+    def test_slot_per_thread(self):
+        pool = connections.Pool()
+        slots = []
+        ready = threading.Event()
+        done = threading.Event()
+
+        def hold():
+            slots.append(pool.get())
+            ready.set()
+            done.wait()
+
+        t = threading.Thread(target=hold)
+        t.start()
+        ready.wait()
+        try:
+            # A thread keeps its slot, and no other thread can have it
+            self.assertTrue(pool.get() is pool.get())
+            self.assertFalse(pool.get() is slots[0])
+        finally:
+            done.set()
+            t.join()
+
+    def test_slot_reused_after_thread_exits(self):
+        # Each short-lived thread used to connect and look up its
+        # containers again
+        pool = connections.Pool()
+        slots = []
+
+        def use():
+            slot = pool.get()
+            if not hasattr(slot, 'conn'):
+                slot.conn = object()
+            slots.append(slot.conn)
+
+        for i in range(5):
+            self.run_thread(use)
+        self.assertEqual(pool.created, 1)
+        self.assertEqual(len(set(slots)), 1)
+
+
+if __name__ == '__main__':
+    support.unittest.main()
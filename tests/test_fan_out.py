@@ -0,0 +1,22 @@
+import filecmp
+
+import support
+
+
+class FanOutTest(support.SyncTestCase):
+    def test_max_requests_below_destinations(self):
+        # Each destination's upload used to hold a request slot while its
+        # tee reader waited, so the other one could never get going
+        self.write_file(self.path('src', 'big'), 8 * 1024 * 1024)
+        self.sync(['--max-requests', '1', '--fan-out-buffer', '2',
+                   'file://' + self.path('src'), self.remote('one'),
+                   self.remote('two')])
+
+        for container in ('one', 'two'):
+            self.assertTrue(filecmp.cmp(self.path('src', 'big'),
+                                        self.stored(container, 'big'),
+                                        shallow=False))
+
+
+if __name__ == '__main__':
+    support.unittest.main()
@@ -0,0 +1,27 @@
+import filecmp
+
+import support
+
+
+class ResumeTest(support.SyncTestCase):
+    def test_changed_file_in_finished_directory(self):
+        # A directory the journal had finished used to be skipped whole,
+        # however its files had changed since
+        self.write_file(self.path('src', 'dir', 'same'), 1000)
+        self.write_file(self.path('src', 'dir', 'changed'), 1000)
+        args = ['--journal', self.path('journal'), '--resume',
+                'file://' + self.path('src'), self.remote('dest')]
+        self.sync(args)
+
+        self.write_file(self.path('src', 'dir', 'changed'), 2000)
+        self.write_file(self.path('src', 'dir', 'added'), 1000)
+        self.sync(args)
+
+        for name in ('same', 'changed', 'added'):
+            self.assertTrue(filecmp.cmp(
+                self.path('src', 'dir', name),
+                self.stored('dest', 'dir/' + name), shallow=False))
+
+
+if __name__ == '__main__':
+    support.unittest.main()
@@ -0,0 +1,119 @@
+import threading
+
+import support
+
+import listing
+
+
+class Container(object):
+    """list_page() over a fixed set of names, a few names a page."""
+
+    def __init__(self, names, page_size=3):
+        self.names = sorted(names)
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.requests = []
+
+    def list_page(self, prefix, marker, delimiter):
+        with self.lock:
+            self.requests.append((prefix, marker, delimiter))
+
+        entries = []
+        for name in self.names:
+            if not name.startswith(prefix) or (marker and name <= marker):
+                continue
+            if delimiter:
+                i = name.find(delimiter, len(prefix))
+                if i >= 0:
+                    name = name[:i + 1]
+                    if name == marker or (entries and entries[-1] == name):
+                        continue
+            entries.append(name)
+            if len(entries) == self.page_size:
+                break
+
+        objects = [(name, 1, 'hash', 'modified') for name in entries
+                   if not (delimiter and name.endswith(delimiter))]
+        subdirs = [name for name in entries
+                   if delimiter and name.endswith(delimiter)]
+        marker = None
+        if len(entries) == self.page_size:
+            marker = entries[-1]
+        return objects, subdirs, marker
+
+
+def tree(dirs, files):
+    names = []
+    for d in range(dirs):
+        for f in range(files):
+            names.append('c~d%02d~f%02d' % (d, f))
+    return names + ['c~top', 'other']
+
+
+class PartitionTest(support.unittest.TestCase):
+    def partition(self, container, jobs=2, max_depth=listing.MAX_DEPTH):
+        emitted = []
+        prefixes = listing.partition(container.list_page, 'c~',
+                                     emitted.extend, jobs, max_depth)
+        return prefixes, [obj[0] for obj in emitted]
+
+    def test_split_by_directory(self):
+        container = Container(tree(10, 3))
+        prefixes, emitted = self.partition(container)
+        self.assertEqual(sorted(prefixes),
+                         ['c~d%02d~' % d for d in range(10)])
+        self.assertEqual(emitted, ['c~top'])
+
+    def test_slices_cover_everything(self):
+        # Objects emitted on the way and the slices left between them hold
+        # every name under the prefix, each once
+        names = tree(3, 4) + ['c~d00~sub~f%02d' % f for f in range(5)]
+        container = Container(names)
+        prefixes, emitted = self.partition(container, jobs=4)
+
+        found = list(emitted)
+        for p in prefixes:
+            found.extend([obj[0] for obj in
+                          listing.list_objects(container.list_page, p, 1)])
+        self.assertEqual(sorted(found),
+                         sorted([n for n in names if n.startswith('c~')]))
+
+    def test_max_depth(self):
+        names = ['c~a~b~c~d~f%d' % i for i in range(3)]
+        prefixes, emitted = self.partition(Container(names), max_depth=2)
+        self.assertEqual(prefixes, ['c~a~b~'])
+        self.assertEqual(emitted, [])
+
+    def test_enough_slices(self):
+        # Listing stops going deeper once every job has its slices
+        container = Container(tree(20, 2))
+        prefixes, emitted = self.partition(container, jobs=2)
+        self.assertEqual(len(prefixes), 20)
+        for prefix, marker, delimiter in container.requests:
+            self.assertEqual(prefix, 'c~')
+
+    def test_empty(self):
+        prefixes, emitted = self.partition(Container(['other']))
+        self.assertEqual(prefixes, [])
+        self.assertEqual(emitted, [])
+
+    def test_error_raised(self):
+        def list_page(prefix, marker, delimiter):
+            raise IOError('listing failed')
+
+        self.assertRaises(IOError, listing.partition, list_page, 'c~',
+                          lambda objects: None, 2)
+
+
+class ListObjectsTest(support.unittest.TestCase):
+    def test_parallel_listing(self):
+        names = tree(12, 5)
+        container = Container(names, page_size=4)
+        found = [obj[0] for obj in
+                 listing.list_objects(container.list_page, 'c~', 2)]
+        self.assertEqual(sorted(found),
+                         sorted([n for n in names if n.startswith('c~')]))
+
+
+if __name__ == '__main__':
+    support.unittest.main()
@@ -0,0 +1,83 @@
+import os
+import re
+
+import support
+
+try:
+    import remote_pyrax
+    has_pyrax = True
+except ImportError:
+    has_pyrax = False
+
+
+class PlanTest(support.SyncTestCase):
+    def test_planning_creates_no_container(self):
+        # Planning used to create the destination container, as a sync
+        # would before its first upload
+        self.write_file(self.path('src', 'file'), 1000)
+        for args in (['--dry-run'], ['--plan-out', self.path('plan')]):
+            self.sync(args + ['file://' + self.path('src'),
+                              self.remote('dest')])
+            self.assertFalse(os.path.exists(os.path.join(self.store,
+                                                         'dest')))
+
+        # Both plans still found the file to upload
+        with open(self.path('sync.log')) as f:
+            self.assertEqual(
+                len(re.findall('Plan +new +1 files', f.read())), 2)
+
+
+
+class FakeObject(object):
+    def __init__(self, data):
+        self.data = data
+
+    def fetch(self):
+        return self.data
+
+
+class FakeContainer(object):
+    """Just enough of a pyrax container and its remote counterpart."""
+
+    region = 'dfw'
+    container_name = 'dest'
+    read_only = True
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_container(self):
+        return self
+
+    def get_object(self, name):
+        return FakeObject(self.objects[name])
+
+    def delete_object(self, name):
+        del self.objects[name]
+
+
+class FakeDirectory(object):
+    index = None
+    path = 'dest'
+
+    def update_shalist(self, path, checksum):
+        pass
+
+    def write_shalist(self):
+        pass
+
+
+class PlanPyraxTest(support.unittest.TestCase):
+    @support.unittest.skipUnless(has_pyrax, 'pyrax is not installed')
+    def test_planning_keeps_old_style_checksum(self):
+        # Checksums from before manifests are moved into the manifest when
+        # they are found. Planning deleted them, and then dropped the
+        # manifest write.
+        container = FakeContainer({'dest~file.sha512': 'abc'})
+        f = remote_pyrax.RemoteFile(container, FakeDirectory(), 'dest/file')
+        self.assertEqual(f.checksum(), 'abc')
+        self.assertEqual(container.objects, {'dest~file.sha512': 'abc'})
+
+
+if __name__ == '__main__':
+    support.unittest.main()
@@ -0,0 +1,40 @@
+import os
+
+import support
+
+
+class RestoreTest(support.SyncTestCase):
+    def setUp(self):
+        support.SyncTestCase.setUp(self)
+        self.write_file(self.path('src', 'file'), 100000)
+        self.sync(['file://' + self.path('src'), self.remote('dest')])
+
+    def corrupt(self):
+        # Not what the manifest says was stored, but the same size
+        with open(self.stored('dest', 'file'), 'wb') as f:
+            f.write(os.urandom(100000))
+
+    def test_corrupt_object(self):
+        # The checksum mismatch used to be printed, and the file counted
+        # as restored
+        self.corrupt()
+        self.sync([self.remote('dest'), 'file://' + self.path('restore')])
+        with open(self.path('sync.log')) as f:
+            self.assertTrue('checksum mismatch' in f.read())
+
+    def test_failed_restore_keeps_old_copy(self):
+        # The download was written straight over the old copy, before it
+        # could be checked
+        self.write_file(self.path('restore', 'file'), 1000)
+        with open(self.path('restore', 'file'), 'rb') as f:
+            old = f.read()
+
+        self.corrupt()
+        self.sync([self.remote('dest'), 'file://' + self.path('restore')])
+        with open(self.path('restore', 'file'), 'rb') as f:
+            self.assertEqual(f.read(), old)
+        self.assertEqual(os.listdir(self.path('restore')), ['file'])
+
+
+if __name__ == '__main__':
+    support.unittest.main()
@@ -0,0 +1,72 @@
+import filecmp
+import os
+
+import support
+
+import benchmark
+
+
+# In mb, so that a file of a few mb is split up
+SEGMENT_ARGS = ['--segment-threshold', '1', '--segment-size', '1',
+                '--fetch-threshold', '1', '--fetch-chunk-size', '1']
+
+
+class SegmentTest(support.SyncTestCase):
+    def setUp(self):
+        support.SyncTestCase.setUp(self)
+        self.write_file(self.path('src', 'file'), 2500000)
+        self.sync(SEGMENT_ARGS + ['file://' + self.path('src'),
+                                  self.remote('dest')])
+
+    def segments(self):
+        found = []
+        for root, dirs, names in os.walk(os.path.join(self.store,
+                                                      'dest_segments')):
+            found.extend([os.path.join(root, name) for name in names])
+        return set(found)
+
+    def restored(self, remote):
+        self.sync(SEGMENT_ARGS + [remote, 'file://' + self.path('restore')])
+        return filecmp.cmp(self.path('src', 'file'),
+                           self.path('restore', 'file'), shallow=False)
+
+    def test_restore(self):
+        self.assertEqual(len(self.segments()), 3)
+        self.assertTrue(self.restored(self.remote('dest')))
+
+    def test_replaced_segments_deleted(self):
+        # Every upload wrote new segments, and the old ones stayed forever
+        first = self.segments()
+        self.write_file(self.path('src', 'file'), 2200000)
+        self.sync(SEGMENT_ARGS + ['file://' + self.path('src'),
+                                  self.remote('dest')])
+
+        second = self.segments()
+        self.assertEqual(len(second), 3)
+        self.assertFalse(first & second)
+        self.assertTrue(self.restored(self.remote('dest')))
+
+    def test_rehash_in_ranges(self):
+        # Without its manifest, the object is fetched in ranges to be
+        # hashed again, and is not uploaded a second time
+        benchmark.remove_manifests(os.path.join(self.store, 'dest'))
+        os.remove(self.path('sync.log'))
+        self.sync(SEGMENT_ARGS + ['file://' + self.path('src'),
+                                  self.remote('dest')])
+        with open(self.path('sync.log')) as f:
+            log = f.read()
+        self.assertTrue('Computing checksum for dest/file' in log)
+        self.assertFalse('Transferring' in log)
+        self.assertTrue(self.restored(self.remote('dest')))
+
+    def test_server_side_copy(self):
+        self.sync([self.remote('dest'), self.remote('copy')])
+        with open(self.path('sync.log')) as f:
+            log = f.read()
+        self.assertTrue('Copying dest/file server side' in log)
+        self.assertFalse('Server side copy failed' in log)
+        self.assertTrue(self.restored(self.remote('copy')))
+
+
+if __name__ == '__main__':
+    support.unittest.main()
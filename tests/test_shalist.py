@@ -0,0 +1,163 @@
+import support
+
+import shalist
+
+
+class Store(object):
+    """Manifest objects by name, for write() and load() callbacks."""
+
+    def __init__(self):
+        self.objects = {}
+        self.written = []
+        self.deleted = []
+        self.fail = set()
+
+    def read(self, name):
+        return self.objects.get(name)
+
+    def write(self, name, data):
+        if name in self.fail:
+            raise Exception('write of %s failed' % name)
+        self.objects[name] = data
+        self.written.append(name)
+
+    def delete(self, name):
+        del self.objects[name]
+        self.deleted.append(name)
+
+    def load(self, **kwargs):
+        manifest = shalist.Manifest(**kwargs)
+        manifest.load(self.objects.keys(), self.read)
+        return manifest
+
+
+class WriteTest(support.unittest.TestCase):
+    def setUp(self):
+        self.store = Store()
+        self.manifest = shalist.Manifest(sharded=True, shard_entries=2)
+        for i in range(8):
+            self.manifest.update('file%d' % i, 'checksum%d' % i)
+        self.manifest.write(self.store.write, self.store.delete)
+        self.store.written = []
+
+    def test_updates_while_writing(self):
+        # The lock used to be held for the whole write
+        def write(name, data):
+            self.assertTrue(self.manifest.lock.acquire(False))
+            self.manifest.lock.release()
+            self.store.write(name, data)
+
+        self.manifest.update('file0', 'changed')
+        self.manifest.write(write, self.store.delete)
+        self.assertEqual(len(self.store.written), 1)
+
+    def test_failed_write_stays_dirty(self):
+        self.manifest.update('file0', 'changed')
+        name = shalist.shard_name(shalist.shard_for('file0', 4), 4, False)
+        self.store.fail.add(name)
+        self.assertRaises(Exception, self.manifest.write, self.store.write,
+                          self.store.delete)
+
+        self.store.fail = set()
+        self.manifest.write(self.store.write, self.store.delete)
+        self.assertEqual(self.store.written, [name])
+
+        loaded = self.store.load(sharded=True)
+        self.assertEqual(loaded['file0'], 'changed')
+
+
+class ShardTest(support.unittest.TestCase):
+    def setUp(self):
+        self.store = Store()
+        self.manifest = shalist.Manifest(sharded=True, shard_entries=2)
+
+    def fill(self, start, end):
+        for i in range(start, end):
+            self.manifest.update('file%d' % i, 'checksum%d' % i)
+
+    def test_shard_count(self):
+        # Enough shards for shard_entries each, in powers of two
+        self.fill(0, 5)
+        self.manifest.write(self.store.write, self.store.delete)
+        self.assertEqual(self.manifest.count, 4)
+        for name in self.store.objects:
+            self.assertTrue(name.endswith('-004'))
+
+    def test_only_dirty_shards_rewritten(self):
+        self.fill(0, 8)
+        self.manifest.write(self.store.write, self.store.delete)
+        self.store.written = []
+
+        self.manifest.update('file1', 'changed')
+        self.manifest.update('file2', None)
+        self.manifest.write(self.store.write, self.store.delete)
+        self.assertEqual(sorted(self.store.written), sorted(set(
+            [shalist.shard_name(shalist.shard_for(key, 4), 4, False)
+             for key in ['file1', 'file2']])))
+
+        loaded = self.store.load(sharded=True)
+        self.assertEqual(loaded['file1'], 'changed')
+        self.assertFalse('file2' in loaded)
+        self.assertEqual(len(loaded.keys()), 7)
+
+    def test_shards_grow(self):
+        # Shards are split once they hold twice shard_entries on average
+        self.fill(0, 8)
+        self.manifest.write(self.store.write, self.store.delete)
+        old = set(self.store.objects)
+
+        self.fill(8, 17)
+        self.manifest.write(self.store.write, self.store.delete)
+        self.assertEqual(self.manifest.count, 8)
+        self.assertEqual(set(self.store.deleted), old)
+        self.assertFalse(old & set(self.store.objects))
+
+        loaded = self.store.load(sharded=True)
+        self.assertEqual(loaded.entries, self.manifest.entries)
+
+    def test_compressed(self):
+        self.manifest = shalist.Manifest(sharded=True, compress=True)
+        self.fill(0, 3)
+        self.manifest.write(self.store.write, self.store.delete)
+        self.assertEqual(self.store.objects.keys(), ['.shalist-000-001.gz'])
+        self.assertEqual(self.store.load(sharded=True).entries,
+                         self.manifest.entries)
+
+
+class MigrationTest(support.unittest.TestCase):
+    def setUp(self):
+        self.store = Store()
+        legacy = shalist.Manifest()
+        for i in range(8):
+            legacy.update('file%d' % i, 'checksum%d' % i)
+        legacy.write(self.store.write, self.store.delete)
+        self.entries = legacy.entries
+        self.store.written = []
+
+    def test_legacy_to_sharded(self):
+        manifest = self.store.load(sharded=True, shard_entries=2)
+        self.assertEqual(manifest.entries, self.entries)
+        manifest.write(self.store.write, self.store.delete)
+
+        # The legacy manifest is only deleted once every shard is written
+        self.assertEqual(manifest.count, 4)
+        for name in self.store.written:
+            self.assertTrue(shalist.SHARD_RE.match(name))
+        self.assertEqual(self.store.deleted, [shalist.LEGACY])
+        self.assertFalse(shalist.LEGACY in self.store.objects)
+        self.assertEqual(self.store.load(sharded=True).entries, self.entries)
+
+    def test_interrupted_migration(self):
+        # Shards written before the legacy manifest was deleted win
+        manifest = self.store.load(sharded=True, shard_entries=2)
+        manifest.update('file0', 'changed')
+        manifest.write(self.store.write, lambda name: None)
+        self.assertTrue(shalist.LEGACY in self.store.objects)
+
+        loaded = self.store.load(sharded=True)
+        self.assertEqual(loaded['file0'], 'changed')
+        self.assertEqual(loaded.count, 4)
+
+
+if __name__ == '__main__':
+    support.unittest.main()
@@ -0,0 +1,29 @@
+import os
+import signal
+import time
+
+import support
+
+
+class SignalTest(support.SyncTestCase):
+    def test_sigterm_mid_transfer(self):
+        # The main thread used to sit in an untimed wait on the pipeline,
+        # where the SIGTERM handler could not run until every file was sent
+        for i in range(8):
+            self.write_file(self.path('src', 'file%d' % i), 4 * 1024 * 1024)
+        p = self.start_sync(['--bwlimit', '1', 'file://' + self.path('src'),
+                             self.remote('dest')])
+
+        deadline = time.time() + support.TIMEOUT
+        while not os.path.exists(os.path.join(self.store, 'dest')):
+            self.assertTrue(time.time() < deadline, 'sync did not start')
+            self.assertEqual(p.poll(), None, 'sync exited early')
+            time.sleep(0.1)
+        time.sleep(1)
+
+        p.send_signal(signal.SIGTERM)
+        self.assertEqual(self.wait(p, timeout=10), 1)
+
+
+if __name__ == '__main__':
+    support.unittest.main()
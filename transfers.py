@@ -0,0 +1,177 @@
+# Helpers for splitting large transfers across several connections
+
+
+import datetime
+import hashlib
+import os
+import sys
+import threading
+
+import scheduler
+import workers
+
+
+# Files larger than this are uploaded in segments
+SEGMENT_THRESHOLD = 256 * 1024 * 1024
+SEGMENT_SIZE = 64 * 1024 * 1024
+SEGMENT_JOBS = 4
+
+# Files larger than this are downloaded as parallel byte ranges
+FETCH_THRESHOLD = 64 * 1024 * 1024
+FETCH_CHUNK_SIZE = 32 * 1024 * 1024
+FETCH_JOBS = 4
+
+# Neither Swift nor S3 will copy objects larger than this in one request
+COPY_LIMIT = 5 * 1024 * 1024 * 1024
+
+
+def segment_size_for(size, segment_size, max_segments):
+    """Grow segment_size if size would need more than max_segments."""
+
+    if size and size > segment_size * max_segments:
+        segment_size = (size + max_segments - 1) / max_segments
+    return segment_size
+
+
+def read_segments(stream, segment_size):
+    """Yield (number, data) for consecutive segments of a stream.
+
+    Segments are numbered from one. An empty stream yields nothing.
+    """
+
+    number = 1
+    while True:
+        chunks = []
+        remaining = segment_size
+        while remaining > 0:
+            d = stream.read(min(remaining, 1024 * 1024))
+            if not d:
+                break
+            chunks.append(d)
+            remaining -= len(d)
+
+        data = ''.join(chunks)
+        if not data:
+            return
+        yield number, data
+        number += 1
+
+        if remaining > 0:
+            return
+
+
+def segmented_upload(stream, segment_size, jobs, upload_segment, name=None,
+                     attempts=3, transfer_scheduler=scheduler.UNLIMITED):
+    """Upload a stream as numbered segments on a pool of threads.
+
+    upload_segment(number, data) stores a single segment and returns
+    whatever the caller needs to build its manifest. Failed segments are
+    retried on their own. The stream is read in order, so a hashing reader
+    wrapping it still sees every byte exactly once, and at most about
+    2 * jobs segments are held in memory at a time. Each segment upload is
+    a request under transfer_scheduler's limits.
+
+    Returns a list of (number, size, md5, result) tuples in segment order.
+    """
+
+    results = {}
+    failures = []
+    lock = threading.Lock()
+
+    def upload(number, data):
+        md5 = hashlib.md5(data).hexdigest()
+        for attempt in range(attempts):
+            try:
+                with transfer_scheduler.request('up', len(data)):
+                    result = upload_segment(number, data)
+                with lock:
+                    results[number] = (number, len(data), md5, result)
+                return
+            except Exception, e:
+                sys.stderr.write('%s Segment %d of %s failed (attempt %d): '
+                                 '%s\n' %(datetime.datetime.now(), number,
+                                          name, attempt, e))
+        with lock:
+            failures.append(number)
+
+    pool = workers.WorkerPool(jobs, queue_size=jobs, name='segment')
+    try:
+        for number, data in read_segments(stream, segment_size):
+            if failures:
+                break
+            pool.submit(upload, number, data)
+        pool.join()
+    finally:
+        pool.close()
+
+    if failures:
+        raise Exception('%d segments of %s failed to upload'
+                        %(len(failures), name))
+
+    print ('%s Uploaded %d segments of %s'
+           %(datetime.datetime.now(), len(results), name))
+    return [results[number] for number in sorted(results)]
+
+
+def ranged_fetch(local_file, size, chunk_size, jobs, fetch_range, name=None,
+                 attempts=3, transfer_scheduler=scheduler.UNLIMITED):
+    """Download an object as byte ranges fetched in parallel.
+
+    fetch_range(start, end) returns a readable stream of the bytes from
+    start to end inclusive. The local file is preallocated and each range
+    is written at its own offset, so ranges can finish in any order.
+    Failed ranges are retried on their own, and each range is a request
+    under transfer_scheduler's limits.
+    """
+
+    with open(local_file, 'wb') as f:
+        f.truncate(size)
+
+    failures = []
+    lock = threading.Lock()
+
+    def fetch_to(start, end):
+        stream = fetch_range(start, end)
+        fd = os.open(local_file, os.O_WRONLY)
+        try:
+            os.lseek(fd, start, os.SEEK_SET)
+            count = 0
+            d = stream.read(1024 * 1024)
+            while d:
+                os.write(fd, d)
+                count += len(d)
+                d = stream.read(1024 * 1024)
+        finally:
+            os.close(fd)
+            if hasattr(stream, 'close'):
+                stream.close()
+        return count
+
+    def fetch(start, end):
+        for attempt in range(attempts):
+            try:
+                with transfer_scheduler.request('down', end - start + 1):
+                    count = fetch_to(start, end)
+
+                if count != end - start + 1:
+                    raise Exception('short read, %d of %d bytes'
+                                    %(count, end - start + 1))
+                return
+            except Exception, e:
+                sys.stderr.write('%s Range %d-%d of %s failed (attempt %d): '
+                                 '%s\n' %(datetime.datetime.now(), start, end,
+                                          name, attempt, e))
+        with lock:
+            failures.append(start)
+
+    pool = workers.WorkerPool(jobs, name='fetch')
+    try:
+        for start in range(0, size, chunk_size):
+            pool.submit(fetch, start, min(start + chunk_size, size) - 1)
+        pool.join()
+    finally:
+        pool.close()
+
+    if failures:
+        raise Exception('%d ranges of %s failed to download'
+                        %(len(failures), name))
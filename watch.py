@@ -0,0 +1,225 @@
+# Notice changes to a local tree with Linux inotify, so that only what
+# changed needs syncing
+
+
+import ctypes
+import ctypes.util
+import datetime
+import errno
+import os
+import select
+import struct
+import time
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF |
+              IN_ONLYDIR)
+
+EVENT = struct.Struct('iIII')
+
+# Seconds a path has to be left alone before it is synced
+DELAY = 5
+
+# Seconds between full scans, in case an event was missed
+RESCAN = 3600
+
+
+_libc = None
+
+
+def libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc
+
+
+def available():
+    try:
+        return hasattr(libc(), 'inotify_init1')
+    except OSError:
+        return False
+
+
+class Watcher(object):
+    """Collect the changes made below a local directory.
+
+    Changes are debounced: a file is only reported once nothing has
+    happened to it for delay seconds, so files still being written are
+    not synced half done. Changes are reported per directory, as the
+    names within it which changed. A name which is a directory stands
+    for everything below it.
+    """
+
+    def __init__(self, root, delay=DELAY):
+        self.root = os.path.abspath(root)
+        self.delay = delay
+
+        self.fd = libc().inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, 'inotify_init1: %s' % os.strerror(e))
+
+        # Watch descriptor -> directory path, and back
+        self.watches = {}
+        self.paths = {}
+
+        # Directory path -> name -> time of the last event
+        self.pending = {}
+        self.overflowed = False
+
+        self.add_tree(self.root)
+        print ('%s Watching  %d directories below %s'
+               %(datetime.datetime.now(), len(self.watches), self.root))
+
+    def add_tree(self, top):
+        for dirpath, dirnames, filenames in os.walk(top):
+            self.add_watch(dirpath)
+
+    def add_watch(self, path):
+        wd = libc().inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            # Directories can vanish before we get to them
+            if e not in (errno.ENOENT, errno.ENOTDIR):
+                print ('%s Could not watch %s: %s'
+                       %(datetime.datetime.now(), path, os.strerror(e)))
+            return
+        self.watches[wd] = path
+        self.paths[path] = wd
+
+    def remove_tree(self, top):
+        # The directory was moved away, so its watches name the wrong
+        # paths now
+        for path in self.paths.keys():
+            if path == top or path.startswith(top + '/'):
+                wd = self.paths.pop(path)
+                del self.watches[wd]
+                libc().inotify_rm_watch(self.fd, wd)
+
+    def poll(self, timeout):
+        """Wait up to timeout seconds for events, and record them."""
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+
+        data = os.read(self.fd, 64 * 1024)
+        now = time.time()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            self.event(wd, mask, name, now)
+
+    def event(self, wd, mask, name, now):
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+
+        if mask & IN_IGNORED:
+            path = self.watches.pop(wd, None)
+            if path is not None:
+                self.paths.pop(path, None)
+            return
+
+        directory = self.watches.get(wd)
+        if directory is None or not name:
+            # Events on a watched directory itself are reported by its
+            # parent too
+            return
+
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+            elif mask & IN_MOVED_FROM:
+                self.remove_tree(path)
+                return
+        elif mask & IN_MOVED_FROM:
+            return
+
+        self.pending.setdefault(directory, {})[name] = now
+
+    def ready(self):
+        """Return (rescan, changes) for everything which has settled.
+
+        changes maps directory paths, relative to the root and None for
+        the root itself, to the set of changed names in them. rescan is
+        True if events were lost and the whole tree needs syncing.
+        """
+
+        if self.overflowed:
+            self.overflowed = False
+            self.pending = {}
+            return True, {}
+
+        cutoff = time.time() - self.delay
+        changes = {}
+        for directory, names in self.pending.items():
+            settled = set([name for name, when in names.items()
+                           if when <= cutoff])
+            if not settled:
+                continue
+            for name in settled:
+                del names[name]
+            if not names:
+                del self.pending[directory]
+
+            relative = os.path.relpath(directory, self.root)
+            if relative == '.':
+                relative = None
+            changes[relative] = settled
+
+        # Directories which are synced whole cover any changes below them
+        covered = set([os.path.join(path or '', name)
+                       for path, names in changes.items() for name in names])
+        for path in changes.keys():
+            parent = path
+            while parent:
+                if parent in covered:
+                    del changes[path]
+                    break
+                parent = os.path.dirname(parent)
+        return False, changes
+
+    def close(self):
+        os.close(self.fd)
+
+
+class CachedContainer(object):
+    """Hand out the same directory object each time a path is asked for.
+
+    Remote directories read their manifests when they are made. Between
+    the syncs of a watch, the container's index and the directories we
+    have already seen stay in memory instead.
+    """
+
+    def __init__(self, container):
+        self.container = container
+        self.directories = {}
+
+    def get_directory(self, path):
+        if path not in self.directories:
+            self.directories[path] = self.container.get_directory(path)
+        return self.directories[path]
+
+    def __getattr__(self, name):
+        return getattr(self.container, name)
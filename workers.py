@@ -0,0 +1,85 @@
+# A bounded pool of worker threads
+
+
+import datetime
+import sys
+import threading
+import Queue
+
+
+# Python only runs signal handlers on the main thread, and not while it
+# is blocked on a lock, so waits there time out this often to let them
+WAIT = 0.5
+
+
+def join_thread(t):
+    """Wait for a thread to finish, without holding off signals."""
+    while t.is_alive():
+        t.join(WAIT)
+
+
+def _put(queue, item):
+    while True:
+        try:
+            queue.put(item, timeout=WAIT)
+            return
+        except Queue.Full:
+            pass
+
+
+class WorkerPool(object):
+    """Run jobs on a fixed number of threads.
+
+    The job queue is bounded, so submit() blocks once the workers fall
+    behind. A pool with zero workers runs each job inline in submit().
+    """
+
+    def __init__(self, workers, queue_size=None, name='worker'):
+        if queue_size is None:
+            queue_size = workers * 2
+
+        self.queue = Queue.Queue(max(queue_size, 1))
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._run, name='%s-%d' %(name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, func, *args, **kwargs):
+        if not self.threads:
+            self._call(func, args, kwargs)
+            return
+        _put(self.queue, (func, args, kwargs))
+
+    def _call(self, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception, e:
+            sys.stderr.write('%s Worker job failed: %s\n'
+                             %(datetime.datetime.now(), e))
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                func, args, kwargs = job
+                self._call(func, args, kwargs)
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        """Wait until every submitted job has finished."""
+        done = self.queue.all_tasks_done
+        with done:
+            while self.queue.unfinished_tasks:
+                done.wait(WAIT)
+
+    def close(self):
+        for t in self.threads:
+            _put(self.queue, None)
+        for t in self.threads:
+            join_thread(t)
+        self.threads = []